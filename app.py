@@ -1,53 +1,1022 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory, abort, redirect, g
 from flask_cors import CORS
 import openai
+import httpx
+import httpcore
 import base64
+import copy
 import requests
+from requests.adapters import HTTPAdapter
 from io import BytesIO
 import os
 import time
 import json
 import random
-from threading import Lock
+import asyncio
+import hashlib
+import heapq
+import itertools
+import re
+import socket
+from contextvars import ContextVar
+from urllib.parse import urlparse
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError as FutureTimeout
+from threading import Event, Lock, Condition
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional: without it images are sent to Vision as-is
+    Image = None
+
+from instrumentation import TimedLock, log, metrics
+from state_stores import (
+    ARCHIVE_PAGE_MAX, BUTTON_BATCH_MAX, BUTTON_EVENTS_BATCH_LIMIT, BUTTON_EVENTS_HEARTBEAT,
+    GENERATION_JOB_DEFAULT_PRIORITY, GENERATION_JOB_WAIT_TIMEOUT, SESSION_ID_PATTERN, SESSION_WAIT_TIMEOUT,
+    VOTE_KEY_MAX_LENGTH, VOTE_VARIANTS, VOTE_WAIT_TIMEOUT, ButtonEventLog, IterationArchive, InstructionPool,
+    JobCancelled, JobQueue, JobQueueFull, SessionConflict, SessionStore, SqliteButtonEventLog,
+    SqliteInstructionPool, SqliteJobQueue, SqliteSessionStore, SqliteVoteBoard, StateDatabase, VoteBoard,
+    check_session_id
+)
 
 app = Flask(__name__)
 CORS(app)
 
-# Global variables to manage physical button state
-button_press_state = {
-    'button_pressed': None,
-    'timestamp': None,
-    'processed': True
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_seconds', time.perf_counter() - started,
+                        method=request.method, route=route, status=str(response.status_code))
+    return response
+
+# Shared state for running several worker processes (or several machines on one file
+# system): with STATE_BACKEND=sqlite the button log, sessions, ballots, the instruction
+# pool and generation job status live in one SQLite database in WAL mode instead of
+# process memory. The default
+# "memory" backend is the single-process behaviour, where nothing else needs to see them.
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')  # 'memory' or 'sqlite'
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state.db'))
+def open_state_database():
+    if STATE_BACKEND == 'sqlite':
+        log.info("Shared state in %s", STATE_DB_PATH)
+        return StateDatabase(STATE_DB_PATH)
+    if STATE_BACKEND != 'memory':
+        raise ValueError(f"Unknown STATE_BACKEND {STATE_BACKEND!r} (use 'memory' or 'sqlite')")
+    return None
+
+state_db = open_state_database()
+
+button_lock = TimedLock("button_lock")
+button_log = SqliteButtonEventLog(state_db, lock=button_lock) if state_db else ButtonEventLog(lock=button_lock)
+
+openai.api_key = os.environ.get("OPENAI_API_KEY", "")
+
+# Single-flight coalescing for upstream calls: identical requests that are in
+# flight share one future, and results that just finished are reused for a short TTL.
+SINGLE_FLIGHT_TTL = 5.0  # seconds
+# Endpoints with their own TTL. A reused image would show two kiosks the identical
+# "generated" picture, so DALL-E calls are only shared while in flight.
+SINGLE_FLIGHT_TTLS = {'generate_image': 0}
+SINGLE_FLIGHT_MAX_RECENT = 256
+
+class SingleFlight:
+    """Deduplicates identical calls per (endpoint, key) and counts how many were saved"""
+
+    def __init__(self, ttl=SINGLE_FLIGHT_TTL, max_recent=SINGLE_FLIGHT_MAX_RECENT, ttls=SINGLE_FLIGHT_TTLS):
+        self.ttl = ttl
+        self.ttls = ttls
+        self.max_recent = max_recent
+        self.lock = Lock()
+        self.in_flight = {}
+        self.recent = OrderedDict()
+        self.counters = defaultdict(lambda: {'calls': 0, 'upstream': 0, 'shared_in_flight': 0, 'recent_hits': 0})
+
+    def _prune(self, now):
+        # Caller holds self.lock; entries are ordered by completion time, so this mostly
+        # stops at the first live one
+        while self.recent:
+            key, (expires, _) = next(iter(self.recent.items()))
+            if expires > now and len(self.recent) <= self.max_recent:
+                break
+            self.recent.popitem(last=False)
+
+    def _claim(self, endpoint, full_key):
+        """Returns (owner, future, recent); recent is a 1-tuple when a fresh result exists"""
+        now = time.monotonic()
+        with self.lock:
+            counter = self.counters[endpoint]
+            counter['calls'] += 1
+            self._prune(now)
+            # Checked here too: with per-endpoint TTLs, expiries aren't in completion order
+            if full_key in self.recent and self.recent[full_key][0] > now:
+                counter['recent_hits'] += 1
+                return False, None, (self.recent[full_key][1],)
+            future = self.in_flight.get(full_key)
+            if future is None:
+                future = self.in_flight[full_key] = Future()
+                counter['upstream'] += 1
+                return True, future, None
+            counter['shared_in_flight'] += 1
+            return False, future, None
+
+    def _finish(self, full_key, future, value):
+        ttl = self.ttls.get(full_key[0], self.ttl)
+        with self.lock:
+            self.in_flight.pop(full_key, None)
+            if ttl > 0:
+                self.recent[full_key] = (time.monotonic() + ttl, value)
+        future.set_result(value)
+
+    def _fail(self, full_key, future, error):
+        with self.lock:
+            self.in_flight.pop(full_key, None)
+        future.set_exception(error)
+
+    def do(self, endpoint, key, fn):
+        """Run fn() unless an identical call is in flight or finished within the TTL"""
+        full_key = (endpoint, key)
+        owner, future, recent = self._claim(endpoint, full_key)
+        if recent:
+            return recent[0]
+        if not owner:
+            return future.result()
+
+        try:
+            value = fn()
+        except Exception as e:
+            self._fail(full_key, future, e)
+            raise
+        self._finish(full_key, future, value)
+        return value
+
+    async def do_async(self, endpoint, key, coro_fn):
+        """Async twin of do(): awaits coro_fn() and shares in-flight calls with sync callers too"""
+        full_key = (endpoint, key)
+        owner, future, recent = self._claim(endpoint, full_key)
+        if recent:
+            return recent[0]
+        if not owner:
+            return await asyncio.wrap_future(future)
+
+        try:
+            value = await coro_fn()
+        except BaseException as e:
+            # Includes cancellation, so waiters are never left hanging
+            self._fail(full_key, future, e if isinstance(e, Exception) else RuntimeError('upstream call cancelled'))
+            raise
+        self._finish(full_key, future, value)
+        return value
+
+    def forget(self, endpoint, key):
+        """Drop a finished result so the next call goes upstream again"""
+        with self.lock:
+            self.recent.pop((endpoint, key), None)
+
+    def stats(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, counter in self.counters.items():
+                saved = counter['shared_in_flight'] + counter['recent_hits']
+                endpoints[endpoint] = dict(counter, saved=saved)
+            return {
+                'endpoints': endpoints,
+                'in_flight': len(self.in_flight),
+                'recent': len(self.recent)
+            }
+
+single_flight = SingleFlight()
+
+# Resilient upstream calls: every OpenAI request gets a per-attempt timeout inside an
+# overall deadline, jittered retries on transient errors, and a per-endpoint circuit
+# breaker that fails fast while the upstream is down. Endpoints listed in
+# HEDGE_ENDPOINTS also fire a second, hedged request once the first one has taken
+# longer than that endpoint's recent p95 latency; the first to succeed wins.
+UPSTREAM_TIMEOUTS = {
+    # endpoint: (timeout per attempt, overall deadline) in seconds
+    'analyze_image_with_vision': (30, 60),
+    'generate_text_variants': (30, 60),
+    'generate_variant_batch': (40, 80),
+    'generate_summary': (15, 30),
+    'generate_reflection': (20, 40),
+    'generate_image': (60, 120),
+    'compact_history': (20, 40)
 }
-button_lock = Lock()
+UPSTREAM_DEFAULT_TIMEOUT = (30, 60)
+UPSTREAM_MAX_RETRIES = 2
+UPSTREAM_BACKOFF_BASE = 0.5  # seconds; full jitter over base * 2^attempt
+UPSTREAM_BACKOFF_MAX = 8.0
+CIRCUIT_FAILURE_THRESHOLD = 5  # consecutive transient failures before the circuit opens
+CIRCUIT_RESET_TIMEOUT = 30.0  # seconds before a half-open probe is let through
+HEDGE_ENDPOINTS = set(filter(None, os.environ.get('HEDGE_ENDPOINTS', '').split(',')))
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_LATENCY_WINDOW = 200
+HEDGE_WORKERS = 8
 
-openai.api_key = ""
+# The SDK retries twice on its own by default; retries are handled here instead
+openai.max_retries = 0
 
-def get_random_instruction():
-    """Get a random instruction from the instructions.json file"""
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    TimeoutError,
+    asyncio.TimeoutError
+)
+
+class UpstreamUnavailable(Exception):
+    """Raised without calling upstream while an endpoint's circuit is open"""
+
+class UpstreamBusy(UpstreamUnavailable):
+    """Raised without calling upstream when the rate-limit scheduler sheds a request"""
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in (408, 409)
+
+def retry_delay(error, attempt):
+    """Full-jitter exponential backoff, but never sooner than a Retry-After header asks"""
+    delay = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+    response = getattr(error, 'response', None)
     try:
-        # Get the directory where app.py is located
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        instructions_file = os.path.join(base_dir, 'instructions.json')
-        
-        print(f"🔍 DEBUG: Looking for instructions file at: {instructions_file}")
-        
-        with open(instructions_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            instructions = data.get('random_instructions', [])
-            
-        print(f"🔍 DEBUG: Found {len(instructions)} instructions in file")
-        
-        if instructions:
-            selected = random.choice(instructions)
-            print(f"🔍 DEBUG: Selected instruction: {selected[:50]}...")
-            return selected
+        retry_after = float(response.headers.get('retry-after')) if response is not None else 0.0
+    except (TypeError, ValueError):
+        retry_after = 0.0
+    return max(delay, min(retry_after, UPSTREAM_BACKOFF_MAX))
+
+class CircuitBreaker:
+    """closed -> open after `threshold` consecutive failures -> half-open probe after `reset_timeout`"""
+
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def before_call(self, endpoint):
+        with self.lock:
+            if self.state == 'closed':
+                return
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return
+        metrics.inc('upstream_rejected_total', endpoint=endpoint)
+        raise UpstreamUnavailable(f"{endpoint}: upstream unavailable, circuit open")
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self, endpoint):
+        """Count a transient failure; returns True when the circuit is (now) open"""
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == 'half_open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    log.warning("Circuit for %s opened after %d failures", endpoint, self.failures)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+            return self.state == 'open'
+
+    def release_probe(self):
+        """A probe that ended in a non-transient error says nothing about availability"""
+        with self.lock:
+            self.probing = False
+
+# Rate-limit-aware scheduling: every upstream attempt first takes budget from its model's
+# token buckets (requests and tokens per minute, refilled continuously), so the process
+# stays under the account's limits instead of discovering them through 429s. Waiting
+# requests are served in priority order: the visitor-facing cycle ('interactive') before
+# 'background' work before 'speculative' pre-generation. Admission control sheds a request
+# up front when its queue is full or it would wait longer than its class allows, and a
+# full queue makes room by shedding less important waiters first. A 429 pauses the model
+# for its Retry-After and sheds the queued speculative work. Set UPSTREAM_RATE_LIMITS to the
+# account's limits; they are per process, so with several workers give each its share.
+RATE_LIMITS = {
+    # model: (requests per minute, tokens per minute or None); OpenAI's usage tier 1
+    'gpt-4o': (500, 30000),
+    'gpt-4-turbo': (500, 30000),
+    'dall-e-3': (5, None)  # images per minute
+}
+RATE_LIMIT_BURST = 0.2  # share of a minute's budget that may go out at once
+RATE_LIMIT_MIN_REQUESTS = 2  # requests that may always go out at once: a cycle's two images
+PRIORITIES = ('interactive', 'background', 'speculative')  # most important first
+RATE_QUEUE_LIMITS = {'interactive': 64, 'background': 16, 'speculative': 4}  # waiters of this class or more important
+RATE_QUEUE_MAX = 64  # waiters per model; beyond it less important ones are shed
+RATE_MAX_WAIT = {'interactive': None, 'background': None, 'speculative': 5.0}  # seconds; None waits until the deadline
+RATE_THROTTLE_DEFAULT = 1.0  # seconds a 429 without Retry-After pauses the model
+RATE_THROTTLE_MAX = 60.0
+VISION_IMAGE_TOKENS = {'low': 85, 'high': 1105, 'auto': 1105}  # a 768x1344 image is 6 tiles of 170 + 85
+COMPLETION_TOKENS_DEFAULT = 500
+
+def parse_rate_limits(spec):
+    """UPSTREAM_RATE_LIMITS: 'model=rpm/tpm,...' (tpm 0 or left out for none) overrides
+    RATE_LIMITS, 'off' disables scheduling"""
+    if spec is None:
+        return dict(RATE_LIMITS)
+    if spec.strip() == 'off':
+        return {}
+    limits = dict(RATE_LIMITS)
+    for item in filter(None, spec.split(',')):
+        model, _, values = item.partition('=')
+        rpm, _, tpm = values.partition('/')
+        limits[model.strip()] = (float(rpm), float(tpm) if tpm and float(tpm) else None)
+    return limits
+
+upstream_priority = ContextVar('upstream_priority', default='interactive')
+
+def with_priority(priority, function, *args, **kwargs):
+    """Run function(*args, **kwargs) with its upstream calls scheduled at this priority class
+    (executor threads don't inherit the submitter's context, so wrap the submitted callable)"""
+    token = upstream_priority.set(priority)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        upstream_priority.reset(token)
+
+def estimate_tokens(kwargs):
+    """Tokens a request counts against a tokens-per-minute limit: prompt text at about four
+    characters per token, images by detail, plus max_tokens for the reply (0 for images)"""
+    if 'messages' not in kwargs:
+        return 0
+    characters = 0
+    tokens = kwargs.get('max_tokens') or COMPLETION_TOKENS_DEFAULT
+    for message in kwargs['messages']:
+        content = message.get('content') or ''
+        tokens += 4
+        if isinstance(content, str):
+            characters += len(content)
+            continue
+        for part in content:
+            if part.get('type') == 'text':
+                characters += len(part['text'])
+            elif part.get('type') == 'image_url':
+                tokens += VISION_IMAGE_TOKENS.get(part['image_url'].get('detail', 'auto'), VISION_IMAGE_TOKENS['auto'])
+    return tokens + characters // 4
+
+class TokenBucket:
+    """`capacity` units (a burst share of the minute's budget, at least `minimum` of them)
+    refilled continuously at per_minute / 60 units a second"""
+
+    def __init__(self, per_minute, burst=RATE_LIMIT_BURST, minimum=1.0):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, min(per_minute, minimum), per_minute * burst)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount units are available (after refill)"""
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+class RateTicket:
+    """One request's place in a model's queue, and the budget it took once granted"""
+
+    def __init__(self, model, cost, priority, deadline):
+        self.model = model
+        self.cost = cost
+        self.priority = priority
+        self.rank = PRIORITIES.index(priority)
+        self.deadline = deadline
+        self.queued_at = time.monotonic()
+        self.state = 'waiting'  # -> granted | shed
+        self.reason = None
+
+class ModelLimiter:
+    """Request and token buckets of one model, with its priority queue of waiting tickets"""
+
+    def __init__(self, model, requests_per_minute, tokens_per_minute):
+        self.model = model
+        self.requests = TokenBucket(requests_per_minute, minimum=RATE_LIMIT_MIN_REQUESTS)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.queue = []  # (rank, seq, ticket); tickets no longer waiting are skipped when popped
+        self.paused_until = 0.0
+
+    def refill(self, now):
+        self.requests.refill(now)
+        if self.tokens:
+            self.tokens.refill(now)
+
+    def wait_time(self, requests, tokens, now):
+        """Seconds until `requests` requests costing `tokens` could all go out"""
+        wait_time = max(self.paused_until - now, self.requests.wait_time(requests))
+        if self.tokens:
+            wait_time = max(wait_time, self.tokens.wait_time(tokens))
+        return wait_time
+
+    def take(self, cost):
+        self.requests.level -= 1
+        if self.tokens:
+            self.tokens.level -= min(cost, self.tokens.capacity)
+
+    def waiting(self):
+        return [ticket for _, _, ticket in self.queue if ticket.state == 'waiting']
+
+class RateLimitScheduler:
+    """Per-model token buckets with priority queues and admission control in front of upstream calls"""
+
+    def __init__(self, limits=None):
+        limits = parse_rate_limits(os.environ.get('UPSTREAM_RATE_LIMITS')) if limits is None else limits
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.listeners = []  # called on every change, for waiters on an event loop
+        self.seq = itertools.count()
+        self.limiters = {model: ModelLimiter(model, rpm, tpm) for model, (rpm, tpm) in limits.items()}
+
+    def _notify(self):
+        self.changed.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def _shed(self, ticket, reason):
+        ticket.state = 'shed'
+        ticket.reason = reason
+        metrics.inc('upstream_shed_total', model=ticket.model, priority=ticket.priority, reason=reason.split(' ')[0])
+
+    def _admit(self, kwargs, deadline):
+        """Queue a ticket for the request, or None when its model isn't limited; raises UpstreamBusy
+        when the request is shed up front"""
+        limiter = self.limiters.get(kwargs.get('model'))
+        if limiter is None:
+            return None
+        now = time.monotonic()
+        priority = upstream_priority.get()
+        max_wait = RATE_MAX_WAIT.get(priority)
+        ticket = RateTicket(limiter.model, estimate_tokens(kwargs), priority,
+                            min(deadline, now + max_wait) if max_wait is not None else deadline)
+        limiter.refill(now)
+        waiting = limiter.waiting()
+        ahead = [other for other in waiting if other.rank <= ticket.rank]
+        if len(ahead) >= RATE_QUEUE_LIMITS[priority]:
+            self._shed(ticket, f"queue full ({len(ahead)} waiting)")
         else:
-            print("🔍 DEBUG: No instructions found in file")
+            expected = limiter.wait_time(len(ahead) + 1, sum(other.cost for other in ahead) + ticket.cost, now)
+            if now + expected > ticket.deadline:
+                self._shed(ticket, f"budget exhausted (about {expected:.1f}s to wait)")
+        if ticket.state == 'shed':
+            raise UpstreamBusy(f"{limiter.model}: {priority} request shed, {ticket.reason}")
+        heapq.heappush(limiter.queue, (ticket.rank, next(self.seq), ticket))
+        # Make room by shedding the least important, most recent waiters first
+        excess = len(waiting) + 1 - RATE_QUEUE_MAX
+        for other in sorted(waiting, key=lambda other: (-other.rank, -other.queued_at))[:max(0, excess)]:
+            if other.rank > ticket.rank:
+                self._shed(other, f"displaced by {priority} work")
+        return ticket
+
+    def _grant(self, limiter):
+        """Give budget to the queue head while there is some; returns seconds until the head can
+        go, or None when nothing is waiting"""
+        now = time.monotonic()
+        limiter.refill(now)
+        granted = False
+        wait_time = None
+        while limiter.queue:
+            ticket = limiter.queue[0][2]
+            if ticket.state != 'waiting':
+                heapq.heappop(limiter.queue)
+                continue
+            wait_time = limiter.wait_time(1, ticket.cost, now)
+            if wait_time > 0:
+                break
+            heapq.heappop(limiter.queue)
+            limiter.take(ticket.cost)
+            ticket.state = 'granted'
+            metrics.observe('upstream_queue_wait_seconds', now - ticket.queued_at, model=ticket.model, priority=ticket.priority)
+            granted = True
+            wait_time = None
+        if granted:
+            self._notify()
+        return wait_time
+
+    def _check(self, ticket):
+        """True once granted; raises UpstreamBusy when shed or out of time. Call with the lock held."""
+        limiter = self.limiters[ticket.model]
+        self._grant(limiter)
+        if ticket.state == 'granted':
+            return True
+        if ticket.state == 'waiting' and time.monotonic() >= ticket.deadline:
+            self._shed(ticket, 'timed out waiting for budget')
+            self._notify()
+        if ticket.state == 'shed':
+            raise UpstreamBusy(f"{ticket.model}: {ticket.priority} request shed, {ticket.reason}")
+        return False
+
+    def _next_check(self, ticket):
+        """Seconds a waiter may sleep before checking again (woken earlier on any change)"""
+        head_wait = self._grant(self.limiters[ticket.model])
+        remaining = ticket.deadline - time.monotonic()
+        return max(0.0, min(remaining, head_wait if head_wait is not None else remaining))
+
+    def acquire(self, kwargs, deadline):
+        """Wait for budget for one request (kwargs of a create() call) until the monotonic
+        deadline; returns its ticket (None for unlimited models) or raises UpstreamBusy"""
+        with self.changed:
+            ticket = self._admit(kwargs, deadline)
+            if ticket is None:
+                return None
+            while not self._check(ticket):
+                self.changed.wait(self._next_check(ticket))
+            return ticket
+
+    async def acquire_async(self, kwargs, deadline):
+        """Async twin of acquire(): waits on the event loop instead of holding a thread"""
+        loop = asyncio.get_running_loop()
+        wake_up = asyncio.Event()
+
+        def listener():
+            loop.call_soon_threadsafe(wake_up.set)
+
+        with self.lock:
+            ticket = self._admit(kwargs, deadline)
+            if ticket is None:
+                return None
+            self.listeners.append(listener)
+        try:
+            while True:
+                with self.lock:
+                    wake_up.clear()
+                    if self._check(ticket):
+                        return ticket
+                    timeout = self._next_check(ticket)
+                try:
+                    await asyncio.wait_for(wake_up.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            with self.lock:
+                if ticket.state == 'waiting':
+                    ticket.state = 'shed'
+                    ticket.reason = 'cancelled'
+                    self._notify()
+            raise
+        finally:
+            with self.lock:
+                self.listeners.remove(listener)
+
+    def try_acquire(self, kwargs):
+        """A ticket only if budget is free right now and nobody is waiting (for hedged requests):
+        None for unlimited models, False when there is no budget to spare"""
+        with self.lock:
+            limiter = self.limiters.get(kwargs.get('model'))
+            if limiter is None:
+                return None
+            now = time.monotonic()
+            limiter.refill(now)
+            cost = estimate_tokens(kwargs)
+            if limiter.waiting() or limiter.wait_time(1, cost, now) > 0:
+                return False
+            limiter.take(cost)
+            ticket = RateTicket(limiter.model, cost, upstream_priority.get(), now)
+            ticket.state = 'granted'
+            return ticket
+
+    def refund(self, ticket):
+        """Give back the budget of a request that was never sent"""
+        if not ticket:
+            return
+        with self.lock:
+            limiter = self.limiters[ticket.model]
+            limiter.requests.level = min(limiter.requests.capacity, limiter.requests.level + 1)
+            if limiter.tokens:
+                limiter.tokens.level = min(limiter.tokens.capacity, limiter.tokens.level + ticket.cost)
+            self._notify()
+
+    def settle(self, ticket, response):
+        """Charge what the response reports beyond the estimate. Nothing is given back when it
+        used less: OpenAI counts max_tokens against the limit, not the reply's length."""
+        usage = getattr(response, 'usage', None)
+        if not ticket or usage is None or not getattr(usage, 'total_tokens', None):
+            return
+        with self.lock:
+            limiter = self.limiters[ticket.model]
+            if limiter.tokens:
+                limiter.tokens.level -= max(0, usage.total_tokens - min(ticket.cost, limiter.tokens.capacity))
+
+    def throttled(self, ticket, error):
+        """A 429 despite the buckets: pause the model for Retry-After, empty its buckets and
+        shed queued speculative work"""
+        if not ticket:
+            return
+        response = getattr(error, 'response', None)
+        try:
+            pause = float(response.headers.get('retry-after')) if response is not None else RATE_THROTTLE_DEFAULT
+        except (TypeError, ValueError):
+            pause = RATE_THROTTLE_DEFAULT
+        pause = min(pause, RATE_THROTTLE_MAX)
+        metrics.inc('upstream_throttled_total', model=ticket.model)
+        with self.lock:
+            limiter = self.limiters[ticket.model]
+            limiter.paused_until = max(limiter.paused_until, time.monotonic() + pause)
+            limiter.requests.level = min(limiter.requests.level, 0.0)
+            if limiter.tokens:
+                limiter.tokens.level = min(limiter.tokens.level, 0.0)
+            for other in limiter.waiting():
+                if other.priority == 'speculative':
+                    self._shed(other, 'throttled upstream')
+            self._notify()
+        log.warning("%s rate limited upstream, pausing it for %.1fs", ticket.model, pause)
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            result = {}
+            for model, limiter in self.limiters.items():
+                limiter.refill(now)
+                waiting = limiter.waiting()
+                result[model] = {
+                    'requests_available': round(limiter.requests.level, 2),
+                    'tokens_available': round(limiter.tokens.level) if limiter.tokens else None,
+                    'paused_for': round(max(0.0, limiter.paused_until - now), 2),
+                    'queued': {priority: sum(ticket.priority == priority for ticket in waiting) for priority in PRIORITIES}
+                }
+            return result
+
+rate_scheduler = RateLimitScheduler()
+
+class AbortableBackend(httpcore.SyncBackend):
+    """Network backend that can shut down its sockets from another thread; closing the
+    httpx client alone doesn't wake a request that is waiting on the upstream"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sockets = []
+        self.aborted = False
+
+    def connect_tcp(self, *args, **kwargs):
+        stream = super().connect_tcp(*args, **kwargs)
+        with self.lock:
+            self.sockets.append(stream.get_extra_info('socket'))
+            aborted = self.aborted
+        if aborted:
+            self.abort()
+        return stream
+
+    def abort(self):
+        with self.lock:
+            self.aborted = True
+            sockets = list(self.sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def isolated_create(create):
+    """create bound to a copy of its OpenAI client with a connection of its own, and a
+    function that aborts whatever that copy has in flight"""
+    resource = getattr(create, '__self__', None)
+    client = getattr(resource, '_client', None)
+    if not isinstance(client, openai.OpenAI):
+        return create, lambda: None
+    backend = AbortableBackend()
+    transport = httpx.HTTPTransport()
+    transport._pool._network_backend = backend  # HTTPTransport takes no network backend
+    http_client = httpx.Client(transport=transport)
+    bound = getattr(type(resource)(client.with_options(http_client=http_client)), create.__name__)
+
+    def abort():
+        backend.abort()
+        http_client.close()
+    return bound, abort
+
+class UpstreamClient:
+    """Deadlines, retries, circuit breaking and optional hedging around openai create() calls,
+    behind the rate-limit scheduler"""
+
+    def __init__(self, hedge_endpoints=HEDGE_ENDPOINTS, scheduler=rate_scheduler):
+        self.hedge_endpoints = hedge_endpoints
+        self.scheduler = scheduler
+        self.lock = Lock()
+        self.breakers = defaultdict(CircuitBreaker)
+        self.latencies = defaultdict(lambda: deque(maxlen=HEDGE_LATENCY_WINDOW))
+        self.hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+        self.hedge_inflight = 0
+
+    def breaker(self, endpoint):
+        with self.lock:
+            return self.breakers[endpoint]
+
+    def record_latency(self, endpoint, seconds):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+
+    def hedge_delay(self, endpoint):
+        """Recent p95 latency of the endpoint, or None when it isn't hedged (yet)"""
+        if endpoint not in self.hedge_endpoints:
             return None
-    except Exception as e:
-        print(f"🔍 DEBUG: Error reading instructions.json: {e}")
-        return None
+        with self.lock:
+            samples = sorted(self.latencies[endpoint])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(HEDGE_QUANTILE * len(samples)))]
+
+    def _queue_deadline(self, endpoint, deadline):
+        """Waiting for budget stops half an attempt's timeout before the deadline, so a granted
+        request still has time to run"""
+        attempt_timeout, _ = UPSTREAM_TIMEOUTS.get(endpoint, UPSTREAM_DEFAULT_TIMEOUT)
+        return deadline - attempt_timeout / 2
+
+    def _admit(self, endpoint, breaker, kwargs, deadline):
+        """Wait for rate-limit budget, then pass the circuit breaker; returns the scheduler ticket"""
+        ticket = self.scheduler.acquire(kwargs, self._queue_deadline(endpoint, deadline))
+        try:
+            breaker.before_call(endpoint)
+        except UpstreamUnavailable:
+            self.scheduler.refund(ticket)
+            raise
+        return ticket
+
+    async def _admit_async(self, endpoint, breaker, kwargs, deadline):
+        ticket = await self.scheduler.acquire_async(kwargs, self._queue_deadline(endpoint, deadline))
+        try:
+            breaker.before_call(endpoint)
+        except UpstreamUnavailable:
+            self.scheduler.refund(ticket)
+            raise
+        return ticket
+
+    def _retry_delay(self, endpoint, breaker, error, attempt, deadline):
+        """Seconds to back off before retrying after `error`; re-raises it when the call
+        should give up instead (not transient, circuit open, out of retries or time)"""
+        if not is_retryable(error):
+            breaker.release_probe()
+            raise error
+        if breaker.record_failure(endpoint):
+            raise error
+        delay = retry_delay(error, attempt)
+        if attempt + 1 > UPSTREAM_MAX_RETRIES or time.monotonic() + delay >= deadline - 1:
+            raise error
+        metrics.inc('upstream_retries_total', endpoint=endpoint)
+        log.warning("%s failed (%s), retry %d in %.1fs", endpoint, error, attempt + 1, delay)
+        return delay
+
+    def may_hedge(self, endpoint, attempts=1):
+        """Whether the breaker is healthy and the hedge pool has room for `attempts` more"""
+        breaker = self.breaker(endpoint)
+        with breaker.lock:
+            if breaker.state != 'closed' or breaker.failures:
+                return False
+        with self.lock:
+            return self.hedge_inflight + attempts <= HEDGE_WORKERS
+
+    def _submit_hedge(self, create, **kwargs):
+        """Run create on its own connection in the hedge pool; returns the future and an abort function"""
+        create, abort = isolated_create(create)
+        with self.lock:
+            self.hedge_inflight += 1
+        future = self.hedge_executor.submit(create, **kwargs)
+
+        def finished(_):
+            abort()
+            with self.lock:
+                self.hedge_inflight -= 1
+        future.add_done_callback(finished)
+        return future, abort
+
+    def _attempt(self, endpoint, create, kwargs, timeout):
+        delay = self.hedge_delay(endpoint)
+        if delay is None or delay >= timeout or not self.may_hedge(endpoint, 2):
+            return create(timeout=timeout, **kwargs)
+
+        first, abort_first = self._submit_hedge(create, timeout=timeout, **kwargs)
+        try:
+            return first.result(timeout=delay)
+        except FutureTimeout:
+            pass
+        if not self.may_hedge(endpoint) or self.scheduler.try_acquire(kwargs) is False:
+            # Breaker or pool saturated, or no rate-limit budget to spare for a second request
+            return first.result()
+        metrics.inc('upstream_hedges_total', endpoint=endpoint)
+        second, abort_second = self._submit_hedge(create, timeout=timeout - delay, **kwargs)
+        aborts = {first: abort_first, second: abort_second}
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is second:
+                            metrics.inc('upstream_hedge_wins_total', endpoint=endpoint)
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            # The losing request is cut off instead of holding a hedge worker until it finishes
+            for future in pending:
+                future.cancel()
+                aborts[future]()
+
+    def call(self, endpoint, create, **kwargs):
+        """create(**kwargs) with retries until it succeeds, fails for good, or the deadline passes"""
+        attempt_timeout, deadline_seconds = UPSTREAM_TIMEOUTS.get(endpoint, UPSTREAM_DEFAULT_TIMEOUT)
+        deadline = time.monotonic() + deadline_seconds
+        breaker = self.breaker(endpoint)
+        attempt = 0
+        while True:
+            ticket = self._admit(endpoint, breaker, kwargs, deadline)
+            started = time.monotonic()
+            try:
+                with metrics.span('openai', endpoint=endpoint):
+                    result = self._attempt(endpoint, create, kwargs, min(attempt_timeout, deadline - started))
+            except Exception as e:
+                if isinstance(e, openai.RateLimitError):
+                    self.scheduler.throttled(ticket, e)
+                delay = self._retry_delay(endpoint, breaker, e, attempt, deadline)
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self.scheduler.settle(ticket, result)
+            breaker.record_success()
+            self.record_latency(endpoint, time.monotonic() - started)
+            return result
+
+    async def _attempt_async(self, endpoint, create, kwargs, timeout):
+        delay = self.hedge_delay(endpoint)
+        first = asyncio.ensure_future(asyncio.wait_for(create(timeout=timeout, **kwargs), timeout))
+        if delay is None or delay >= timeout:
+            return await first
+
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        if not self.may_hedge(endpoint, 0) or self.scheduler.try_acquire(kwargs) is False:
+            return await first
+        metrics.inc('upstream_hedges_total', endpoint=endpoint)
+        second = asyncio.ensure_future(asyncio.wait_for(create(timeout=timeout - delay, **kwargs), timeout - delay))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            metrics.inc('upstream_hedge_wins_total', endpoint=endpoint)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call_async(self, endpoint, create, **kwargs):
+        """Async twin of call(); create returns a coroutine (AsyncOpenAI)"""
+        attempt_timeout, deadline_seconds = UPSTREAM_TIMEOUTS.get(endpoint, UPSTREAM_DEFAULT_TIMEOUT)
+        deadline = time.monotonic() + deadline_seconds
+        breaker = self.breaker(endpoint)
+        attempt = 0
+        while True:
+            ticket = await self._admit_async(endpoint, breaker, kwargs, deadline)
+            started = time.monotonic()
+            try:
+                with metrics.span('openai', endpoint=endpoint):
+                    result = await self._attempt_async(endpoint, create, kwargs, min(attempt_timeout, deadline - started))
+            except Exception as e:
+                if isinstance(e, openai.RateLimitError):
+                    self.scheduler.throttled(ticket, e)
+                delay = self._retry_delay(endpoint, breaker, e, attempt, deadline)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.scheduler.settle(ticket, result)
+            breaker.record_success()
+            self.record_latency(endpoint, time.monotonic() - started)
+            return result
+
+    def stream(self, endpoint, create, **kwargs):
+        """Text deltas of a streamed chat completion. Deadlines, retries and the circuit
+        breaker apply until the first token arrives; after that the tokens are already on
+        their way to the client, so a failure ends the stream instead of being retried.
+        Streams are never hedged or shared through the single-flight layer."""
+        attempt_timeout, deadline_seconds = UPSTREAM_TIMEOUTS.get(endpoint, UPSTREAM_DEFAULT_TIMEOUT)
+        deadline = time.monotonic() + deadline_seconds
+        breaker = self.breaker(endpoint)
+        attempt = 0
+        while True:
+            ticket = self._admit(endpoint, breaker, kwargs, deadline)
+            started = time.monotonic()
+            try:
+                deltas = stream_text(create(stream=True, timeout=min(attempt_timeout, deadline - started), **kwargs))
+                first = next(deltas, '')
+            except Exception as e:
+                if isinstance(e, openai.RateLimitError):
+                    self.scheduler.throttled(ticket, e)
+                delay = self._retry_delay(endpoint, breaker, e, attempt, deadline)
+                attempt += 1
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            metrics.observe('upstream_first_token_seconds', time.monotonic() - started, endpoint=endpoint)
+            break
+        if first:
+            yield first
+        yield from deltas
+
+    async def stream_async(self, endpoint, create, **kwargs):
+        """Async twin of stream(); create returns a coroutine (AsyncOpenAI)"""
+        attempt_timeout, deadline_seconds = UPSTREAM_TIMEOUTS.get(endpoint, UPSTREAM_DEFAULT_TIMEOUT)
+        deadline = time.monotonic() + deadline_seconds
+        breaker = self.breaker(endpoint)
+        attempt = 0
+        while True:
+            ticket = await self._admit_async(endpoint, breaker, kwargs, deadline)
+            started = time.monotonic()
+            try:
+                deltas = stream_text_async(await create(stream=True, timeout=min(attempt_timeout, deadline - started), **kwargs))
+                first = await anext(deltas, '')
+            except Exception as e:
+                if isinstance(e, openai.RateLimitError):
+                    self.scheduler.throttled(ticket, e)
+                delay = self._retry_delay(endpoint, breaker, e, attempt, deadline)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            metrics.observe('upstream_first_token_seconds', time.monotonic() - started, endpoint=endpoint)
+            break
+        if first:
+            yield first
+        async for delta in deltas:
+            yield delta
+
+    def stats(self):
+        with self.lock:
+            breakers = dict(self.breakers)
+            endpoints = set(breakers) | set(self.latencies)
+        result = {}
+        for endpoint in sorted(endpoints):
+            breaker = breakers.get(endpoint)
+            result[endpoint] = {
+                'circuit': breaker.state if breaker else 'closed',
+                'consecutive_failures': breaker.failures if breaker else 0,
+                'hedged': endpoint in self.hedge_endpoints,
+                'hedge_delay': self.hedge_delay(endpoint)
+            }
+        return result
+
+def stream_text(chunks):
+    """Text deltas of a streamed chat completion"""
+    for chunk in chunks:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def stream_text_async(chunks):
+    async for chunk in chunks:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+upstream = UpstreamClient()
+
+def request_dedup_key(kwargs):
+    """Hash of the request parameters, used as the default single-flight key"""
+    payload = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def call_openai(endpoint, create, dedup_key=None, **kwargs):
+    """Call an openai.* create function through the single-flight layer and the resilient
+    upstream client. The dedup key defaults to a hash of the request parameters."""
+    if dedup_key is None:
+        dedup_key = request_dedup_key(kwargs)
+    return single_flight.do(endpoint, dedup_key, lambda: upstream.call(endpoint, create, **kwargs))
+
+def get_instructions_file():
+    """Path of instructions.json next to app.py"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(base_dir, 'instructions.json')
+
+if state_db:
+    instruction_pool = SqliteInstructionPool(state_db, get_instructions_file())
+else:
+    instruction_pool = InstructionPool(get_instructions_file())
+
+def get_random_instruction():
+    """Get a random instruction from the in-memory instruction pool"""
+    selected = instruction_pool.choice()
+    if selected:
+        log.debug("Selected instruction: %.50s...", selected)
+    else:
+        log.warning("No instructions left in the pool")
+    return selected
 
 def convert_to_past_tense(instruction):
     """Convert instruction text from present/imperative to past tense"""
@@ -101,180 +1070,1444 @@ def convert_to_past_tense(instruction):
     return result
 
 def remove_instruction_from_json(instruction_to_remove):
-    """Remove a specific instruction from the instructions.json file"""
+    """Remove a specific instruction from the pool; the file is rewritten shortly after"""
+    if instruction_pool.remove(instruction_to_remove):
+        log.info("Removed instruction: %s (%d remaining)", instruction_to_remove, instruction_pool.count())
+        return True
+    log.info("Instruction not found: %s", instruction_to_remove)
+    return False
+
+session_store = SqliteSessionStore(state_db) if state_db else SessionStore()
+
+def session_inputs(data):
+    """(session id, prompt, history, image URL) for a generation request. With a sessionId,
+    fields the client leaves out come from the session, so the history isn't re-uploaded."""
+    session_id = data.get('sessionId')
+    if session_id is None:
+        return None, data.get('prompt', ''), data.get('history', []), data.get('imageUrl', 'CircleStart.png')
+    history, current_image, current_prompt = session_store.inputs(session_id)
+    return (
+        session_id,
+        data.get('prompt') or current_prompt or '',
+        data['history'] if 'history' in data else history,
+        data.get('imageUrl') or current_image or 'CircleStart.png'
+    )
+
+def record_session_round(session_id, new_round=False, **round_fields):
+    """Keep a round's generated artifacts in the session (no-op without a session)"""
+    if session_id is not None:
+        session_store.apply(session_id, {'new_round': new_round, 'round': round_fields})
+
+def cycle_round_fields(variants, images, summaries, reflection):
+    return {
+        'variants': variants,
+        'images': [image['modifiedImageUrl'] for image in images],
+        'summaries': [summary['summary'] for summary in summaries],
+        'instructions': [image['debug_info'].get('random_instruction') for image in images],
+        'reflection': reflection.get('reflection')
+    }
+
+vote_board = SqliteVoteBoard(state_db) if state_db else VoteBoard()
+
+def ballot_options(data):
+    """Keyword arguments for VoteBoard.open from a POST /votes/<id>/ballot body; ValueError if invalid"""
+    data = data or {}
+    key = data.get('key')
+    if key is not None and (not isinstance(key, str) or len(key) > VOTE_KEY_MAX_LENGTH):
+        raise ValueError('key must be a string')
+    window = data.get('window')
+    if window is not None and (not isinstance(window, (int, float)) or isinstance(window, bool) or window < 0):
+        raise ValueError('window must be a non-negative number of seconds')
+    votes_to_win = data.get('votes_to_win')
+    if votes_to_win is not None and (not isinstance(votes_to_win, int) or isinstance(votes_to_win, bool) or votes_to_win < 1):
+        raise ValueError('votes_to_win must be a positive integer')
+    return {'key': key, 'window': window, 'votes_to_win': votes_to_win, 'physical': bool(data.get('physical', True))}
+
+def open_ballot(session_id, data):
+    """Body of POST /votes/<id>/ballot, shared with the async app: (JSON body, status)"""
+    try:
+        vote_board.open(session_id, **ballot_options(data))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return vote_board.tally(session_id), 200
+
+def cast_vote(session_id, data):
+    """Body of POST /votes/<id>, shared with the async app: (JSON body, status)"""
+    data = data or {}
+    variant = data.get('variant')
+    if variant not in VOTE_VARIANTS or isinstance(variant, bool):
+        return {'error': f'variant must be one of {list(VOTE_VARIANTS)}'}, 400
+    number = data.get('ballot')
+    if not vote_board.vote(session_id, variant, number):
+        tally = vote_board.tally(session_id)
+        if tally is None:
+            return {'error': 'no ballot is open for this session'}, 404
+        return dict(tally, error='this ballot is closed'), 409
+    return vote_board.tally(session_id), 200
+
+# Shared keep-alive pool for image downloads, with bounded per-host connections and timeouts
+IMAGE_FETCH_TIMEOUT = (3.05, 10)  # (connect, read between bytes) seconds
+IMAGE_FETCH_DEADLINE = 20  # seconds for a whole download, so a slow host can't pin a worker
+IMAGE_FETCH_MAX_BYTES = 20 * 1024 * 1024
+IMAGE_POOL_HOSTS = 8
+IMAGE_POOL_PER_HOST = 8
+
+def make_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=IMAGE_POOL_HOSTS, pool_maxsize=IMAGE_POOL_PER_HOST, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+http_session = make_http_session()
+
+def fetch_url_bytes(url):
+    """Download url through the shared pool within IMAGE_FETCH_DEADLINE and IMAGE_FETCH_MAX_BYTES"""
+    deadline = time.monotonic() + IMAGE_FETCH_DEADLINE
+    with metrics.span('image_fetch', source='http'), \
+            http_session.get(url, timeout=IMAGE_FETCH_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            size += len(chunk)
+            if size > IMAGE_FETCH_MAX_BYTES:
+                raise ValueError(f"Image larger than {IMAGE_FETCH_MAX_BYTES} bytes: {url}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Image download exceeded {IMAGE_FETCH_DEADLINE}s: {url}")
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+# Local content-addressed mirror of generated images. DALL-E URLs expire and are slow to
+# re-download; mirrored images are served from /images/<sha256>.<ext> and read from disk
+# whenever one of those URLs comes back as imageUrl.
+IMAGE_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image_store')
+IMAGE_STORE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600  # names are content hashes, so they never change
+IMAGE_NAME_PATTERN = re.compile(r'^[0-9a-f]{64}(-[a-z]+)?\.(png|jpg|webp)$')  # <sha256>[-<derivative tier>].<ext>
+IMAGE_EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp'}
+
+class ImageStore:
+    """Content-addressed image files with size-bounded, least-recently-used eviction"""
+
+    def __init__(self, directory=IMAGE_STORE_DIR, max_bytes=IMAGE_STORE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.last_used = {}
+        self.pinned = set()  # names eviction must keep (the precomputed variant pool's images)
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(
+            os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory) if IMAGE_NAME_PATTERN.match(name)
+        )
+
+    def path_for(self, name):
+        """Absolute path of a stored image, or None for unknown/invalid names"""
+        if not IMAGE_NAME_PATTERN.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.exists(path) else None
+
+    def path_for_url(self, url):
+        """Stored file behind one of our own /images/ URLs (any host), or None"""
+        path = urlparse(url).path
+        if not path.startswith('/images/'):
+            return None
+        return self.path_for(path[len('/images/'):])
+
+    def pin(self, names):
+        """Keep these images, and their derivatives, out of eviction"""
+        with self.lock:
+            self.pinned.update(image_digest(name) for name in names)
+
+    def touch(self, path):
+        """Record a use for LRU eviction (in memory, so file mtimes and ETags stay stable)"""
+        with self.lock:
+            self.last_used[os.path.basename(path)] = time.time()
+
+    def source_for(self, digest):
+        """Name of the stored original with this content hash, or None"""
+        for extension in IMAGE_EXTENSIONS.values():
+            if self.path_for(f"{digest}.{extension}"):
+                return f"{digest}.{extension}"
+        return None
+
+    def _commit(self, tmp_path, name):
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+                self.total_bytes += os.path.getsize(path)
+        self.touch(path)
+        self.evict()
+        return name
+
+    def put_bytes(self, data, content_type='image/png', name=None):
+        """Store image bytes under name (by default their hash); returns the file name"""
+        name = name or f"{hashlib.sha256(data).hexdigest()}.{IMAGE_EXTENSIONS.get(content_type, 'png')}"
+        tmp_path = os.path.join(self.directory, f".tmp-{os.getpid()}-{time.monotonic_ns()}")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        return self._commit(tmp_path, name)
+
+    def put_from_url(self, url):
+        """Stream a remote image straight to disk while hashing it; returns the file name"""
+        deadline = time.monotonic() + IMAGE_FETCH_DEADLINE
+        tmp_path = os.path.join(self.directory, f".tmp-{os.getpid()}-{time.monotonic_ns()}")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with metrics.span('image_fetch', source='mirror'), \
+                    http_session.get(url, timeout=IMAGE_FETCH_TIMEOUT, stream=True) as response:
+                response.raise_for_status()
+                content_type = response.headers.get('Content-Type', 'image/png').split(';')[0]
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        size += len(chunk)
+                        if size > IMAGE_FETCH_MAX_BYTES:
+                            raise ValueError(f"Image larger than {IMAGE_FETCH_MAX_BYTES} bytes: {url}")
+                        if time.monotonic() > deadline:
+                            raise TimeoutError(f"Image download exceeded {IMAGE_FETCH_DEADLINE}s: {url}")
+                        digest.update(chunk)
+                        f.write(chunk)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return self._commit(tmp_path, f"{digest.hexdigest()}.{IMAGE_EXTENSIONS.get(content_type, 'png')}")
+
+    def evict(self):
+        """Drop least recently used images until the store fits in max_bytes"""
+        with self.lock:
+            if self.total_bytes <= self.max_bytes:
+                return
+            files = []
+            for name in os.listdir(self.directory):
+                if IMAGE_NAME_PATTERN.match(name) and image_digest(name) not in self.pinned:
+                    stat = os.stat(os.path.join(self.directory, name))
+                    files.append((self.last_used.get(name, stat.st_mtime), stat.st_size, name))
+            for _, size, name in sorted(files):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                os.remove(os.path.join(self.directory, name))
+                self.last_used.pop(name, None)
+                self.total_bytes -= size
+                log.info("Image store: evicted %s", name)
+
+    def stats(self):
+        with self.lock:
+            return {'bytes': self.total_bytes, 'max_bytes': self.max_bytes, 'pinned': len(self.pinned)}
+
+def image_digest(name):
+    """Content hash part of a stored image name, shared by an original and its derivatives"""
+    return name.split('.')[0].split('-')[0]
+
+image_store = ImageStore()
+
+# Display-tier derivatives: every mirrored image also gets a version sized for the 2160x3840
+# portrait monitors, a thumbnail for the prompt history and a tiny placeholder to show while
+# the display version loads. A worker pool makes all tiers in one decode right after
+# mirroring. They are named after the original (/images/<sha256>-<tier>.<ext>), so clients
+# derive their URLs, and a request for one not made yet waits for it instead of failing.
+DISPLAY_TIERS = {
+    'display': {'size': (2160, 3840), 'upscale': True, 'format': 'WEBP', 'quality': 90},
+    'thumb': {'size': (320, 560), 'upscale': False, 'format': 'WEBP', 'quality': 75},
+    'placeholder': {'size': (24, 42), 'upscale': False, 'format': 'JPEG', 'quality': 50}
+}
+DERIVATIVE_WORKERS = 2
+DERIVATIVE_WAIT = 1.0  # seconds a request for a missing derivative waits before getting the original
+                       # (it keeps rendering in the background for the next request)
+
+def render_derivatives(image_data):
+    """Every display tier of an image, resized to fit its box: {tier: bytes}"""
+    derivatives = {}
+    with Image.open(BytesIO(image_data)) as source:
+        source = source.convert('RGB')
+        width, height = source.size
+        for tier, settings in DISPLAY_TIERS.items():
+            box_width, box_height = settings['size']
+            scale = min(box_width / width, box_height / height)
+            image = source
+            if scale < 1.0 or (scale > 1.0 and settings['upscale']):
+                image = source.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+            output = BytesIO()
+            image.save(output, format=settings['format'], quality=settings['quality'], optimize=True)
+            derivatives[tier] = output.getvalue()
+    return derivatives
+
+def derivative_name(name, tier):
+    extension = IMAGE_EXTENSIONS[f"image/{DISPLAY_TIERS[tier]['format'].lower()}"]
+    return f"{image_digest(name)}-{tier}.{extension}"
+
+class ImageDerivatives:
+    """Makes the display tiers of stored images once each, on a small thread pool"""
+
+    def __init__(self, store=image_store, workers=DERIVATIVE_WORKERS):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='derivatives')
+        self.lock = Lock()
+        self.in_flight = {}  # original name -> Future
+        self.counters = Counter()
+
+    def submit(self, name):
+        """Make the derivatives of stored original `name` in the background; returns the
+        Future (shared with any job already running for it), or None without Pillow"""
+        if Image is None:
+            return None
+        with self.lock:
+            future = self.in_flight.get(name)
+            if future is not None:
+                return future
+            future = self.in_flight[name] = self.executor.submit(self._make, name)
+        # Outside the lock: a job that already finished runs its callback right here
+        future.add_done_callback(lambda _: self._finished(name))
+        return future
+
+    def _finished(self, name):
+        with self.lock:
+            self.in_flight.pop(name, None)
+
+    def _make(self, name):
+        missing = [tier for tier in DISPLAY_TIERS if not self.store.path_for(derivative_name(name, tier))]
+        if not missing:
+            return
+        path = self.store.path_for(name)
+        if path is None:
+            raise FileNotFoundError(f"Image {name} is no longer in the store")
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            with metrics.span('image_derivatives'):
+                derivatives = render_derivatives(data)
+            for tier in missing:
+                self.store.put_bytes(derivatives[tier], name=derivative_name(name, tier))
+        except Exception as e:
+            log.warning("Error making display derivatives of %s: %s", name, e)
+            with self.lock:
+                self.counters['failed'] += 1
+            raise
+        with self.lock:
+            self.counters['made'] += 1
+
+    def lookup(self, name):
+        """For a requested store name: (path if it exists, Future to wait on for a derivative
+        being made, original to fall back to)"""
+        path = self.store.path_for(name)
+        tier = name.split('.')[0].partition('-')[2]
+        if path or tier not in DISPLAY_TIERS or name != derivative_name(name, tier):
+            return path, None, None
+        source = self.store.source_for(image_digest(name))
+        if source is None:
+            return None, None, None
+        with self.lock:
+            self.counters['on_demand'] += 1
+        return None, self.submit(source), source
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, in_flight=len(self.in_flight))
+
+image_derivatives = ImageDerivatives()
+
+def mirror_generated_image(result, public_base_url):
+    """Copy a freshly generated image into the store and point the result at the local URL.
+    Keeps the remote URL when mirroring fails."""
+    remote_url = result['modifiedImageUrl']
+    try:
+        name = image_store.put_from_url(remote_url)
+    except Exception as e:
+        log.warning("Error mirroring generated image, keeping remote URL: %s", e)
+        return result
+    image_derivatives.submit(name)
+    result['modifiedImageUrl'] = f"{public_base_url.rstrip('/')}/images/{name}"
+    result['debug_info']['remote_image_url'] = remote_url
+    return result
+
+# Precomputed rounds for the first levels of the choice tree, written by precompute_pool.py.
+# Entries are keyed by the image a round starts from (the stored file name, or
+# CircleStart.png), so a hit doesn't depend on the host in the URL. Hits are served
+# without any upstream call. When the upstream fails, only a round for the same image (and
+# the same variants, if chosen) stands in; it is marked as a fallback and not recorded.
+VARIANT_POOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'variant_pool.json')  # None disables the pool
+POOL_START_IMAGE = 'CircleStart.png'
+POOL_START_PROMPT = "Create a simple mutation of shape in the image with minimal design. Use solid colors and clean lines. The image should be very simple and minimal."
+
+def pool_image_key(image_url):
+    """Host-independent key for an image: the file name for our /images/ URLs"""
+    path = urlparse(image_url or '').path
+    if path.startswith('/images/') and IMAGE_NAME_PATTERN.match(path[len('/images/'):]):
+        return path[len('/images/'):]
+    return image_url
+
+iteration_archive = IterationArchive(image_key=pool_image_key)
+
+class VariantPool:
+    """Precomputed cycles keyed by their starting image, persisted as one JSON index"""
+
+    def __init__(self, path=VARIANT_POOL_PATH):
+        self.path = path
+        self.lock = Lock()
+        self.write_lock = Lock()  # one index write at a time (precompute_pool.py puts from several threads)
+        self.entries = {}
+        self.counters = Counter()
+        if path and os.path.exists(path):
+            # A truncated or corrupt index (say from an interrupted precompute run) must not
+            # keep the backend from starting: the pool is only an optimization
+            try:
+                self.entries, pinned = self._load(path)
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                log.error("Could not load %s, starting with an empty variant pool: %s", path, e)
+            else:
+                image_store.pin(pinned)
+                log.info("Variant pool loaded: %d precomputed rounds", len(self.entries))
+
+    def _load(self, path):
+        """(entries, store names of their images); raises on a malformed index"""
+        with metrics.span('json_io', file='variant_pool', op='read'):
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f).get('entries', {})
+        pinned = [pool_image_key(image['modifiedImageUrl']) for entry in entries.values() for image in entry['images']]
+        return entries, pinned
+
+    def __contains__(self, image_url):
+        with self.lock:
+            return pool_image_key(image_url) in self.entries
+
+    def get(self, image_url, variants=None):
+        """The entry for a round starting at image_url (with these variants, if given), or None"""
+        with self.lock:
+            entry = self.entries.get(pool_image_key(image_url))
+            if entry is not None and variants and variants != entry['variants']:
+                entry = None
+            self.counters['hits' if entry else 'misses'] += 1
+            return entry
+
+    def fallback(self, image_url, variants=None):
+        """Something to show while the upstream is failing: this image's entry (with these
+        variants, if given), or None. Another image's round would not match what the visitor sees."""
+        with self.lock:
+            entry = self.entries.get(pool_image_key(image_url))
+            if entry is not None and variants and variants != entry['variants']:
+                entry = None
+            if entry is not None:
+                self.counters['fallbacks'] += 1
+            return entry
+
+    def put(self, entry):
+        """Add an entry (precompute_pool.py) and write the index: temp file, fsync, rename"""
+        image_store.pin(pool_image_key(image['modifiedImageUrl']) for image in entry['images'])
+        with self.write_lock:
+            with self.lock:
+                self.entries[entry['image']] = entry
+                payload = json.dumps({'entries': self.entries}, ensure_ascii=False, indent=1)
+            tmp_path = f"{self.path}.tmp"
+            with metrics.span('json_io', file='variant_pool', op='write'):
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries))
+
+variant_pool = VariantPool()
+
+def absolute_image_url(url, public_base_url):
+    """Pool entries store our images as /images/<name>; clients need the full URL"""
+    if public_base_url and url.startswith('/images/'):
+        return f"{public_base_url.rstrip('/')}{url}"
+    return url
+
+def pool_variants(entry, fallback=False):
+    """A precomputed entry as a /generate-variants answer"""
+    return variant_batch_result(
+        list(entry['variants']),
+        [summary['original_summary'] for summary in entry['summaries']],
+        entry['reflection'],
+        dict(entry['variants_debug_info'], pool={'image': entry['image'], 'fallback': fallback})
+    )
+
+def pool_cycle(entry, public_base_url, fallback=False):
+    """A precomputed entry as a /generate-cycle answer, with image URLs for this host"""
+    images = copy.deepcopy(entry['images'])
+    for image in images:
+        image['modifiedImageUrl'] = absolute_image_url(image['modifiedImageUrl'], public_base_url)
+    return {
+        'variants': list(entry['variants']),
+        'variants_debug_info': entry['variants_debug_info'],
+        'images': images,
+        'summaries': copy.deepcopy(entry['summaries']),
+        'reflection': entry['reflection'],
+        'pool': {'image': entry['image'], 'fallback': fallback}
+    }
+
+def load_image_bytes(image_path_or_url):
+    """Read raw image bytes from a URL or from a path relative to app.py"""
     try:
+        stored_path = image_store.path_for_url(image_path_or_url)
+        if stored_path:
+            # One of our mirrored images: read it from disk instead of over HTTP
+            image_store.touch(stored_path)
+            with metrics.span('image_fetch', source='store'), open(stored_path, 'rb') as image_file:
+                return image_file.read()
+
+        if image_path_or_url.startswith('http'):
+            # Download image from URL
+            log.debug("Downloading image from URL: %s", image_path_or_url)
+            return fetch_url_bytes(image_path_or_url)
+
+        # For local files, construct the full path
         # Get the directory where app.py is located
         base_dir = os.path.dirname(os.path.abspath(__file__))
-        instructions_file = os.path.join(base_dir, 'instructions.json')
-        
-        # Read current instructions
-        with open(instructions_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            instructions = data.get('random_instructions', [])
-        
-        # Remove the instruction if it exists
-        if instruction_to_remove in instructions:
-            instructions.remove(instruction_to_remove)
-            data['random_instructions'] = instructions
-            
-            # Write back to file
-            with open(instructions_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=4, ensure_ascii=False)
-            
-            print(f"Removed instruction: {instruction_to_remove}")
-            print(f"Remaining instructions: {len(instructions)}")
-            return True
-        else:
-            print(f"Instruction not found: {instruction_to_remove}")
-            return False
-            
+        full_path = os.path.join(base_dir, image_path_or_url)
+        log.debug("Trying to read local file: %s", full_path)
+
+        # Check if file exists
+        if not os.path.exists(full_path):
+            log.warning("File not found: %s", full_path)
+            return None
+
+        with metrics.span('image_fetch', source='file'), open(full_path, 'rb') as image_file:
+            return image_file.read()
     except Exception as e:
-        print(f"Error removing instruction from JSON: {e}")
-        return False
+        log.error("Error loading image: %s", e)
+        return None
 
 def encode_image_to_base64(image_path_or_url):
     """Convert image to base64 for GPT-4 Vision"""
-    try:
-        if image_path_or_url.startswith('http'):
-            # Download image from URL
-            print(f"DEBUG: Downloading image from URL: {image_path_or_url}")
-            response = requests.get(image_path_or_url)
-            response.raise_for_status()
-            image_data = response.content
-        else:
-            # For local files, construct the full path
-            # Get the directory where app.py is located
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            full_path = os.path.join(base_dir, image_path_or_url)
-            print(f"DEBUG: Trying to read local file: {full_path}")
-            
-            # Check if file exists
-            if not os.path.exists(full_path):
-                print(f"DEBUG: File not found: {full_path}")
-                return None
-            
-            with open(full_path, 'rb') as image_file:
-                image_data = image_file.read()
-        
-        print("DEBUG: Image successfully encoded to base64")
+    image_data = load_image_bytes(image_path_or_url)
+    if image_data is None:
+        return None
+    with metrics.span('base64_encode'):
         return base64.b64encode(image_data).decode('utf-8')
+
+# Vision analysis cache: same image bytes -> same analysis.
+# One voting cycle analyzes the same image three times (text variants + two images).
+VISION_CACHE_SIZE = 128
+VISION_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vision_cache')  # None disables the disk tier
+
+class VisionCache:
+    """Content-addressed cache for vision analyses: in-memory LRU + optional on-disk tier.
+    Misses go through the single-flight layer, so concurrent lookups share one call."""
+
+    def __init__(self, max_entries=VISION_CACHE_SIZE, cache_dir=VISION_CACHE_DIR):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with metrics.span('json_io', file='vision_cache', op='read'), open(path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('analysis')
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, value):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with metrics.span('json_io', file='vision_cache', op='write'):
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'analysis': value, 'created': time.time()}, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            log.error("Error writing vision cache entry: %s", e)
+
+    def lookup(self, key):
+        """In-memory hit or None"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        return None
+
+    def _load_from_disk(self, key):
+        value = self._read_disk(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value for key, or run compute() once and share its result.
+        compute() must raise on failure so that errors are never cached."""
+        value = self.lookup(key)
+        if value is not None:
+            return value
+
+        def load():
+            value = self._load_from_disk(key)
+            if value is None:
+                value = compute()
+                self._write_disk(key, value)
+            return value
+
+        value = single_flight.do('analyze_image_with_vision', key, load)
+        self._remember(key, value)
+        return value
+
+    async def get_or_compute_async(self, key, compute_async):
+        """Async twin of get_or_compute(); compute_async is a coroutine function"""
+        value = self.lookup(key)
+        if value is not None:
+            return value
+
+        async def load():
+            value = self._load_from_disk(key)
+            if value is None:
+                value = await compute_async()
+                self._write_disk(key, value)
+            return value
+
+        value = await single_flight.do_async('analyze_image_with_vision', key, load)
+        self._remember(key, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+vision_cache = VisionCache()
+
+# Vision payload preprocessing: GPT-4o never looks at more than a 768px short side
+# (high detail) or 512px (low detail), so full 1024x1792 PNGs are mostly wasted upload.
+# Each profile trades analysis accuracy against bytes sent per vision call; pick one with
+# VISION_IMAGE_PROFILE.
+VISION_IMAGE_PROFILES = {
+    'low': {'max_side': 512, 'short_side': 512, 'format': 'JPEG', 'quality': 70, 'detail': 'low'},
+    'balanced': {'max_side': 2048, 'short_side': 768, 'format': 'JPEG', 'quality': 82, 'detail': 'high'},
+    'sharp': {'max_side': 2048, 'short_side': 768, 'format': 'WEBP', 'quality': 92, 'detail': 'high'},
+    'original': None
+}
+VISION_IMAGE_PROFILE = os.environ.get('VISION_IMAGE_PROFILE', 'balanced')
+if VISION_IMAGE_PROFILE not in VISION_IMAGE_PROFILES:
+    raise ValueError(f"Unknown VISION_IMAGE_PROFILE {VISION_IMAGE_PROFILE!r} (use one of {', '.join(VISION_IMAGE_PROFILES)})")
+VISION_PAYLOAD_CACHE_SIZE = 32
+IMAGE_MIME_SIGNATURES = [
+    (b'\x89PNG', 'image/png'),
+    (b'\xff\xd8', 'image/jpeg'),
+    (b'RIFF', 'image/webp'),
+    (b'GIF8', 'image/gif')
+]
+
+vision_payloads = OrderedDict()
+vision_payloads_lock = Lock()
+
+def sniff_image_mime(image_data):
+    for signature, mime in IMAGE_MIME_SIGNATURES:
+        if image_data.startswith(signature):
+            return mime
+    return 'image/jpeg'
+
+def downscale_for_vision(image_data, profile):
+    """Resize to what the vision model actually sees and re-encode; returns (mime, bytes)"""
+    settings = VISION_IMAGE_PROFILES.get(profile)
+    if settings is None or Image is None:
+        return sniff_image_mime(image_data), image_data
+
+    with Image.open(BytesIO(image_data)) as image:
+        image = image.convert('RGB')
+        width, height = image.size
+        # Fit inside max_side x max_side, then bring the short side down to short_side
+        scale = min(1.0, settings['max_side'] / max(width, height), settings['short_side'] / min(width, height))
+        if scale < 1.0:
+            image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS, reducing_gap=2.0)
+        output = BytesIO()
+        image.save(output, format=settings['format'], quality=settings['quality'], optimize=True)
+
+    encoded = output.getvalue()
+    if len(encoded) >= len(image_data):
+        # Tiny flat images can grow when re-encoded: keep the original
+        return sniff_image_mime(image_data), image_data
+    return f"image/{settings['format'].lower()}", encoded
+
+def prepare_vision_payload(image_data, digest, profile=None):
+    """Base64 payload for the vision call, cached by source hash and profile: (mime, base64)"""
+    profile = profile or VISION_IMAGE_PROFILE
+    key = (digest, profile)
+    with vision_payloads_lock:
+        if key in vision_payloads:
+            vision_payloads.move_to_end(key)
+            return vision_payloads[key]
+
+    try:
+        with metrics.span('vision_preprocess', profile=profile):
+            mime, payload = downscale_for_vision(image_data, profile)
+    except Exception as e:
+        log.warning("Error preprocessing image for Vision, sending original: %s", e)
+        mime, payload = sniff_image_mime(image_data), image_data
+    with metrics.span('base64_encode'):
+        result = (mime, base64.b64encode(payload).decode('utf-8'))
+    log.debug("Vision payload %d -> %d bytes (%s, %s)", len(image_data), len(payload), profile, mime)
+
+    with vision_payloads_lock:
+        vision_payloads[key] = result
+        while len(vision_payloads) > VISION_PAYLOAD_CACHE_SIZE:
+            vision_payloads.popitem(last=False)
+    return result
+
+def vision_cache_key(digest, profile=None):
+    """Analyses depend on the preprocessing profile as well as the image"""
+    return f"{digest}-{profile or VISION_IMAGE_PROFILE}"
+
+def vision_request(base64_image, mime='image/jpeg', detail=None):
+    """openai.chat.completions.create arguments for a GPT-4o Vision analysis"""
+    return dict(
+        model="gpt-4o",  # Updated to use the current model with vision capabilities
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text", 
+                        "text": "Analyze this image in detail. Describe the shapes, colors, composition, style, lighting, and any visual elements present. Be very specific and descriptive as this will be used to generate similar artwork variations."
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": dict(
+                            {"url": f"data:{mime};base64,{base64_image}"},
+                            **({"detail": detail} if detail else {})
+                        )
+                    }
+                ]
+            }
+        ],
+        max_tokens=400
+    )
+
+def vision_request_for(image_data, digest, profile=None):
+    """vision_request arguments for raw image bytes, preprocessed per profile"""
+    profile = profile or VISION_IMAGE_PROFILE
+    mime, base64_image = prepare_vision_payload(image_data, digest, profile)
+    settings = VISION_IMAGE_PROFILES.get(profile) or {}
+    return vision_request(base64_image, mime, settings.get('detail'))
+
+def _call_vision_api(image_data, digest):
+    """Send one image to GPT-4o Vision; raises on failure"""
+    response = upstream.call('analyze_image_with_vision', openai.chat.completions.create,
+                             **vision_request_for(image_data, digest))
+    return response.choices[0].message.content
+
+def analyze_image_with_vision(image_path_or_url):
+    """Analyze image using GPT-4o Vision and return detailed description"""
+    log.debug("Trying to analyze image: %s", image_path_or_url)
+    
+    image_data = load_image_bytes(image_path_or_url)
+    if not image_data:
+        log.warning("Failed to load image for Vision: %s", image_path_or_url)
+        return "Unable to analyze image - encoding failed"
+    
+    digest = hashlib.sha256(image_data).hexdigest()
+    log.debug("Image loaded (sha256 %.12s), calling Vision API if not cached...", digest)
+    
+    try:
+        result = vision_cache.get_or_compute(
+            vision_cache_key(digest),
+            lambda: _call_vision_api(image_data, digest)
+        )
+        log.debug("Vision API response: %.100s...", result)
+        return result
+    except Exception as e:
+        log.error("Error analyzing image with Vision: %s", e)
+        return f"Error analyzing image: {str(e)}"
+
+# History compaction: the client sends its whole choice history every round. Prompts get
+# the last HISTORY_KEEP_RECENT..+HISTORY_FOLD_BATCH choices verbatim and a rolling summary
+# of everything older. Older choices are folded in batches at fixed boundaries, and each
+# summary is cached under the hash of the prefix it covers, so every kiosk's next fold
+# starts from its previous summary instead of re-reading the whole history. A cold cache
+# (after a restart) is caught up HISTORY_FOLD_MAX choices per request.
+HISTORY_KEEP_RECENT = 6
+HISTORY_FOLD_BATCH = 4
+HISTORY_FOLD_MAX = 4 * HISTORY_FOLD_BATCH  # most choices one fold request reads
+HISTORY_FALLBACK_CHOICES = 24  # newest unfolded choices sent verbatim when a fold fails
+HISTORY_SUMMARY_MAX_CHARS = 600
+HISTORY_SUMMARY_CACHE_SIZE = 256
+HISTORY_SUMMARY_SYSTEM_MESSAGE = "You keep a compact profile of one gallery visitor's visual preferences."
+
+history_summaries = OrderedDict()
+history_summaries_lock = Lock()
+
+def history_prefix_keys(history, upto):
+    """{b: sha256 of history[:b]} for every fold boundary b <= upto"""
+    digest = hashlib.sha256()
+    keys = {}
+    for index, item in enumerate(history[:upto], start=1):
+        digest.update(json.dumps(item, ensure_ascii=False).encode('utf-8') + b'\n')
+        if index % HISTORY_FOLD_BATCH == 0:
+            keys[index] = digest.hexdigest()
+    return keys
+
+def plan_history_compaction(history):
+    """Returns (latest cached summary, folds still to make, recent choices). Each fold is
+    (summary key, choices) with at most HISTORY_FOLD_MAX choices, oldest first; there are
+    none while the history is short enough to send verbatim."""
+    history = list(history or [])
+    folded = max(0, (len(history) - HISTORY_KEEP_RECENT) // HISTORY_FOLD_BATCH * HISTORY_FOLD_BATCH)
+    if folded == 0:
+        return None, [], history
+    keys = history_prefix_keys(history, folded)
+    boundary, summary = 0, None
+    with history_summaries_lock:
+        for candidate in range(folded, 0, -HISTORY_FOLD_BATCH):
+            if keys[candidate] in history_summaries:
+                history_summaries.move_to_end(keys[candidate])
+                boundary, summary = candidate, history_summaries[keys[candidate]]
+                break
+    folds = []
+    for start in range(boundary, folded, HISTORY_FOLD_MAX):
+        end = min(start + HISTORY_FOLD_MAX, folded)
+        folds.append((keys[end], history[start:end]))
+    return summary, folds, history[folded:]
+
+def remember_history_summary(key, summary):
+    with history_summaries_lock:
+        history_summaries[key] = summary
+        history_summaries.move_to_end(key)
+        while len(history_summaries) > HISTORY_SUMMARY_CACHE_SIZE:
+            history_summaries.popitem(last=False)
+
+def history_fold_request(summary, choices):
+    """openai.chat.completions.create arguments that fold new choices into the summary"""
+    user_message = (
+        f"Current preference summary: {summary or 'none yet'}\n"
+        f"Choices made since then, oldest first: {choices}\n\n"
+        "Update the summary so it also reflects these choices. Keep recurring tendencies "
+        "(colors, shapes, textures, mood) and the direction the choices are drifting in; drop one-offs. "
+        f"Maximum {HISTORY_SUMMARY_MAX_CHARS} characters. Return only the summary."
+    )
+    return dict(
+        model="gpt-4-turbo",
+        messages=[
+            {"role": "system", "content": HISTORY_SUMMARY_SYSTEM_MESSAGE},
+            {"role": "user", "content": user_message}
+        ],
+        max_tokens=200,
+        temperature=0.3
+    )
+
+def history_fold_result(content):
+    return content.strip()[:HISTORY_SUMMARY_MAX_CHARS]
+
+def format_compacted_history(summary, recent):
+    """History text for prompts; identical to the raw list while nothing has been folded"""
+    if summary is None:
+        return f"{recent}"
+    return f"earlier choices, summarized: {summary} | most recent choices: {recent}"
+
+def format_unfolded_history(summary, folds, recent):
+    """History text when folding stopped early: the choices the summary doesn't cover yet
+    go verbatim, truncated to the newest HISTORY_FALLBACK_CHOICES"""
+    unfolded = [choice for _, choices in folds for choice in choices] + recent
+    return format_compacted_history(summary, unfolded[-HISTORY_FALLBACK_CHOICES:])
+
+def compact_history(history):
+    """Bounded-size history text: recent choices verbatim plus a cached rolling summary"""
+    summary, folds, recent = plan_history_compaction(history)
+    for index, (key, choices) in enumerate(folds):
+        try:
+            response = call_openai('compact_history', openai.chat.completions.create,
+                                   **history_fold_request(summary, choices))
+        except Exception as e:
+            # The rest is folded next round; until then it goes in verbatim
+            log.warning("History compaction failed, sending unfolded choices verbatim: %s", e)
+            return format_unfolded_history(summary, folds[index:], recent)
+        summary = history_fold_result(response.choices[0].message.content)
+        remember_history_summary(key, summary)
+    return format_compacted_history(summary, recent)
+
+VARIANT_SYSTEM_INTRO = (
+    "You are an art curator proposing very subtle, minimal changes to artworks. "
+    "You will receive a detailed visual analysis of the current image and the user's choice history. "
+)
+VARIANT_SYSTEM_GUIDELINES = (
+    "Focus on: slight color shifts, minor shape adjustments, small texture changes, small style changes, or gentle lighting modifications. "
+    "AVOID: dramatic transformations. "
+    "Keep the core visual elements and composition similar to what's described in the analysis. "
+    "Each variant should be a single paragraph describing the subtle modification. "
+    "Base your proposals on the user's preferences as inferred from the history. "
+)
+VARIANT_PORTRAIT_HINT = (
+    "IMPORTANT: Remember that the final image will be in VERTICAL/PORTRAIT format, so suggest changes that work well in tall compositions. "
+    "Consider vertical elements, layers, or extensions that utilize the full height of the canvas. "
+)
+
+def variant_context(prompt, history, image_analysis):
+    return (
+        f"CURRENT IMAGE ANALYSIS: {image_analysis}\n\n"
+        f"Previous prompt context: {prompt}\n"
+        f"User choice history: {history}\n\n"
+    )
+
+def text_variants_request(prompt, history, image_analysis):
+    """openai.chat.completions.create arguments and debug info for the two-variant proposal"""
+    system_prompt = (
+        VARIANT_SYSTEM_INTRO +
+        "Based on what you can see in the image analysis, propose two new variants that make VERY SMALL, SUBTLE changes only. " +
+        VARIANT_SYSTEM_GUIDELINES +
+        "Separate the two variants with the exact text '---VARIANT---' on its own line."
+    )
+
+    user_message = (
+        variant_context(prompt, history, image_analysis) +
+        "Based on the visual analysis above, propose two new MINIMAL mutation ideas. "
+        "Focus on very small changes that maintain most of what you see in the current image. " +
+        VARIANT_PORTRAIT_HINT +
+        "Separate variants with ---VARIANT---"
+    )
+
+    request_kwargs = dict(
+        model="gpt-4-turbo",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message}
+        ],
+        n=1,
+        max_tokens=400
+    )
+    debug_info = {
+        'system_prompt': system_prompt,
+        'user_message': user_message,
+        'image_analysis': image_analysis
+    }
+    return request_kwargs, debug_info
+
+VARIANT_DELIMITER = '---VARIANT---'
+
+def parse_text_variants(content):
+    """Split the curator's answer into (at most) two variant texts"""
+    content = content.strip()
+
+    # Simple, reliable splitting using our custom delimiter
+    variants = content.split(VARIANT_DELIMITER)
+    variants = [v.strip() for v in variants if v.strip()]
+
+    # Ensure we have exactly 2 variants
+    if len(variants) < 2:
+        # Fallback: split on double newlines (paragraph breaks)
+        variants = content.split('\n\n')
+        variants = [v.strip() for v in variants if v.strip()]
+
+    return variants[:2]
+
+def propose_text_variants(prompt, history, image_url):
+    """Analyze the current image and ask the curator model for two variant texts"""
+    # Analyze the current image with GPT-4 Vision
+    log.debug("Analyzing image: %s", image_url)
+    image_analysis = analyze_image_with_vision(image_url)
+    log.debug("Image analysis result: %s", image_analysis)
+
+    request_kwargs, debug_info = text_variants_request(prompt, compact_history(history), image_analysis)
+    chat_response = call_openai('generate_text_variants', openai.chat.completions.create, **request_kwargs)
+
+    return {
+        'variants': parse_text_variants(chat_response.choices[0].message.content),
+        'debug_info': debug_info
+    }
+
+# One structured completion for a round's text: N variants, each with its past-tense
+# summary, and optionally the curator's reflection. Replaces the delimiter-parsed variant
+# call plus one summary call per variant (and the separate reflection call).
+VARIANT_BATCH_MODEL = "gpt-4o"  # json_schema response formats need a model with structured outputs
+VARIANT_BATCH_DEFAULT_COUNT = 2
+VARIANT_BATCH_MAX_COUNT = 4
+
+def variant_batch_schema(count, with_reflection):
+    properties = {
+        'variants': {
+            'type': 'array',
+            'minItems': count,
+            'maxItems': count,
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'text': {'type': 'string', 'description': 'One paragraph describing the subtle modification'},
+                    'summary': {'type': 'string', 'description': 'The same change in past tense, at most 200 characters'}
+                },
+                'required': ['text', 'summary'],
+                'additionalProperties': False
+            }
+        }
+    }
+    if with_reflection:
+        properties['reflection'] = {'type': 'string', 'description': "The curator's reflection, at most 200 characters"}
+    return {
+        'type': 'object',
+        'properties': properties,
+        'required': list(properties),
+        'additionalProperties': False
+    }
+
+def variant_batch_request(prompt, history, image_analysis, count=VARIANT_BATCH_DEFAULT_COUNT, with_reflection=False):
+    """openai.chat.completions.create arguments and debug info for a structured variant batch"""
+    system_prompt = (
+        VARIANT_SYSTEM_INTRO +
+        f"Based on what you can see in the image analysis, propose {count} new variants that make VERY SMALL, SUBTLE changes only. " +
+        VARIANT_SYSTEM_GUIDELINES +
+        "For each variant also write a very concise, engaging summary of at most 200 characters, in past tense "
+        "as if the change had already been applied (\"enhance\" → \"enhanced\", \"add\" → \"added\")."
+    )
+    if with_reflection:
+        system_prompt += (
+            " Then, as a critical curator in an art gallery, reflect on your reasoning behind these proposals in at most 200 characters, "
+            "specifically on the user's preferences and their whole choice history, without saying who you are."
+        )
+
+    user_message = (
+        variant_context(prompt, history, image_analysis) +
+        f"Based on the visual analysis above, propose {count} new MINIMAL mutation ideas. "
+        "Focus on very small changes that maintain most of what you see in the current image. " +
+        VARIANT_PORTRAIT_HINT
+    )
+
+    request_kwargs = dict(
+        model=VARIANT_BATCH_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message}
+        ],
+        response_format={
+            'type': 'json_schema',
+            'json_schema': {'name': 'variant_batch', 'strict': True, 'schema': variant_batch_schema(count, with_reflection)}
+        },
+        max_tokens=250 * count + (150 if with_reflection else 0)
+    )
+    debug_info = {
+        'system_prompt': system_prompt,
+        'user_message': user_message,
+        'image_analysis': image_analysis,
+        'batched': True
+    }
+    return request_kwargs, debug_info
+
+def batched_reflection(text):
+    """A reflection written along with the variants, shaped like write_reflection's result"""
+    return {'reflection': text.strip(), 'debug_info': {'source': 'variant_batch'}}
+
+def parse_variant_batch(content, count, with_reflection):
+    """(variants, summaries, reflection text or None) from a variant_batch answer; ValueError if malformed"""
+    try:
+        data = json.loads(content)
+        items = data['variants'][:count]
+        variants = [item['text'].strip() for item in items]
+        summaries = [item['summary'].strip() for item in items]
+        reflection = data['reflection'].strip() if with_reflection else None
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Malformed variant batch: {e!r}")
+    if len(variants) < count or not all(variants) or not all(summaries):
+        raise ValueError(f"Variant batch has {len(variants)} usable variants, expected {count}")
+    return variants, summaries, reflection
+
+def variant_batch_result(variants, summaries, reflection, debug_info):
+    return {
+        'variants': variants,
+        'summaries': summaries,
+        'reflection': reflection,
+        'debug_info': debug_info
+    }
+
+JSON_STRING_DECODER = json.JSONDecoder(strict=False)
+
+class VariantBatchStreamSplitter:
+    """Follows a streamed variant_batch answer (see variant_batch_schema) as it arrives.
+    feed() returns ('delta', {'index', 'text'}) events while variants[i].text is written,
+    ('variant', {'index', 'text'}) once it is complete, then ('summary', {'index', 'text'})
+    and ('reflection', {'text'}) as those strings complete. Only the JSON structure the
+    schema allows is tracked; an escape split across chunks waits for the next one."""
+
+    def __init__(self, count=VARIANT_BATCH_DEFAULT_COUNT, with_reflection=False):
+        self.count = count
+        self.with_reflection = with_reflection
+        self.content = []  # everything received, checked as a whole by close()
+        self.containers = []  # ['{', current key] / ['[', current index], outermost first
+        self.expect_key = False
+        self.string = None  # raw characters of the string being read
+        self.string_is_key = False
+        self.backslash = False
+        self.target = None  # ('text' | 'summary', index) or ('reflection', None) for the string being read
+        self.sent = 0  # decoded characters of the current text already sent as deltas
+        self.variants = []
+        self.summaries = []
+        self.reflection = None
+
+    def _target(self):
+        keys = [key for _, key in self.containers]
+        if (len(keys) == 3 and keys[0] == 'variants' and self.containers[1][0] == '['
+                and keys[2] in ('text', 'summary') and keys[1] < self.count):
+            return keys[2], keys[1]
+        if keys == ['reflection'] and self.with_reflection:
+            return 'reflection', None
+        return None
+
+    @staticmethod
+    def _decode(raw, final=False):
+        # The longest prefix that decodes: a cut inside an escape fails, so back off up to
+        # the length of a surrogate pair (\uXXXX\uXXXX), keeping a lone high surrogate back
+        for cut in range(len(raw), max(len(raw) - 12, 0) - 1, -1):
+            try:
+                text = JSON_STRING_DECODER.decode(f'"{raw[:cut]}"')
+            except ValueError:
+                continue
+            if not final and text and '\ud800' <= text[-1] <= '\udbff':
+                text = text[:-1]
+            return text
+        return ''
+
+    def _send_text(self, events, final=False):
+        kind, index = self.target
+        text = self._decode(''.join(self.string), final)
+        if len(text) > self.sent:
+            events.append(('delta', {'index': index, 'text': text[self.sent:]}))
+            self.sent = len(text)
+        return text
+
+    def _end_string(self, events):
+        if self.string_is_key:
+            if self.containers:
+                self.containers[-1][1] = self._decode(''.join(self.string), True)
+            self.expect_key = False
+        elif self.target is not None:
+            kind, index = self.target
+            if kind == 'text':
+                text = self._send_text(events, True).strip()
+                if index == len(self.variants):
+                    self.variants.append(text)
+                    events.append(('variant', {'index': index, 'text': text}))
+            elif kind == 'summary':
+                text = self._decode(''.join(self.string), True).strip()
+                if index == len(self.summaries):
+                    self.summaries.append(text)
+                    events.append(('summary', {'index': index, 'text': text}))
+            else:
+                self.reflection = self._decode(''.join(self.string), True).strip()
+                events.append(('reflection', {'text': self.reflection}))
+        self.string = None
+        self.target = None
+
+    def feed(self, text):
+        events = []
+        self.content.append(text)
+        for char in text:
+            if self.string is not None:
+                if self.backslash:
+                    self.backslash = False
+                elif char == '\\':
+                    self.backslash = True
+                elif char == '"':
+                    self._end_string(events)
+                    continue
+                self.string.append(char)
+            elif char == '"':
+                self.string, self.backslash, self.sent = [], False, 0
+                self.string_is_key = self.expect_key
+                self.target = None if self.string_is_key else self._target()
+            elif char == '{':
+                self.containers.append(['{', None])
+                self.expect_key = True
+            elif char == '[':
+                self.containers.append(['[', 0])
+                self.expect_key = False
+            elif char in '}]':
+                if self.containers:
+                    self.containers.pop()
+                self.expect_key = False
+            elif char == ',' and self.containers:
+                if self.containers[-1][0] == '[':
+                    self.containers[-1][1] += 1
+                else:
+                    self.expect_key = True
+        if self.target is not None and self.target[0] == 'text':
+            self._send_text(events)
+        return events
+
+    def close(self):
+        """Events for the end of the answer. The whole answer is checked with
+        parse_variant_batch (ValueError if malformed) and anything the incremental pass
+        read differently is re-sent."""
+        variants, summaries, reflection = parse_variant_batch(''.join(self.content), self.count, self.with_reflection)
+        events = []
+        for index, text in enumerate(variants):
+            if self.variants[index:index + 1] != [text]:
+                events.append(('variant', {'index': index, 'text': text}))
+        for index, text in enumerate(summaries):
+            if self.summaries[index:index + 1] != [text]:
+                events.append(('summary', {'index': index, 'text': text}))
+        if reflection is not None and reflection != self.reflection:
+            events.append(('reflection', {'text': reflection}))
+        self.variants, self.summaries, self.reflection = variants, summaries, reflection
+        return events
+
+def unbatched_variants(prompt, history, image_url, with_reflection):
+    """The old separate calls, for when the structured completion fails"""
+    variants_info = propose_text_variants(prompt, history, image_url)
+    summaries = [summarize_variant_or_fallback(text, '')['original_summary'] for text in variants_info['variants']]
+    reflection = write_reflection(prompt, history) if with_reflection else None
+    return variant_batch_result(variants_info['variants'], summaries, reflection, variants_info['debug_info'])
+
+def propose_variant_batch(prompt, history, image_url, count=VARIANT_BATCH_DEFAULT_COUNT, with_reflection=False):
+    """Analyze the current image and get `count` variants with their summaries (and the
+    reflection) from one completion. Falls back to the separate calls if that fails;
+    they only ever produce two variants."""
+    image_analysis = analyze_image_with_vision(image_url)
+    request_kwargs, debug_info = variant_batch_request(prompt, compact_history(history), image_analysis, count, with_reflection)
+    try:
+        response = call_openai('generate_variant_batch', openai.chat.completions.create, **request_kwargs)
+        variants, summaries, reflection = parse_variant_batch(response.choices[0].message.content, count, with_reflection)
+    except Exception as e:
+        log.warning("Batched variant generation failed, falling back to separate calls: %s", e)
+        return unbatched_variants(prompt, history, image_url, with_reflection)
+    return variant_batch_result(variants, summaries, batched_reflection(reflection) if with_reflection else None, debug_info)
+
+def variant_batch_args(data):
+    """(count, with_reflection) from a /generate-variants body"""
+    count = data.get('count', VARIANT_BATCH_DEFAULT_COUNT)
+    if not isinstance(count, int) or isinstance(count, bool) or not 1 <= count <= VARIANT_BATCH_MAX_COUNT:
+        raise ValueError(f"count must be an integer from 1 to {VARIANT_BATCH_MAX_COUNT}")
+    return count, bool(data.get('reflection', False))
+
+def image_request(prompt, image_analysis, random_instruction):
+    """openai.images.generate arguments and the final DALL-E prompt for one variant"""
+    random_instruction_text = f"\n\nAdditionally, {random_instruction}." if random_instruction else ""
+    log.debug("Random instruction text: %s", random_instruction_text)
+
+    # Create a more informed prompt based on the visual analysis
+    final_prompt = (
+        f"Based on this image analysis: {image_analysis}\n\n"
+        f"Create a new image that implements this subtle change: {prompt}{random_instruction_text}\n\n"
+        "IMPORTANT: Create a VERTICAL composition that fills the entire tall frame (portrait orientation). "
+        "Extend the composition vertically, don't just center a square composition in the middle. "
+        "Use the full height of the canvas with visual elements distributed throughout the vertical space. "
+        "Maintain the same visual style, composition, colors, and overall appearance as described in the analysis, "
+        "but adapt it to work beautifully in a tall vertical format. "
+        "Make only the minimal change requested while utilizing the full vertical space."
+    )
+
+    request_kwargs = dict(
+        model="dall-e-3",
+        prompt=final_prompt,
+        n=1,
+        size="1024x1792"  # Formato verticale per monitor 2160x3840
+    )
+    return request_kwargs, final_prompt
+
+def image_result(generated_image_url, final_prompt, image_analysis, prompt, random_instruction):
+    """Response body shared by /generate-image and /generate-cycle"""
+    return {
+        'modifiedImageUrl': generated_image_url,
+        'debug_info': {
+            'final_prompt': final_prompt,
+            'image_analysis': image_analysis,
+            'original_prompt': prompt,
+            'random_instruction': random_instruction
+        }
+    }
+
+def render_variant_image(prompt, image_url, random_instruction, public_base_url=None, progress=None):
+    """Generate the DALL-E image for one variant text plus its random instruction.
+    With public_base_url, the image is mirrored into the local store and served from there.
+    A job's progress callback is checked before the DALL-E call and before mirroring, so a
+    cancelled job neither starts the call nor keeps its image."""
+    progress = progress or (lambda stage: None)
+    # Get image analysis for context
+    image_analysis = analyze_image_with_vision(image_url)
+
+    request_kwargs, final_prompt = image_request(prompt, image_analysis, random_instruction)
+    progress(None)
+    response = call_openai('generate_image', openai.images.generate, **request_kwargs)
+
+    result = image_result(response.data[0].url, final_prompt, image_analysis, prompt, random_instruction)
+    progress(None)
+    if public_base_url:
+        mirror_generated_image(result, public_base_url)
+    return result
+
+REFLECTION_SYSTEM_MESSAGE = "You are a critical curator in an art gallery."
+
+def reflection_request(prompt, history):
+    """openai.chat.completions.create arguments and the user prompt for the curator reflection"""
+    reflection_prompt = (
+        "Reflect critically on the process and reasoning behind proposing two variants for the following image mutation prompt, "
+        "considering the user's choice history and inferred preferences. "
+        "Write as if you are the curator, explaining your own reasoning and approach in detail, "
+        "not in general but specifically on the user preferences and remembering all the choice history made by the user. "
+        "But do not specify who you are, just write the reflection.\n"
+        "The reflection must be maximum 200 characters.\n"
+        f"Current prompt: {prompt}\nUser choice history: {history}"
+    )
+    request_kwargs = dict(
+        model="gpt-4-turbo",
+        messages=[
+            {"role": "system", "content": REFLECTION_SYSTEM_MESSAGE},
+            {"role": "user", "content": reflection_prompt}
+        ],
+        max_tokens=300
+    )
+    return request_kwargs, reflection_prompt
+
+def reflection_result(reflection, reflection_prompt):
+    return {
+        'reflection': reflection.strip(),
+        'debug_info': {
+            'reflection_prompt': reflection_prompt,
+            'system_message': REFLECTION_SYSTEM_MESSAGE
+        }
+    }
+
+def write_reflection(prompt, history):
+    """Ask the curator model to reflect on the current round"""
+    request_kwargs, reflection_prompt = reflection_request(prompt, compact_history(history))
+    reflection_response = call_openai('generate_reflection', openai.chat.completions.create, **request_kwargs)
+    return reflection_result(reflection_response.choices[0].message.content, reflection_prompt)
+
+# Speculative next-round variants: while visitors vote, the next round's text variants
+# (a batch with summaries and reflection) are generated for both possible winners and
+# picked up by the next request.
+PIPELINE_WORKERS = 8
+SPECULATIVE_MAX_ENTRIES = 8
+
+pipeline_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix='pipeline')
+speculative_variants = OrderedDict()
+speculative_lock = Lock()
+
+def speculative_key(prompt, history, image_url):
+    payload = json.dumps([prompt, history, image_url], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def speculate_text_variants(prompt, history, image_url):
+    """Start generating the variants a future request with these arguments will ask for"""
+    if image_url in variant_pool:
+        return
+    key = speculative_key(prompt, history, image_url)
+    with speculative_lock:
+        if key in speculative_variants:
+            return
+        speculative_variants[key] = pipeline_executor.submit(with_priority, 'speculative', propose_variant_batch,
+                                                             prompt, history, image_url, with_reflection=True)
+        while len(speculative_variants) > SPECULATIVE_MAX_ENTRIES:
+            speculative_variants.popitem(last=False)
+
+def pop_speculative_future(prompt, history, image_url):
+    """Claim the pre-generation future for these arguments, or None"""
+    with speculative_lock:
+        return speculative_variants.pop(speculative_key(prompt, history, image_url), None)
+
+def take_speculative_variants(prompt, history, image_url):
+    """Return pre-generated variants for these arguments (waiting if still running), or None"""
+    future = pop_speculative_future(prompt, history, image_url)
+    if future is None:
+        return None
+    try:
+        result = future.result()
+        log.info("Using speculatively pre-generated variants")
+        return result
     except Exception as e:
-        print(f"Error encoding image: {e}")
+        log.warning("Speculative variant generation failed, generating again: %s", e)
         return None
 
-def analyze_image_with_vision(image_path_or_url):
-    """Analyze image using GPT-4o Vision and return detailed description"""
-    print(f"DEBUG: Trying to analyze image: {image_path_or_url}")
-    
-    base64_image = encode_image_to_base64(image_path_or_url)
-    if not base64_image:
-        print("DEBUG: Failed to encode image to base64")
-        return "Unable to analyze image - encoding failed"
-    
-    print("DEBUG: Image successfully encoded, calling Vision API...")
-    
+generation_jobs = (SqliteJobQueue(state_db, name='generation-job') if state_db
+                   else JobQueue(name='generation-job'))
+
+def cancel_session_jobs(session_id):
+    """A new round makes the previous round's pending jobs (the losing variant's) moot"""
+    if session_id is not None:
+        cancelled = generation_jobs.cancel_group(session_id)
+        if cancelled:
+            log.info("Cancelled %d pending job(s) of session %s", cancelled, session_id)
+
+def variants_with_pool(image_url, count, generate):
+    """A round's variants from the precomputed pool on a hit, else generate(); falls back
+    to the pool when generate() fails"""
+    entry = variant_pool.get(image_url)
+    if entry is not None and len(entry['variants']) == count:
+        return pool_variants(entry)
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",  # Updated to use the current model with vision capabilities
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text", 
-                            "text": "Analyze this image in detail. Describe the shapes, colors, composition, style, lighting, and any visual elements present. Be very specific and descriptive as this will be used to generate similar artwork variations."
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=400
-        )
-        result = response.choices[0].message.content
-        print(f"DEBUG: Vision API response: {result[:100]}...")
-        return result
+        return generate()
     except Exception as e:
-        print(f"Error analyzing image with Vision: {e}")
-        return f"Error analyzing image: {str(e)}"
+        entry = variant_pool.fallback(image_url)
+        if entry is None:
+            raise
+        log.warning("Variant generation failed (%s), serving the precomputed round for %s", e, entry['image'])
+        return pool_variants(entry, fallback=True)
 
 @app.route('/generate-text-variants', methods=['POST', 'OPTIONS'])
 def generate_text_variants():
     if request.method == 'OPTIONS':
         return '', 200
 
-    data = request.json
-    prompt = data.get('prompt', '')
-    history = data.get('history', [])
-    image_url = data.get('imageUrl', 'CircleStart.png')
+    try:
+        session_id, prompt, history, image_url = session_inputs(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    cancel_session_jobs(session_id)
 
     try:
-        # Analyze the current image with GPT-4 Vision
-        print(f"Analyzing image: {image_url}")
-        image_analysis = analyze_image_with_vision(image_url)
-        print(f"Image analysis result: {image_analysis}")
-
-        system_prompt = (
-            "You are an art curator proposing very subtle, minimal changes to artworks. "
-            "You will receive a detailed visual analysis of the current image and the user's choice history. "
-            "Based on what you can see in the image analysis, propose two new variants that make VERY SMALL, SUBTLE changes only. "
-            "Focus on: slight color shifts, minor shape adjustments, small texture changes, small style changes, or gentle lighting modifications. "
-            "AVOID: dramatic transformations. "
-            "Keep the core visual elements and composition similar to what's described in the analysis. "
-            "Each variant should be a single paragraph describing the subtle modification. "
-            "Base your proposals on the user's preferences as inferred from the history. "
-            "Separate the two variants with the exact text '---VARIANT---' on its own line."
-        )
-        
-        user_message = (
-            f"CURRENT IMAGE ANALYSIS: {image_analysis}\n\n"
-            f"Previous prompt context: {prompt}\n"
-            f"User choice history: {history}\n\n"
-            "Based on the visual analysis above, propose two new MINIMAL mutation ideas. "
-            "Focus on very small changes that maintain most of what you see in the current image. "
-
-            "IMPORTANT: Remember that the final image will be in VERTICAL/PORTRAIT format, so suggest changes that work well in tall compositions. "
-            "Consider vertical elements, layers, or extensions that utilize the full height of the canvas. "
-            "Separate variants with ---VARIANT---"
-        )
+        result = variants_with_pool(image_url, 2, lambda: (take_speculative_variants(prompt, history, image_url)
+                                                           or propose_text_variants(prompt, history, image_url)))
+        record_session_round(session_id, new_round=True, prompt=prompt, variants=result['variants'])
+        return jsonify(result)
+    except Exception as e:
+        log.error("Backend error (generate-text-variants): %s", e)
+        return jsonify({'error': str(e)}), 500
 
-        chat_response = openai.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            n=1,
-            max_tokens=400
-        )
-        content = chat_response.choices[0].message.content.strip()
-        
-        # Simple, reliable splitting using our custom delimiter
-        variants = content.split('---VARIANT---')
-        variants = [v.strip() for v in variants if v.strip()]
-        
-        # Ensure we have exactly 2 variants
-        if len(variants) < 2:
-            # Fallback: split on double newlines (paragraph breaks)
-            variants = content.split('\n\n')
-            variants = [v.strip() for v in variants if v.strip()]
-        
-        variants = variants[:2]
+@app.route('/generate-variants', methods=['POST', 'OPTIONS'])
+def generate_variants():
+    """count variants (default 2), each with its past-tense summary, and with
+    reflection=true the curator's reflection, from one structured completion"""
+    if request.method == 'OPTIONS':
+        return '', 200
 
-        return jsonify({
-            'variants': variants,
-            'debug_info': {
-                'system_prompt': system_prompt,
-                'user_message': user_message,
-                'image_analysis': image_analysis
-            }
-        })
+    data = request.json
+    try:
+        session_id, prompt, history, image_url = session_inputs(data)
+        count, with_reflection = variant_batch_args(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    cancel_session_jobs(session_id)
+
+    def generate():
+        result = take_speculative_variants(prompt, history, image_url) if count == VARIANT_BATCH_DEFAULT_COUNT else None
+        return result or propose_variant_batch(prompt, history, image_url, count, with_reflection)
+
+    try:
+        result = variants_with_pool(image_url, count, generate)
+        record_session_round(session_id, new_round=True, prompt=prompt, variants=result['variants'])
+        return jsonify(result)
     except Exception as e:
-        print("Backend error (generate-text-variants):", e)
+        log.error("Backend error (generate-variants): %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/generate-image', methods=['POST'])
@@ -284,49 +2517,13 @@ def generate_image():
     image_url = data.get('imageUrl', 'CircleStart.png')
 
     try:
-        # Get image analysis for context
-        image_analysis = analyze_image_with_vision(image_url)
-        
         # Get a random instruction to add creative variation
         random_instruction = get_random_instruction()
-        print(f"🔍 DEBUG: Random instruction selected: {random_instruction}")
-        random_instruction_text = f"\n\nAdditionally, {random_instruction}." if random_instruction else ""
-        print(f"🔍 DEBUG: Random instruction text: {random_instruction_text}")
-        
-        # Create a more informed prompt based on the visual analysis
-        final_prompt = (
-            f"Based on this image analysis: {image_analysis}\n\n"
-            f"Create a new image that implements this subtle change: {prompt}{random_instruction_text}\n\n"
-            "IMPORTANT: Create a VERTICAL composition that fills the entire tall frame (portrait orientation). "
-            "Extend the composition vertically, don't just center a square composition in the middle. "
-            "Use the full height of the canvas with visual elements distributed throughout the vertical space. "
-            "Maintain the same visual style, composition, colors, and overall appearance as described in the analysis, "
-            "but adapt it to work beautifully in a tall vertical format. "
-            "Make only the minimal change requested while utilizing the full vertical space."
-        )
-        
-        response = openai.images.generate(
-            model="dall-e-3",
-            prompt=final_prompt,
-            n=1,
-            size="1024x1792"  # Formato verticale per monitor 2160x3840
-        )
-        
-        generated_image_url = response.data[0].url
+        log.debug("Random instruction selected: %s", random_instruction)
 
-        print(f"🔍 DEBUG: About to return - random_instruction value: {random_instruction}")
-        
-        return jsonify({
-            'modifiedImageUrl': generated_image_url,
-            'debug_info': {
-                'final_prompt': final_prompt,
-                'image_analysis': image_analysis,
-                'original_prompt': prompt,
-                'random_instruction': random_instruction
-            }
-        })
+        return jsonify(render_variant_image(prompt, image_url, random_instruction, request.host_url))
     except Exception as e:
-        print("Backend error (generate-image):", e)
+        log.error("Backend error (generate-image): %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/generate-reflection', methods=['POST', 'OPTIONS'])
@@ -334,99 +2531,1028 @@ def generate_reflection():
     if request.method == 'OPTIONS':
         return '', 200
 
+    try:
+        session_id, prompt, history, _ = session_inputs(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        reflection = write_reflection(prompt, history)
+        record_session_round(session_id, reflection=reflection['reflection'])
+        return jsonify(reflection)
+    except Exception as e:
+        log.error("Backend error (generate-reflection): %s", e)
+        return jsonify({'error': str(e)}), 500
+
+def completed_future(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+# Token streaming: /stream twins of the text endpoints forward the completion as
+# Server-Sent Events while it is being written. The variants stream is the structured
+# /generate-variants completion, followed string by string: variant 1 is shown (and
+# recorded in the session for the displays), and its image started when asked for,
+# before variant 2 is finished; summaries and the reflection come in the same answer.
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def sse_response(events, endpoint):
+    """Stream (event, data) pairs as Server-Sent Events; a failure becomes an error event"""
+    started = time.perf_counter()
+
+    def stream():
+        first_text = True
+        try:
+            for event, data in events:
+                if event == 'delta' and first_text:
+                    first_text = False
+                    metrics.observe('stream_first_text_seconds', time.perf_counter() - started, endpoint=endpoint)
+                yield sse_event(event, data)
+        except Exception as e:
+            log.error("Backend error (%s stream): %s", endpoint, e)
+            yield sse_event('error', {'error': str(e)})
+        finally:
+            # Runs the events' own cleanup as soon as the client goes away
+            events.close()
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream', headers=STREAM_HEADERS)
+
+def stream_options(data):
+    """(summaries, reflection, images) flags of a /generate-text-variants/stream body"""
+    return bool(data.get('summaries')), bool(data.get('reflection')), bool(data.get('images'))
+
+def ready_text_variants(prompt, history, image_url):
+    """(variants result, source) when no upstream call is needed: from the precomputed
+    pool or a finished speculation; (None, 'upstream') otherwise"""
+    entry = variant_pool.get(image_url)
+    if entry is not None and len(entry['variants']) == 2:
+        return pool_variants(entry), 'pool'
+    result = take_speculative_variants(prompt, history, image_url)
+    return (result, 'speculation') if result else (None, 'upstream')
+
+def ready_deltas(result, with_reflection):
+    """Precomputed variants as a one-chunk variant_batch answer, so they take the same path as tokens"""
+    batch = {'variants': [{'text': text, 'summary': summary} for text, summary in zip(result['variants'], result['summaries'])]}
+    if with_reflection:
+        batch['reflection'] = result['reflection']['reflection']
+    return [json.dumps(batch, ensure_ascii=False)]
+
+class VariantStreamRound:
+    """Bookkeeping shared by the Flask and async variant streams: turns the splitter's
+    events into the stream's, records variants in the session as they complete and
+    tracks which still need their image started"""
+
+    def __init__(self, session_id, prompt, ready=None, with_summaries=False, with_reflection=False):
+        self.session_id = session_id
+        self.prompt = prompt
+        self.ready_reflection = (ready or {}).get('reflection')
+        self.with_summaries = with_summaries
+        # Precomputed variants without a reflection get theirs from write_reflection
+        self.batch_reflection = with_reflection and (ready is None or self.ready_reflection is not None)
+        self.splitter = VariantBatchStreamSplitter(with_reflection=self.batch_reflection)
+        self.started = {}  # variant index -> the text its image was started for
+        self.summaries = {}  # variant index -> summary_result
+        self.images = {}  # variant index -> image result
+        self.reflection = None
+
+    def _events(self, events):
+        out = []
+        for event, data in events:
+            if event == 'summary':
+                self.summaries[data['index']] = summary_result(data['text'], '')
+                if self.with_summaries:
+                    out.append(('summary', dict(self.summaries[data['index']], index=data['index'])))
+            elif event == 'reflection':
+                self.reflection = self.ready_reflection or batched_reflection(data['text'])
+                out.append(('reflection', self.reflection))
+            else:
+                out.append((event, data))
+        return out
+
+    def feed(self, delta):
+        return self._events(self.splitter.feed(delta))
+
+    def close(self):
+        return self._events(self.splitter.close())
+
+    def to_start(self, events):
+        """(index, text) of variants these events completed, or re-sent with new text"""
+        started = []
+        for event, data in events:
+            if event == 'variant' and self.started.get(data['index']) != data['text']:
+                started.append((data['index'], data['text']))
+                self.started[data['index']] = data['text']
+        if started:
+            record_session_round(self.session_id, new_round=len(self.started) == len(started), prompt=self.prompt,
+                                 variants=list(self.splitter.variants))
+        return started
+
+    def followup_event(self, kind, index, text, result, error):
+        """The event for finished follow-up work, or None when the variant's text changed since"""
+        if kind == 'reflection':
+            self.reflection = result
+            return 'reflection', {'error': str(error)} if error else result
+        if self.started.get(index) != text:
+            return None
+        if error:
+            return kind, {'index': index, 'error': str(error)}
+        self.images[index] = result
+        return kind, dict(result, index=index)
+
+    def done(self, source, debug_info):
+        variants = self.splitter.variants
+        return {
+            'source': source,
+            'variants': variants,
+            'summaries': [self.summaries[i]['original_summary'] for i in range(len(variants))],
+            'images': [self.images.get(i) for i in range(len(variants))] if self.images else None,
+            'reflection': self.reflection,
+            'debug_info': debug_info
+        }
+
+def text_variant_events(session_id, prompt, history, image_url, public_base_url,
+                        with_summaries=False, with_reflection=False, with_images=False):
+    """(event, data) pairs for /generate-text-variants/stream"""
+    ready, source = ready_text_variants(prompt, history, image_url)
+    round_ = VariantStreamRound(session_id, prompt, ready, with_summaries, with_reflection)
+    followups = {}  # future -> (kind, index, variant text)
+    if with_reflection and not round_.batch_reflection:
+        followups[pipeline_executor.submit(write_reflection, prompt, history)] = ('reflection', None, None)
+    if ready is not None:
+        debug_info = ready['debug_info']
+        deltas = ready_deltas(ready, round_.batch_reflection)
+    else:
+        # The same structured completion as /generate-variants, streamed
+        image_analysis = analyze_image_with_vision(image_url)
+        request_kwargs, debug_info = variant_batch_request(prompt, compact_history(history), image_analysis,
+                                                           with_reflection=with_reflection)
+        deltas = upstream.stream('generate_variant_batch', openai.chat.completions.create, **request_kwargs)
+    yield 'start', {'source': source, 'debug_info': debug_info}
+    closed = Event()
+
+    def check_open(stage):
+        if closed.is_set():
+            raise JobCancelled()
+
+    def start_images(events):
+        for index, text in round_.to_start(events):
+            if with_images:
+                future = pipeline_executor.submit(render_variant_image, text, image_url, get_random_instruction(),
+                                                  public_base_url, check_open)
+                followups[future] = ('image', index, text)
+
+    try:
+        for delta in deltas:
+            events = round_.feed(delta)
+            yield from events
+            start_images(events)
+        events = round_.close()
+        yield from events
+        start_images(events)
+
+        for future in as_completed(list(followups)):
+            kind, index, text = followups[future]
+            error = future.exception()
+            event = round_.followup_event(kind, index, text, None if error else future.result(), error)
+            if event:
+                yield event
+    finally:
+        # A client that went away doesn't need the images it had started: queued ones give
+        # their executor slot back, running ones stop before their next upstream call or mirror
+        closed.set()
+        for future in followups:
+            future.cancel()
+    if round_.reflection:
+        record_session_round(session_id, reflection=round_.reflection['reflection'])
+    yield 'done', round_.done(source, debug_info)
+
+def summary_events(variant_text, instruction):
+    """(event, data) pairs for /generate_summary/stream"""
+    parts = []
+    for delta in upstream.stream('generate_summary', openai.chat.completions.create, **summary_request(variant_text)):
+        parts.append(delta)
+        yield 'delta', {'text': delta}
+    yield 'done', summary_result(''.join(parts), instruction)
+
+def reflection_events(session_id, prompt, history):
+    """(event, data) pairs for /generate-reflection/stream"""
+    request_kwargs, reflection_prompt = reflection_request(prompt, compact_history(history))
+    parts = []
+    for delta in upstream.stream('generate_reflection', openai.chat.completions.create, **request_kwargs):
+        parts.append(delta)
+        yield 'delta', {'text': delta}
+    reflection = reflection_result(''.join(parts), reflection_prompt)
+    record_session_round(session_id, reflection=reflection['reflection'])
+    yield 'done', reflection
+
+@app.route('/generate-text-variants/stream', methods=['POST', 'OPTIONS'])
+def stream_text_variants():
+    """Like /generate-variants, as Server-Sent Events: start, then delta {index, text}
+    while a variant is written and variant {index, text} once it is complete; with
+    "summaries" or "reflection" in the body, summary/reflection events follow as the same
+    completion writes them, and with "images" an image event per variant (each started as
+    soon as its variant is complete); done carries everything. A failure ends the stream
+    with an error event."""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    data = request.get_json(silent=True) or {}
+    try:
+        session_id, prompt, history, image_url = session_inputs(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    cancel_session_jobs(session_id)
+    return sse_response(text_variant_events(session_id, prompt, history, image_url, request.host_url,
+                                            *stream_options(data)), 'generate-text-variants')
+
+@app.route('/generate_summary/stream', methods=['POST'])
+def stream_summary():
+    """Like /generate_summary, as Server-Sent Events: delta {text} per token, then done"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('variant_text'):
+        return jsonify({'error': 'variant_text is required'}), 400
+    return sse_response(summary_events(data['variant_text'], data.get('instruction', '')), 'generate_summary')
+
+@app.route('/generate-reflection/stream', methods=['POST', 'OPTIONS'])
+def stream_reflection():
+    """Like /generate-reflection, as Server-Sent Events: delta {text} per token, then done"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        session_id, prompt, history, _ = session_inputs(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return sse_response(reflection_events(session_id, prompt, history), 'generate-reflection')
+
+def cycle_text_inputs(variants, summaries, reflection):
+    """Pre-made summaries (one string per variant) and reflection text passed back from
+    /generate-variants, or None where they're missing or don't fit"""
+    if not (variants and isinstance(summaries, list) and len(summaries) == len(variants)
+            and all(isinstance(summary, str) and summary.strip() for summary in summaries)):
+        summaries = None
+    reflection = batched_reflection(reflection) if isinstance(reflection, str) and reflection.strip() else None
+    return summaries, reflection
+
+def cycle_image_inputs(variants, images):
+    """Images the variant stream already rendered for these variants (one entry per
+    variant, None where it has to be rendered here), or None. Only our own stored images,
+    rendered for that very variant text, are taken."""
+    if not (variants and isinstance(images, list) and len(images) == len(variants)):
+        return None
+    checked = []
+    for text, image in zip(variants, images):
+        info = image.get('debug_info') if isinstance(image, dict) else None
+        url = image.get('modifiedImageUrl') if isinstance(image, dict) else None
+        if (isinstance(info, dict) and isinstance(url, str) and image_store.path_for_url(url)
+                and info.get('original_prompt') == text
+                and all(isinstance(info.get(key), str) for key in ('final_prompt', 'image_analysis'))
+                and isinstance(info.get('random_instruction'), (str, type(None)))):
+            checked.append(image_result(url, info['final_prompt'], info['image_analysis'], text, info['random_instruction']))
+        else:
+            checked.append(None)
+    return checked if any(checked) else None
+
+# A round is written once, as generators that yield their I/O steps ('variants',
+# 'instruction', 'start_image', 'wait', ...); a driver performs each step with its mode's
+# primitives and sends the result back (or throws the error in). drive_cycle runs them
+# on the pipeline threads, app_async on the event loop.
+def live_cycle_steps(prompt, history, image_url, variants, public_base_url, progress, summaries=None, reflection=None,
+                     images=None):
+    """Generate a round upstream: variants (unless given), then the images, summaries and
+    reflection concurrently. Missing variants come in one batch with their summaries and
+    the reflection; summaries, reflection text and images from the variant stream (or
+    /generate-variants) can be passed back in to skip those calls."""
+    summaries, reflection = cycle_text_inputs(variants, summaries, reflection)
+    images = cycle_image_inputs(variants, images)
+
+    variants_info = None
+    if not variants:
+        progress('variants')
+        variants_info = yield ('variants', prompt, history, image_url, reflection is None)
+        variants = variants_info['variants']
+        summaries = variants_info.get('summaries')
+        reflection = reflection or variants_info.get('reflection')
+
+    # The reflection only depends on the prompt and history
+    progress(None)
+    reflection_task = None if reflection else (yield ('start_reflection', prompt, history))
+
+    # Each variant's image (and summary, unless it came with the variants) starts as soon
+    # as its text and instruction exist. A cancelled job submits nothing more; images
+    # already generating are dropped before they are mirrored.
+    image_tasks = []
+    summary_tasks = []
+    for index, variant_text in enumerate(variants):
+        ready_image = images[index] if images else None
+        if ready_image:
+            random_instruction = ready_image['debug_info']['random_instruction']
+        else:
+            random_instruction = yield ('instruction',)
+        progress('images')
+        if ready_image:
+            image_tasks.append((yield ('ready', ready_image)))
+        else:
+            image_tasks.append((yield ('start_image', variant_text, image_url, random_instruction, public_base_url, progress)))
+        if summaries:
+            summary_tasks.append((yield ('ready', summary_result(summaries[index], random_instruction or ''))))
+        else:
+            progress('images')
+            summary_tasks.append((yield ('start_summary', variant_text, random_instruction or '')))
+
+    images = []
+    for task in image_tasks:
+        images.append((yield ('wait', task)))
+    summaries = []
+    for task in summary_tasks:
+        summaries.append((yield ('wait', task)))
+    progress('reflection')
+    reflection = reflection or (yield ('wait', reflection_task))
+    return {
+        'variants': variants,
+        'variants_debug_info': variants_info['debug_info'] if variants_info else None,
+        'images': images,
+        'summaries': summaries,
+        'reflection': reflection
+    }
+
+def cycle_steps(session_id, prompt, history, image_url, variants, speculate, public_base_url, progress=None,
+                summaries=None, reflection=None, images=None):
+    """A whole round: from the precomputed pool on a hit, otherwise live_cycle_steps, falling
+    back to the pool if that fails. With speculate, also pre-generates the next round's
+    variants for either winner. progress(stage) is called between stages when given."""
+    progress = progress or (lambda stage: None)
+    entry = variant_pool.get(image_url, variants)
+    if entry is not None:
+        result = pool_cycle(entry, public_base_url)
+    else:
+        try:
+            result = yield from live_cycle_steps(prompt, history, image_url, variants, public_base_url, progress,
+                                                 summaries, reflection, images)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            entry = variant_pool.fallback(image_url, variants)
+            if entry is None:
+                raise
+            log.warning("Cycle failed (%s), serving the precomputed round for %s", e, entry['image'])
+            result = pool_cycle(entry, public_base_url, fallback=True)
+
+    if speculate:
+        # Mirror what script.js sends after a win: summary as prompt, appended to history
+        for image, summary in zip(result['images'], result['summaries']):
+            next_prompt = summary['summary']
+            speculate_text_variants(next_prompt, history + [next_prompt], image['modifiedImageUrl'])
+
+    progress('saving')
+    if not (result.get('pool') or {}).get('fallback'):
+        # A stand-in round is shown as such by the client, not played as the visitor's own
+        yield ('record', session_id, not variants, prompt, history, image_url, result)
+    return result
+
+def record_cycle(session_id, new_round, prompt, history, image_url, result):
+    record_session_round(session_id, new_round=new_round, prompt=prompt,
+                         **cycle_round_fields(result['variants'], result['images'], result['summaries'], result['reflection']))
+    iteration_archive.add_iteration(session_id, prompt, history, image_url, result)
+
+class CycleIO:
+    """The cycle's I/O steps on the pipeline threads; tasks are futures"""
+
+    def __init__(self):
+        self.tasks = []
+
+    def variants(self, prompt, history, image_url, with_reflection):
+        return (take_speculative_variants(prompt, history, image_url)
+                or propose_variant_batch(prompt, history, image_url, with_reflection=with_reflection))
+
+    def instruction(self):
+        return get_random_instruction()
+
+    def ready(self, value):
+        return completed_future(value)
+
+    def _start(self, function, *args):
+        future = pipeline_executor.submit(function, *args)
+        self.tasks.append(future)
+        return future
+
+    def start_reflection(self, prompt, history):
+        return self._start(write_reflection, prompt, history)
+
+    def start_image(self, text, image_url, random_instruction, public_base_url, progress):
+        return self._start(render_variant_image, text, image_url, random_instruction, public_base_url, progress)
+
+    def start_summary(self, text, instruction):
+        return self._start(summarize_variant_or_fallback, text, instruction)
+
+    def wait(self, task):
+        return task.result()
+
+    def record(self, *args):
+        record_cycle(*args)
+
+    def close(self):
+        # Work that hasn't started yet is dropped when the round fails or is cancelled
+        for future in self.tasks:
+            future.cancel()
+
+def drive_cycle(steps, io=None):
+    """Run a cycle_steps generator, performing each step with io's method of that name"""
+    io = io or CycleIO()
+    value, error = None, None
+    try:
+        while True:
+            try:
+                step = steps.throw(error) if error else steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, error = getattr(io, step[0])(*step[1:]), None
+            except Exception as e:
+                value, error = None, e
+    finally:
+        steps.close()
+        io.close()
+
+def live_cycle(prompt, history, image_url, variants, public_base_url, progress, summaries=None, reflection=None,
+               images=None):
+    """live_cycle_steps on the pipeline threads"""
+    return drive_cycle(live_cycle_steps(prompt, history, image_url, variants, public_base_url, progress,
+                                        summaries, reflection, images))
+
+def run_cycle(session_id, prompt, history, image_url, variants, speculate, public_base_url, progress=None,
+              summaries=None, reflection=None, images=None):
+    """cycle_steps on the pipeline threads"""
+    return drive_cycle(cycle_steps(session_id, prompt, history, image_url, variants, speculate, public_base_url, progress,
+                                   summaries, reflection, images))
+
+@app.route('/generate-cycle', methods=['POST', 'OPTIONS'])
+def generate_cycle():
+    """Run a whole round server-side and answer when it is done (see /jobs/cycle for the
+    non-blocking version)"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
     data = request.json
-    prompt = data.get('prompt', '')
-    history = data.get('history', [])
-
-    try:
-        reflection_prompt = (
-            "Reflect critically on the process and reasoning behind proposing two variants for the following image mutation prompt, "
-            "considering the user's choice history and inferred preferences. "
-            "Write as if you are the curator, explaining your own reasoning and approach in detail, "
-            "not in general but specifically on the user preferences and remembering all the choice history made by the user. "
-            "But do not specify who you are, just write the reflection.\n"
-            "The reflection must be maximum 200 characters.\n"
-            f"Current prompt: {prompt}\nUser choice history: {history}"
-        )
-        reflection_response = openai.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": "You are a critical curator in an art gallery."},
-                {"role": "user", "content": reflection_prompt}
-            ],
-            max_tokens=300
-        )
-        reflection = reflection_response.choices[0].message.content.strip()
-        return jsonify({
-            'reflection': reflection,
-            'debug_info': {
-                'reflection_prompt': reflection_prompt,
-                'system_message': "You are a critical curator in an art gallery."
-            }
-        })
+    try:
+        session_id, prompt, history, image_url = session_inputs(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        return jsonify(run_cycle(session_id, prompt, history, image_url, data.get('variants'),
+                                 data.get('speculate', False), request.host_url, summaries=data.get('summaries'),
+                                 reflection=data.get('reflection'), images=data.get('images')))
     except Exception as e:
-        print("Backend error (generate-reflection):", e)
+        log.error("Backend error (generate-cycle): %s", e)
         return jsonify({'error': str(e)}), 500
 
+def job_priority(data):
+    priority = data.get('priority', GENERATION_JOB_DEFAULT_PRIORITY)
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        raise ValueError("priority must be an integer")
+    return priority
+
+def submit_image_job(data, public_base_url):
+    """Queue one variant image, like /generate-image; shared with the async app"""
+    if not data.get('prompt'):
+        raise ValueError("prompt is required")
+    prompt = data['prompt']
+    image_url = data.get('imageUrl', 'CircleStart.png')
+    group = check_session_id(data['sessionId']) if data.get('sessionId') is not None else None
+    priority = job_priority(data)
+    random_instruction = get_random_instruction()
+    return generation_jobs.submit(
+        'image',
+        lambda progress: render_variant_image(prompt, image_url, random_instruction, public_base_url, progress),
+        group=group, priority=priority
+    )
+
+def submit_cycle_job(data, public_base_url):
+    """Queue a whole round, like /generate-cycle; it replaces the session's pending jobs"""
+    session_id, prompt, history, image_url = session_inputs(data)
+    priority = job_priority(data)
+    variants = data.get('variants')
+    speculate = data.get('speculate', False)
+    summaries, reflection, images = data.get('summaries'), data.get('reflection'), data.get('images')
+    cancel_session_jobs(session_id)
+    return generation_jobs.submit(
+        'cycle',
+        lambda progress: run_cycle(session_id, prompt, history, image_url, variants, speculate, public_base_url, progress,
+                                   summaries=summaries, reflection=reflection, images=images),
+        group=session_id, priority=priority
+    )
+
+def job_submit_response(submit, data, public_base_url):
+    """(JSON body, status, headers) for a job submission: 202, 400 or 429"""
+    try:
+        job = submit(data or {}, public_base_url)
+    except JobQueueFull as e:
+        return {'error': str(e), 'retry_after': e.retry_after}, 429, {'Retry-After': str(e.retry_after)}
+    except ValueError as e:
+        return {'error': str(e)}, 400, {}
+    return job, 202, {'Location': f"/jobs/{job['id']}"}
+
+def job_wait_args(args):
+    """(seconds to wait or None, revision or None) from a GET /jobs/<id> query string"""
+    wait = args.get('wait', type=float)
+    return (None if wait is None else min(max(wait, 0), GENERATION_JOB_WAIT_TIMEOUT)), args.get('revision', type=int)
+
+@app.route('/jobs/image', methods=['POST'])
+def create_image_job():
+    """Submit a variant image; answers 202 with the job id straight away"""
+    body, status, headers = job_submit_response(submit_image_job, request.get_json(silent=True), request.host_url)
+    return jsonify(body), status, headers
+
+@app.route('/jobs/cycle', methods=['POST'])
+def create_cycle_job():
+    """Submit a whole round (same body as /generate-cycle); answers 202 with the job id"""
+    body, status, headers = job_submit_response(submit_cycle_job, request.get_json(silent=True), request.host_url)
+    return jsonify(body), status, headers
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Job status, stage and (once done) result. ?wait=S blocks until the job finishes,
+    or with ?revision=R until it changes from the revision the client last saw."""
+    wait, revision = job_wait_args(request.args)
+    job = generation_jobs.get(job_id) if wait is None else generation_jobs.wait(job_id, wait, revision)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = generation_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+@app.route('/jobs', methods=['DELETE'])
+def cancel_jobs():
+    """Cancel every pending job of ?group= (a session id)"""
+    group = request.args.get('group')
+    if not group:
+        return jsonify({'error': 'group is required'}), 400
+    return jsonify({'group': group, 'cancelled': generation_jobs.cancel_group(group)})
+
 @app.route('/physical-button-press', methods=['POST'])
 def physical_button_press():
     """Endpoint to receive button presses from Raspberry Pi physical buttons"""
-    global button_press_state
-    
     try:
         data = request.json
         button_number = data.get('button')
         timestamp = data.get('timestamp')
         
-        print(f"Physical button {button_number} pressed (timestamp: {timestamp})")
+        log.info("Physical button %s pressed (timestamp: %s)", button_number, timestamp)
         
-        with button_lock:
-            button_press_state['button_pressed'] = button_number
-            button_press_state['timestamp'] = timestamp
-            button_press_state['processed'] = False
+        event = record_button_press(button_number, timestamp)
         
-        return jsonify({'status': 'success', 'message': f'Button {button_number} press received'})
+        return jsonify({'status': 'success', 'message': f'Button {button_number} press received', 'seq': event['seq']})
         
     except Exception as e:
-        print(f"Error handling physical button press: {e}")
+        log.error("Error handling physical button press: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+def record_button_press(button, timestamp):
+    """Append one press to the button log and count it for the open ballots. The sender's
+    clock can't be trusted against ours, so the press counts for the ballots open on arrival."""
+    event = button_log.append(button, timestamp)
+    vote_board.add_presses([dict(event, timestamp=time.time())])
+    return event
+
+def parse_button_presses(data):
+    """[(press_id, button, timestamp)] from a /physical-button-presses body; ValueError if malformed"""
+    presses = (data or {}).get('presses')
+    if not isinstance(presses, list) or not presses:
+        raise ValueError('presses must be a non-empty list')
+    if len(presses) > BUTTON_BATCH_MAX:
+        raise ValueError(f'at most {BUTTON_BATCH_MAX} presses per request')
+    parsed = []
+    for press in presses:
+        try:
+            press_id, button, timestamp = press['id'], press['button'], press['timestamp']
+        except (KeyError, TypeError):
+            raise ValueError('each press needs id, button and timestamp')
+        if not isinstance(press_id, str) or not 0 < len(press_id) <= 64:
+            raise ValueError(f'invalid press id {press_id!r}')
+        if button not in (1, 2) or isinstance(button, bool):
+            raise ValueError(f'invalid button {button!r}')
+        if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool):
+            raise ValueError(f'invalid timestamp {timestamp!r}')
+        parsed.append((press_id, button, timestamp))
+    return parsed
+
+def button_clock_offset(data, now):
+    """Seconds to add to a batch's press timestamps to put them on the server clock, from the
+    sent_at the daemon stamps on each request (give or take the network delay); None without one.
+    A Pi without a real-time clock or NTP can run minutes off, which would decide every vote."""
+    sent_at = (data or {}).get('sent_at')
+    if sent_at is None:
+        return None
+    if not isinstance(sent_at, (int, float)) or isinstance(sent_at, bool):
+        raise ValueError(f'invalid sent_at {sent_at!r}')
+    return now - sent_at
+
+def record_button_presses(data):
+    """Append a batch of presses from the Pi daemon; returns the response body"""
+    presses = parse_button_presses(data)
+    now = time.time()
+    offset = button_clock_offset(data, now)
+    if offset is not None:
+        presses = [(press_id, button, timestamp + offset) for press_id, button, timestamp in presses]
+    events = button_log.append_batch(presses)
+    # Without sent_at (an older daemon) the presses count for the ballots open on arrival
+    vote_board.add_presses(events if offset is not None else [dict(event, timestamp=now) for event in events])
+    for event in events:
+        # Press-to-server delay: network outages show up here, not as lost votes
+        metrics.observe('button_delivery_seconds', max(0.0, now - event['timestamp']))
+    duplicates = len(presses) - len(events)
+    log.info("Physical button batch: %d press(es) recorded, %d duplicate(s)", len(events), duplicates)
+    return {
+        'status': 'success',
+        'recorded': len(events),
+        'duplicates': duplicates,
+        'seqs': [event['seq'] for event in events]
+    }
+
+@app.route('/physical-button-presses', methods=['POST'])
+def physical_button_presses():
+    """Batched presses from the Raspberry Pi daemon: {"presses": [{"id", "button", "timestamp"}],
+    "sent_at"}, timestamps on the Pi's clock (corrected by sent_at, see button_clock_offset).
+    Idempotent per press id, so the daemon can resend a batch whose answer it never got."""
+    try:
+        return jsonify(record_button_presses(request.get_json(silent=True)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        log.error("Error handling physical button presses: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def parse_button_cursor(value):
+    """Parse an ?after= / Last-Event-ID cursor; None when absent or invalid"""
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+def resync_button_cursor(cursor):
+    """Return (cursor, stale): a cursor past the log's last seq was handed out before the
+    backend restarted, so it is moved back to the end and the client told to re-sync"""
+    _, current, _ = button_log.read_after(cursor, 0)
+    if current < cursor:
+        return current, True
+    return cursor, False
+
+@app.route('/button-events', methods=['GET'])
+def button_events():
+    """Server-Sent Events stream of physical button presses (push alternative to /check-button-press).
+    Resumes after ?after=N or the Last-Event-ID the browser sends on reconnect; defaults to new presses only."""
+    # A browser reconnect sends Last-Event-ID, newer than the ?after= the stream was opened with
+    cursor = parse_button_cursor(request.headers.get('Last-Event-ID'))
+    if cursor is None:
+        cursor = parse_button_cursor(request.args.get('after'))
+    if cursor is None:
+        cursor = button_log.stats()['last_seq']
+    cursor, reset = resync_button_cursor(cursor)
+
+    def stream(cursor):
+        with button_lock:
+            button_log.subscribers += 1
+        try:
+            # The id moves the browser's Last-Event-ID along with a reset cursor
+            yield f"retry: 1000\nid: {cursor}\nevent: hello\ndata: {json.dumps({'cursor': cursor, 'reset': reset})}\n\n"
+            while True:
+                events, cursor, missed = button_log.wait_after(cursor, BUTTON_EVENTS_HEARTBEAT)
+                if missed:
+                    yield f"event: missed\ndata: {json.dumps({'missed': missed})}\n\n"
+                if not events:
+                    yield ": keep-alive\n\n"
+                    continue
+                for event in events:
+                    yield f"id: {event['seq']}\nevent: button\ndata: {json.dumps(event)}\n\n"
+        finally:
+            with button_lock:
+                button_log.subscribers -= 1
+
+    return Response(
+        stream_with_context(stream(cursor)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def poll_button_events(after_arg, limit_arg):
+    """Body of /check-button-press, shared with the async app.
+    With after=N returns every press after seq N (non-destructive, batched by limit);
+    without it, hands out presses one at a time through a shared legacy cursor."""
+    after = parse_button_cursor(after_arg)
+    if after is not None:
+        limit = parse_button_cursor(limit_arg) or BUTTON_EVENTS_BATCH_LIMIT
+        events, cursor, missed = button_log.read_after(after, min(limit, BUTTON_EVENTS_BATCH_LIMIT))
+        return {
+            'button_pressed': bool(events),
+            'events': events,
+            'cursor': cursor,
+            'missed': missed,
+            'reset': cursor < after  # stale cursor from before a restart: start over from here
+        }
+
+    event = button_log.claim_next()
+    if event:
+        # There is an unprocessed button press
+        return {
+            'button_pressed': True,
+            'button': event['button'],
+            'timestamp': event['timestamp'],
+            'seq': event['seq']
+        }
+    else:
+        return {'button_pressed': False}
+
 @app.route('/check-button-press', methods=['GET'])
 def check_button_press():
     """Endpoint for frontend to check if there was a physical button press"""
-    global button_press_state
-    
-    with button_lock:
-        if not button_press_state['processed'] and button_press_state['button_pressed']:
-            # There is an unprocessed button press
-            button = button_press_state['button_pressed']
-            button_press_state['processed'] = True
-            return jsonify({
-                'button_pressed': True,
-                'button': button,
-                'timestamp': button_press_state['timestamp']
-            })
-        else:
-            return jsonify({'button_pressed': False})
+    return jsonify(poll_button_events(request.args.get('after'), request.args.get('limit')))
+
+def health_info(message='Flask app is running'):
+    return {
+        'status': 'healthy',
+        'timestamp': time.time(),
+        'message': message,
+        'state_backend': STATE_BACKEND,
+        'vision_profile': VISION_IMAGE_PROFILE,
+        'vision_cache': vision_cache.stats(),
+        'image_store': image_store.stats(),
+        'derivatives': image_derivatives.stats(),
+        'sessions': session_store.stats(),
+        'variant_pool': variant_pool.stats(),
+        'jobs': generation_jobs.stats(),
+        'votes': vote_board.stats(),
+        'archive': iteration_archive.stats(),
+        'rate_limits': rate_scheduler.stats(),
+        'upstream': upstream.stats()
+    }
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for Raspberry Pi"""
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': time.time(),
-        'message': 'Flask app is running'
-    })
+    return jsonify(health_info())
+
+def original_redirect(source):
+    """Redirect to the original while a derivative is missing; never cached, so the browser
+    asks for the derivative again next time"""
+    response = redirect(f'/images/{source}')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/images/<name>', methods=['GET'])
+def serve_image(name):
+    """Serve a mirrored image or one of its derivatives. Names are content hashes, so responses
+    are cacheable forever; send_file hands the open file to the server's wsgi.file_wrapper
+    (sendfile where supported)."""
+    path, making, source = image_derivatives.lookup(name)
+    if making is not None:
+        try:
+            making.result(timeout=DERIVATIVE_WAIT)
+        except Exception:
+            pass
+        path = image_store.path_for(name)
+    if not path and source:
+        # Without the derivative, the original is the next best thing (not cached as this name)
+        return original_redirect(source)
+    if not path:
+        abort(404)
+    image_store.touch(path)
+    response = send_from_directory(image_store.directory, name, max_age=IMAGE_CACHE_MAX_AGE,
+                                   conditional=True, etag=name.split('.')[0])
+    response.headers['Cache-Control'] = f'public, max-age={IMAGE_CACHE_MAX_AGE}, immutable'
+    return response
+
+@app.route('/dedup-stats', methods=['GET'])
+def dedup_stats():
+    """Per-endpoint single-flight counters: how many upstream calls were saved"""
+    return jsonify(single_flight.stats())
+
+def metrics_gauges():
+    """Point-in-time values from the caches, stores and counters that already keep stats"""
+    gauges = []
+    for key, value in button_log.stats().items():
+        gauges.append((f'button_events_{key}', {}, value))
+    for key, value in vision_cache.stats().items():
+        gauges.append((f'vision_cache_{key}', {}, value))
+    gauges.append(('vision_image_profile', {'profile': VISION_IMAGE_PROFILE}, 1))
+    for key, value in image_store.stats().items():
+        gauges.append((f'image_store_{key}', {}, value))
+    for key, value in image_derivatives.stats().items():
+        gauges.append((f'derivatives_{key}', {}, value))
+    gauges.append(('instructions_available', {}, instruction_pool.count()))
+    for key, value in session_store.stats().items():
+        gauges.append((f'session_{key}', {}, value))
+    for key, value in generation_jobs.stats().items():
+        gauges.append((f'jobs_{key}', {}, value))
+    for key, value in variant_pool.stats().items():
+        gauges.append((f'variant_pool_{key}', {}, value))
+    for key, value in vote_board.stats().items():
+        gauges.append((f'votes_{key}', {}, value))
+    for key, value in iteration_archive.stats().items():
+        gauges.append((f'archive_{key}', {}, value))
+    for model, limits in rate_scheduler.stats().items():
+        for priority, depth in limits['queued'].items():
+            gauges.append(('upstream_queue_depth', {'model': model, 'priority': priority}, depth))
+        gauges.append(('upstream_requests_available', {'model': model}, limits['requests_available']))
+        if limits['tokens_available'] is not None:
+            gauges.append(('upstream_tokens_available', {'model': model}, limits['tokens_available']))
+    dedup = single_flight.stats()
+    gauges.append(('single_flight_in_flight', {}, dedup['in_flight']))
+    for endpoint, counter in dedup['endpoints'].items():
+        for key, value in counter.items():
+            gauges.append((f'single_flight_{key}', {'endpoint': endpoint}, value))
+    for endpoint, info in upstream.stats().items():
+        gauges.append(('upstream_circuit_open', {'endpoint': endpoint}, int(info['circuit'] != 'closed')))
+        if info['hedge_delay'] is not None:
+            gauges.append(('upstream_hedge_delay_seconds', {'endpoint': endpoint}, info['hedge_delay']))
+    return gauges
+
+def metrics_text():
+    return metrics.render(sorted(metrics_gauges(), key=lambda gauge: gauge[0]))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition of timing histograms and counters"""
+    return Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+def button_status_info():
+    last_event = button_log.latest() or {}
+    stats = button_log.stats()
+    return {
+        'physical_buttons_enabled': True,
+        'last_button_press': last_event.get('timestamp'),
+        'last_button': last_event.get('button'),
+        'last_seq': stats['last_seq'],
+        'dropped_events': stats['dropped'],
+        'push_subscribers': stats['subscribers']
+    }
 
 @app.route('/button-status', methods=['GET'])
 def button_status():
     """Endpoint to check physical buttons status"""
-    with button_lock:
-        return jsonify({
-            'physical_buttons_enabled': True,
-            'last_button_press': button_press_state['timestamp'],
-            'last_button': button_press_state['button_pressed']
-        })
+    return jsonify(button_status_info())
+
+def session_read_args(args):
+    """(version to wait past or None, history_after) from a GET /session query string"""
+    return parse_button_cursor(args.get('after')), parse_button_cursor(args.get('history_after')) or 0
+
+def session_etag(session_id, version):
+    return f'"{session_id}-{version}"'
+
+def session_response(session_id, version, text, if_none_match):
+    """(body, status, headers) for a snapshot; 304 when the client already has this version"""
+    etag = session_etag(session_id, version)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if if_none_match == etag:
+        return '', 304, headers
+    return text, 200, dict(headers, **{'Content-Type': 'application/json'})
+
+def apply_session_delta(session_id, delta):
+    """Body of POST /session/<id>, shared with the async app: (JSON body, status)"""
+    delta = {} if delta is None else delta
+    try:
+        version = session_store.apply(session_id, delta)
+    except SessionConflict as e:
+        return {'error': str(e), 'version': session_store.version(session_id), 'history_length': e.history_length}, 409
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    if delta.get('new_round') or delta.get('reset'):
+        cancel_session_jobs(session_id)
+    if delta.get('reset'):
+        vote_board.discard(session_id)
+        iteration_archive.add_reset(session_id)
+    chosen = (delta.get('set') or {}).get('current_image')
+    if chosen and delta.get('history_append') and not delta.get('reset'):
+        # A vote: the winner's image becomes the current one and its summary joins the history
+        iteration_archive.add_choice(session_id, chosen, delta['set'].get('current_prompt'))
+    return {'session': session_id, 'version': version}, 200
+
+@app.route('/session/<session_id>', methods=['GET'])
+def get_session(session_id):
+    """Snapshot of a session: history, current image and prompt, and the current round.
+    ?after=V blocks (up to SESSION_WAIT_TIMEOUT) until the version differs from V;
+    ?history_after=N only sends the history past the first N items; ETag/If-None-Match work too."""
+    if not SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    after, history_after = session_read_args(request.args)
+    if after is None:
+        version, text = session_store.read(session_id, history_after)
+    else:
+        version, text = session_store.wait(session_id, after, SESSION_WAIT_TIMEOUT, history_after)
+    return session_response(session_id, version, text, request.headers.get('If-None-Match'))
+
+@app.route('/session/<session_id>', methods=['POST'])
+def update_session(session_id):
+    """Apply a delta (see SessionStore.apply) from a display, the control page or the Pi"""
+    if not SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = apply_session_delta(session_id, request.get_json(silent=True))
+    return jsonify(body), status
+
+@app.route('/votes/<session_id>', methods=['GET'])
+def get_votes(session_id):
+    """Tally of the session's current ballot: counts, whether it is open, and the winner
+    once it closed. ?after=<version> blocks (up to VOTE_WAIT_TIMEOUT, and never past the
+    end of the voting window) until the tally differs from that version."""
+    if not SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    after = request.args.get('after')
+    if after is not None:
+        vote_board.wait(session_id, after)
+    tally = vote_board.tally(session_id)
+    if tally is None:
+        return jsonify({'error': 'no ballot for this session'}), 404
+    return jsonify(tally)
+
+@app.route('/votes/<session_id>/ballot', methods=['POST'])
+def create_ballot(session_id):
+    """Open a ballot for the round on display: {"key", "window", "votes_to_win", "physical"}, all optional"""
+    if not SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = open_ballot(session_id, request.get_json(silent=True))
+    return jsonify(body), status
+
+@app.route('/votes/<session_id>', methods=['POST'])
+def vote(session_id):
+    """A kiosk click: {"variant": 1|2, "ballot": n}; 409 once that ballot is closed"""
+    if not SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = cast_vote(session_id, request.get_json(silent=True))
+    return jsonify(body), status
+
+def archive_page(session_id, args, full=False, default_run=None):
+    """Body of GET /archive/<id> and /archive/<id>/replay, shared with the async app: (JSON body, status)"""
+    if not iteration_archive.db:
+        return {'error': 'the iteration archive is disabled'}, 404
+    run = args.get('run', default_run)
+    if run not in (None, 'current'):
+        run = parse_button_cursor(run)
+        if run is None:
+            return {'error': "run must be a number or 'current'"}, 400
+    after = parse_button_cursor(args.get('after')) or 0
+    limit = min(parse_button_cursor(args.get('limit')) or ARCHIVE_PAGE_MAX, ARCHIVE_PAGE_MAX)
+    records, cursor = iteration_archive.page(session_id, after, limit, run, full)
+    return {'session': session_id, 'iterations': records, 'next': cursor}, 200
+
+def archive_iteration(session_id, number):
+    """Body of GET /archive/<id>/<n>, shared with the async app: (JSON body, status)"""
+    record = iteration_archive.iteration(session_id, number) if iteration_archive.db else None
+    if record is None:
+        return {'error': f'no iteration {number} in session {session_id}'}, 404
+    return dict(record, children=iteration_archive.children(record['id'])), 200
+
+def archive_lineage(iteration_id, args):
+    """Body of GET /archive/iterations/<id>/lineage, shared with the async app: (JSON body, status)"""
+    if not iteration_archive.db:
+        return {'error': 'the iteration archive is disabled'}, 404
+    limit = min(parse_button_cursor(args.get('limit')) or ARCHIVE_PAGE_MAX, ARCHIVE_PAGE_MAX)
+    records, next_id = iteration_archive.lineage(iteration_id, limit)
+    if not records:
+        return {'error': f'no iteration with id {iteration_id}'}, 404
+    return {'lineage': records, 'next': next_id}, 200
+
+@app.route('/archive/<session_id>', methods=['GET'])
+def get_archive(session_id):
+    """The session's archived iterations, oldest first: ?after=<iteration>&limit=N pages
+    through them ("next" is the cursor for the following page), ?run=current|<n> keeps
+    one run (the rounds between two resets)"""
+    if not SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = archive_page(session_id, request.args)
+    return jsonify(body), status
+
+@app.route('/archive/<session_id>/replay', methods=['GET'])
+def replay_archive(session_id):
+    """Like /archive/<id> with every field of each iteration (analysis, variants, images,
+    prompts, summaries, reflection, winner) and the current run by default, to replay an
+    evolution without calling OpenAI"""
+    if not SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = archive_page(session_id, request.args, full=True, default_run='current')
+    return jsonify(body), status
+
+@app.route('/archive/<session_id>/<int:number>', methods=['GET'])
+def get_archived_iteration(session_id, number):
+    """Iteration N of the session, with the ids of the rounds that started from its images"""
+    if not SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = archive_iteration(session_id, number)
+    return jsonify(body), status
+
+@app.route('/archive/iterations/<int:iteration_id>/lineage', methods=['GET'])
+def get_lineage(iteration_id):
+    """The iteration and its ancestors back to the start image, newest first;
+    ?limit=N pages, continue from the "next" id"""
+    body, status = archive_lineage(iteration_id, request.args)
+    return jsonify(body), status
 
 @app.route('/remove-instruction', methods=['POST'])
 def remove_instruction():
@@ -454,45 +3580,26 @@ def remove_instruction():
             })
             
     except Exception as e:
-        print(f"Error in remove_instruction endpoint: {e}")
+        log.error("Error in remove_instruction endpoint: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/get-instructions-count', methods=['GET'])
 def get_instructions_count():
     """Endpoint to get the current number of available instructions"""
     try:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        instructions_file = os.path.join(base_dir, 'instructions.json')
-        
-        with open(instructions_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            instructions = data.get('random_instructions', [])
-            
         return jsonify({
-            'count': len(instructions),
+            'count': instruction_pool.count(),
             'status': 'success'
         })
         
     except Exception as e:
-        print(f"Error getting instructions count: {e}")
+        log.error("Error getting instructions count: %s", e)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/generate_summary', methods=['POST'])
-def generate_summary():
-    """Generate a short summary (max 200 chars) + instruction for variant text"""
-    try:
-        data = request.json
-        variant_text = data.get('variant_text', '')
-        instruction = data.get('instruction', '')
-        
-        print(f"🔍 SUMMARY DEBUG: Input variant_text: {variant_text[:100]}...")
-        print(f"🔍 SUMMARY DEBUG: Input instruction: {instruction}")
-        
-        if not variant_text:
-            return jsonify({'error': 'variant_text is required'}), 400
-        
-        # Create prompt for OpenAI to summarize
-        summary_prompt = f"""
+def summary_request(variant_text):
+    """openai.chat.completions.create arguments for a past-tense variant summary"""
+    # Create prompt for OpenAI to summarize
+    summary_prompt = f"""
         Please create a very concise summary of this text variant description in maximum 200 characters.
         Keep it engaging and descriptive but extremely brief.
         
@@ -504,48 +3611,83 @@ def generate_summary():
         
         Return only the summary in past tense, no additional text.
         """
+    return dict(
+        model="gpt-4-turbo",
+        messages=[
+            {"role": "system", "content": "You are a concise text summarizer. Create very brief, engaging summaries."},
+            {"role": "user", "content": summary_prompt}
+        ],
+        max_tokens=100,
+        temperature=0.7
+    )
+
+def summary_result(summary, instruction):
+    """Combine the model summary with the variant's instruction"""
+    summary = summary.strip()
+    log.debug("Generated summary: %s", summary)
+    
+    # Combine summary with instruction (convert instruction to past tense too)
+    if instruction:
+        # Convert instruction to past tense
+        instruction_past = convert_to_past_tense(instruction)
+        final_text = f"{summary}\n\n{instruction_past}"
+    else:
+        final_text = summary
         
-        print(f"🔍 SUMMARY DEBUG: Calling OpenAI for summary...")
-        
-        # Call OpenAI to generate summary
-        response = openai.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": "You are a concise text summarizer. Create very brief, engaging summaries."},
-                {"role": "user", "content": summary_prompt}
-            ],
-            max_tokens=100,
-            temperature=0.7
-        )
+    log.debug("Final combined summary text: %s", final_text)
+    
+    return {
+        'summary': final_text,
+        'original_summary': summary,
+        'instruction': instruction,
+        'status': 'success'
+    }
+
+def summarize_variant(variant_text, instruction):
+    """Generate a short past-tense summary (max 200 chars) of a variant, followed by its instruction"""
+    # Call OpenAI to generate summary
+    response = call_openai('generate_summary', openai.chat.completions.create, **summary_request(variant_text))
+    return summary_result(response.choices[0].message.content, instruction)
+
+def summarize_variant_or_fallback(variant_text, instruction):
+    """summarize_variant, falling back to the truncated text like script.js does"""
+    try:
+        return summarize_variant(variant_text, instruction)
+    except Exception as e:
+        log.error("Error generating summary: %s", e)
+        return fallback_summary(variant_text, instruction)
+
+def fallback_summary(variant_text, instruction):
+    """Truncated variant text + instruction, used when the summary call fails"""
+    truncated = variant_text[:150] + '...'
+    return {
+        'summary': f"{truncated}\n\n {instruction}" if instruction else truncated,
+        'original_summary': truncated,
+        'instruction': instruction,
+        'status': 'fallback'
+    }
+
+@app.route('/generate_summary', methods=['POST'])
+def generate_summary():
+    """Generate a short summary (max 200 chars) + instruction for variant text"""
+    try:
+        data = request.json
+        variant_text = data.get('variant_text', '')
+        instruction = data.get('instruction', '')
         
-        summary = response.choices[0].message.content.strip()
-        print(f"🔍 SUMMARY DEBUG: Generated summary: {summary}")
+        log.debug("Summary input: %.100s... (instruction: %s)", variant_text, instruction)
         
-        # Combine summary with instruction (convert instruction to past tense too)
-        if instruction:
-            # Convert instruction to past tense
-            instruction_past = convert_to_past_tense(instruction)
-            final_text = f"{summary}\n\n{instruction_past}"
-        else:
-            final_text = summary
-            
-        print(f"🔍 SUMMARY DEBUG: Final combined text: {final_text}")
+        if not variant_text:
+            return jsonify({'error': 'variant_text is required'}), 400
         
-        return jsonify({
-            'summary': final_text,
-            'original_summary': summary,
-            'instruction': instruction,
-            'status': 'success'
-        })
+        return jsonify(summarize_variant(variant_text, instruction))
         
     except Exception as e:
-        print(f"Error generating summary: {e}")
+        log.error("Error generating summary: %s", e)
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
     # Test the instruction function on startup
-    print("🧪 TESTING: get_random_instruction() function...")
-    test_instruction = get_random_instruction()
-    print(f"🧪 TEST RESULT: {test_instruction}")
+    log.info("Testing get_random_instruction(): %s", get_random_instruction())
     
-    app.run(host='0.0.0.0', port=65500)  # Changed to 0.0.0.0 to accept connections from Raspberry Pi
\ No newline at end of file
+    app.run(host='0.0.0.0', port=65500, threaded=True)  # Changed to 0.0.0.0 to accept connections from Raspberry Pi; threaded so /button-events streams don't block other requests
\ No newline at end of file
@@ -0,0 +1,838 @@
+"""
+Async (ASGI) serving mode for the exhibition backend.
+
+Serves the same routes as app.py with Quart, the async OpenAI client and httpx,
+so slow DALL-E calls, /button-events streams and pollers don't each pin a thread
+and several display kiosks can share one backend. Prompts, caches, the single-flight
+layer and the button event log are shared with app.py.
+
+    pip install quart quart-cors
+    hypercorn app_async:app --bind 0.0.0.0:65500
+
+Several worker processes need the shared state backend (see STATE_BACKEND in app.py):
+
+    STATE_BACKEND=sqlite hypercorn app_async:app --workers 4 --bind 0.0.0.0:65500
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+
+import httpx
+import openai
+from quart import Quart, request, jsonify, Response, send_from_directory, abort, redirect, g
+from quart_cors import cors
+
+import app as core
+from app import log, metrics
+
+app = cors(Quart(__name__), allow_origin='*')
+
+# Created when the server starts so they bind to the serving event loop
+async_openai = None
+http_client = None
+
+@app.before_serving
+async def open_clients():
+    global async_openai, http_client
+    async_openai = openai.AsyncOpenAI(api_key=openai.api_key or None, max_retries=0)
+    connect_timeout, read_timeout = core.IMAGE_FETCH_TIMEOUT
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        limits=httpx.Limits(max_connections=core.IMAGE_POOL_HOSTS * core.IMAGE_POOL_PER_HOST,
+                            max_keepalive_connections=core.IMAGE_POOL_PER_HOST),
+        follow_redirects=True
+    )
+
+@app.after_serving
+async def close_clients():
+    await async_openai.close()
+    await http_client.aclose()
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+async def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_seconds', time.perf_counter() - started,
+                        method=request.method, route=route, status=str(response.status_code))
+    return response
+
+async def call_openai_async(endpoint, create, dedup_key=None, **kwargs):
+    """Async twin of core.call_openai"""
+    if dedup_key is None:
+        dedup_key = core.request_dedup_key(kwargs)
+    return await core.single_flight.do_async(endpoint, dedup_key, lambda: core.upstream.call_async(endpoint, create, **kwargs))
+
+async def fetch_url_bytes_async(url):
+    """Async twin of core.fetch_url_bytes (the overall deadline is applied by the caller)"""
+    with metrics.span('image_fetch', source='http'):
+        async with http_client.stream('GET', url) as response:
+            response.raise_for_status()
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > core.IMAGE_FETCH_MAX_BYTES:
+                    raise ValueError(f"Image larger than {core.IMAGE_FETCH_MAX_BYTES} bytes: {url}")
+                chunks.append(chunk)
+            return b''.join(chunks)
+
+async def load_image_bytes_async(image_path_or_url):
+    """Download remote images without blocking the loop; local files are read on a worker thread"""
+    if not image_path_or_url.startswith('http') or core.image_store.path_for_url(image_path_or_url):
+        return await asyncio.to_thread(core.load_image_bytes, image_path_or_url)
+    try:
+        log.debug("Downloading image from URL: %s", image_path_or_url)
+        return await asyncio.wait_for(fetch_url_bytes_async(image_path_or_url), core.IMAGE_FETCH_DEADLINE)
+    except Exception as e:
+        log.error("Error loading image: %s", e)
+        return None
+
+async def analyze_image_with_vision_async(image_path_or_url):
+    """Async twin of core.analyze_image_with_vision, sharing its cache"""
+    image_data = await load_image_bytes_async(image_path_or_url)
+    if not image_data:
+        log.warning("Failed to load image for Vision: %s", image_path_or_url)
+        return "Unable to analyze image - encoding failed"
+
+    digest = hashlib.sha256(image_data).hexdigest()
+
+    async def call_vision():
+        # Resizing is CPU-bound: keep it off the event loop
+        request_kwargs = await asyncio.to_thread(core.vision_request_for, image_data, digest)
+        response = await core.upstream.call_async('analyze_image_with_vision', async_openai.chat.completions.create, **request_kwargs)
+        return response.choices[0].message.content
+
+    try:
+        return await core.vision_cache.get_or_compute_async(core.vision_cache_key(digest), call_vision)
+    except Exception as e:
+        log.error("Error analyzing image with Vision: %s", e)
+        return f"Error analyzing image: {str(e)}"
+
+async def compact_history_async(history):
+    """Async twin of core.compact_history, sharing its summary cache"""
+    summary, folds, recent = core.plan_history_compaction(history)
+    for index, (key, choices) in enumerate(folds):
+        try:
+            response = await call_openai_async('compact_history', async_openai.chat.completions.create,
+                                               **core.history_fold_request(summary, choices))
+        except Exception as e:
+            log.warning("History compaction failed, sending unfolded choices verbatim: %s", e)
+            return core.format_unfolded_history(summary, folds[index:], recent)
+        summary = core.history_fold_result(response.choices[0].message.content)
+        core.remember_history_summary(key, summary)
+    return core.format_compacted_history(summary, recent)
+
+async def propose_text_variants_async(prompt, history, image_url):
+    # The vision analysis and the history fold don't depend on each other
+    image_analysis, history_text = await asyncio.gather(
+        analyze_image_with_vision_async(image_url),
+        compact_history_async(history)
+    )
+    request_kwargs, debug_info = core.text_variants_request(prompt, history_text, image_analysis)
+    chat_response = await call_openai_async('generate_text_variants', async_openai.chat.completions.create, **request_kwargs)
+    return {
+        'variants': core.parse_text_variants(chat_response.choices[0].message.content),
+        'debug_info': debug_info
+    }
+
+async def unbatched_variants_async(prompt, history, image_url, with_reflection):
+    variants_info = await propose_text_variants_async(prompt, history, image_url)
+    stages = [summarize_variant_or_fallback_async(text, '') for text in variants_info['variants']]
+    if with_reflection:
+        stages.append(write_reflection_async(prompt, history))
+    results = await asyncio.gather(*stages)
+    summaries = [summary['original_summary'] for summary in results[:len(variants_info['variants'])]]
+    reflection = results[-1] if with_reflection else None
+    return core.variant_batch_result(variants_info['variants'], summaries, reflection, variants_info['debug_info'])
+
+async def propose_variant_batch_async(prompt, history, image_url, count=core.VARIANT_BATCH_DEFAULT_COUNT, with_reflection=False):
+    """Async twin of core.propose_variant_batch"""
+    image_analysis, history_text = await asyncio.gather(
+        analyze_image_with_vision_async(image_url),
+        compact_history_async(history)
+    )
+    request_kwargs, debug_info = core.variant_batch_request(prompt, history_text, image_analysis, count, with_reflection)
+    try:
+        response = await call_openai_async('generate_variant_batch', async_openai.chat.completions.create, **request_kwargs)
+        variants, summaries, reflection = core.parse_variant_batch(response.choices[0].message.content, count, with_reflection)
+    except Exception as e:
+        log.warning("Batched variant generation failed, falling back to separate calls: %s", e)
+        return await unbatched_variants_async(prompt, history, image_url, with_reflection)
+    return core.variant_batch_result(variants, summaries, core.batched_reflection(reflection) if with_reflection else None, debug_info)
+
+async def take_speculative_variants_async(prompt, history, image_url):
+    future = core.pop_speculative_future(prompt, history, image_url)
+    if future is None:
+        return None
+    try:
+        return await asyncio.wrap_future(future)
+    except Exception as e:
+        log.warning("Speculative variant generation failed, generating again: %s", e)
+        return None
+
+async def mirror_generated_image_async(result, public_base_url):
+    """Async twin of core.mirror_generated_image"""
+    remote_url = result['modifiedImageUrl']
+    try:
+        data = await asyncio.wait_for(fetch_url_bytes_async(remote_url), core.IMAGE_FETCH_DEADLINE)
+        name = await asyncio.to_thread(core.image_store.put_bytes, data)
+    except Exception as e:
+        log.warning("Error mirroring generated image, keeping remote URL: %s", e)
+        return result
+    core.image_derivatives.submit(name)
+    result['modifiedImageUrl'] = f"{public_base_url.rstrip('/')}/images/{name}"
+    result['debug_info']['remote_image_url'] = remote_url
+    return result
+
+async def render_variant_image_async(prompt, image_url, random_instruction, public_base_url=None):
+    image_analysis = await analyze_image_with_vision_async(image_url)
+    request_kwargs, final_prompt = core.image_request(prompt, image_analysis, random_instruction)
+    response = await call_openai_async('generate_image', async_openai.images.generate, **request_kwargs)
+    result = core.image_result(response.data[0].url, final_prompt, image_analysis, prompt, random_instruction)
+    if public_base_url:
+        await mirror_generated_image_async(result, public_base_url)
+    return result
+
+async def render_new_variant_image_async(prompt, image_url, public_base_url=None):
+    """render_variant_image_async with a fresh random instruction"""
+    random_instruction = await asyncio.to_thread(core.get_random_instruction)
+    return await render_variant_image_async(prompt, image_url, random_instruction, public_base_url)
+
+async def write_reflection_async(prompt, history):
+    request_kwargs, reflection_prompt = core.reflection_request(prompt, await compact_history_async(history))
+    response = await call_openai_async('generate_reflection', async_openai.chat.completions.create, **request_kwargs)
+    return core.reflection_result(response.choices[0].message.content, reflection_prompt)
+
+async def summarize_variant_async(variant_text, instruction):
+    response = await call_openai_async('generate_summary', async_openai.chat.completions.create, **core.summary_request(variant_text))
+    return core.summary_result(response.choices[0].message.content, instruction)
+
+async def summarize_variant_or_fallback_async(variant_text, instruction):
+    try:
+        return await summarize_variant_async(variant_text, instruction)
+    except Exception as e:
+        log.error("Error generating summary: %s", e)
+        return core.fallback_summary(variant_text, instruction)
+
+class AsyncCycleIO:
+    """The cycle's I/O steps (see core.cycle_steps) on the event loop; tasks are asyncio
+    tasks, and the state stores are called on worker threads"""
+
+    def __init__(self):
+        self.tasks = []
+
+    async def variants(self, prompt, history, image_url, with_reflection):
+        return (await take_speculative_variants_async(prompt, history, image_url)
+                or await propose_variant_batch_async(prompt, history, image_url, with_reflection=with_reflection))
+
+    async def instruction(self):
+        return await asyncio.to_thread(core.get_random_instruction)
+
+    async def ready(self, value):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(value)
+        return future
+
+    def _start(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.append(task)
+        return task
+
+    async def start_reflection(self, prompt, history):
+        return self._start(write_reflection_async(prompt, history))
+
+    async def start_image(self, text, image_url, random_instruction, public_base_url, progress):
+        return self._start(render_variant_image_async(text, image_url, random_instruction, public_base_url))
+
+    async def start_summary(self, text, instruction):
+        return self._start(summarize_variant_or_fallback_async(text, instruction))
+
+    async def wait(self, task):
+        return await task
+
+    async def record(self, *args):
+        await asyncio.to_thread(core.record_cycle, *args)
+
+    def close(self):
+        # A failed round or a client that went away leaves no DALL-E calls running for nobody
+        for task in self.tasks:
+            task.cancel()
+
+async def drive_cycle_async(steps, io=None):
+    """Async twin of core.drive_cycle"""
+    io = io or AsyncCycleIO()
+    value, error = None, None
+    try:
+        while True:
+            try:
+                step = steps.throw(error) if error else steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, error = await getattr(io, step[0])(*step[1:]), None
+            except Exception as e:
+                value, error = None, e
+    finally:
+        steps.close()
+        io.close()
+
+async def variants_with_pool_async(image_url, count, generate):
+    """Async twin of core.variants_with_pool; generate is a coroutine function"""
+    entry = core.variant_pool.get(image_url)
+    if entry is not None and len(entry['variants']) == count:
+        return core.pool_variants(entry)
+    try:
+        return await generate()
+    except Exception as e:
+        entry = core.variant_pool.fallback(image_url)
+        if entry is None:
+            raise
+        log.warning("Variant generation failed (%s), serving the precomputed round for %s", e, entry['image'])
+        return core.pool_variants(entry, fallback=True)
+
+@app.route('/generate-text-variants', methods=['POST', 'OPTIONS'])
+async def generate_text_variants():
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        session_id, prompt, history, image_url = await asyncio.to_thread(core.session_inputs, await request.get_json())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    await asyncio.to_thread(core.cancel_session_jobs, session_id)
+
+    async def generate():
+        result = await take_speculative_variants_async(prompt, history, image_url)
+        return result or await propose_text_variants_async(prompt, history, image_url)
+
+    try:
+        result = await variants_with_pool_async(image_url, 2, generate)
+        await asyncio.to_thread(core.record_session_round, session_id, new_round=True, prompt=prompt, variants=result['variants'])
+        return jsonify(result)
+    except Exception as e:
+        log.error("Backend error (generate-text-variants): %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generate-variants', methods=['POST', 'OPTIONS'])
+async def generate_variants():
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    data = await request.get_json()
+    try:
+        session_id, prompt, history, image_url = await asyncio.to_thread(core.session_inputs, data)
+        count, with_reflection = core.variant_batch_args(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    await asyncio.to_thread(core.cancel_session_jobs, session_id)
+
+    async def generate():
+        result = None
+        if count == core.VARIANT_BATCH_DEFAULT_COUNT:
+            result = await take_speculative_variants_async(prompt, history, image_url)
+        return result or await propose_variant_batch_async(prompt, history, image_url, count, with_reflection)
+
+    try:
+        result = await variants_with_pool_async(image_url, count, generate)
+        await asyncio.to_thread(core.record_session_round, session_id, new_round=True, prompt=prompt, variants=result['variants'])
+        return jsonify(result)
+    except Exception as e:
+        log.error("Backend error (generate-variants): %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generate-image', methods=['POST'])
+async def generate_image():
+    data = await request.get_json()
+    prompt = data['prompt']
+    image_url = data.get('imageUrl', 'CircleStart.png')
+
+    try:
+        return jsonify(await render_new_variant_image_async(prompt, image_url, request.host_url))
+    except Exception as e:
+        log.error("Backend error (generate-image): %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generate-reflection', methods=['POST', 'OPTIONS'])
+async def generate_reflection():
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        session_id, prompt, history, _ = await asyncio.to_thread(core.session_inputs, await request.get_json())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        reflection = await write_reflection_async(prompt, history)
+        await asyncio.to_thread(core.record_session_round, session_id, reflection=reflection['reflection'])
+        return jsonify(reflection)
+    except Exception as e:
+        log.error("Backend error (generate-reflection): %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generate_summary', methods=['POST'])
+async def generate_summary():
+    try:
+        data = await request.get_json()
+        variant_text = data.get('variant_text', '')
+        instruction = data.get('instruction', '')
+        if not variant_text:
+            return jsonify({'error': 'variant_text is required'}), 400
+        return jsonify(await summarize_variant_async(variant_text, instruction))
+    except Exception as e:
+        log.error("Error generating summary: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+def sse_response_async(events, endpoint):
+    """Async twin of core.sse_response; events is an async generator of (event, data)"""
+    started = time.perf_counter()
+
+    async def stream():
+        first_text = True
+        try:
+            async for event, data in events:
+                if event == 'delta' and first_text:
+                    first_text = False
+                    metrics.observe('stream_first_text_seconds', time.perf_counter() - started, endpoint=endpoint)
+                yield core.sse_event(event, data).encode()
+        except Exception as e:
+            log.error("Backend error (%s stream): %s", endpoint, e)
+            yield core.sse_event('error', {'error': str(e)}).encode()
+
+    response = Response(stream(), mimetype='text/event-stream', headers=core.STREAM_HEADERS)
+    response.timeout = None
+    return response
+
+async def ready_text_variants_async(prompt, history, image_url):
+    entry = core.variant_pool.get(image_url)
+    if entry is not None and len(entry['variants']) == 2:
+        return core.pool_variants(entry), 'pool'
+    result = await take_speculative_variants_async(prompt, history, image_url)
+    return (result, 'speculation') if result else (None, 'upstream')
+
+async def list_deltas(deltas):
+    for delta in deltas:
+        yield delta
+
+async def followup(kind, index, text, work):
+    """(kind, index, text, result, error) once work finishes, for asyncio.as_completed"""
+    try:
+        return kind, index, text, await work, None
+    except Exception as e:
+        return kind, index, text, None, e
+
+async def text_variant_events_async(session_id, prompt, history, image_url, public_base_url,
+                                    with_summaries=False, with_reflection=False, with_images=False):
+    """Async twin of core.text_variant_events"""
+    ready, source = await ready_text_variants_async(prompt, history, image_url)
+    round_ = core.VariantStreamRound(session_id, prompt, ready, with_summaries, with_reflection)
+    followups = []
+    if with_reflection and not round_.batch_reflection:
+        followups.append(asyncio.ensure_future(followup('reflection', None, None, write_reflection_async(prompt, history))))
+    if ready is not None:
+        debug_info = ready['debug_info']
+        deltas = list_deltas(core.ready_deltas(ready, round_.batch_reflection))
+    else:
+        image_analysis = await analyze_image_with_vision_async(image_url)
+        request_kwargs, debug_info = core.variant_batch_request(prompt, await compact_history_async(history), image_analysis,
+                                                                with_reflection=with_reflection)
+        deltas = core.upstream.stream_async('generate_variant_batch', async_openai.chat.completions.create, **request_kwargs)
+    yield 'start', {'source': source, 'debug_info': debug_info}
+
+    def start_images(events):
+        for index, text in round_.to_start(events):
+            if with_images:
+                work = render_new_variant_image_async(text, image_url, public_base_url)
+                followups.append(asyncio.ensure_future(followup('image', index, text, work)))
+
+    try:
+        async for delta in deltas:
+            events = round_.feed(delta)
+            for event in events:
+                yield event
+            start_images(events)
+        events = round_.close()
+        for event in events:
+            yield event
+        start_images(events)
+
+        for finished in asyncio.as_completed(followups):
+            event = round_.followup_event(*await finished)
+            if event:
+                yield event
+    finally:
+        # The client went away: don't leave DALL-E calls running for nobody
+        for task in followups:
+            task.cancel()
+    if round_.reflection:
+        await asyncio.to_thread(core.record_session_round, session_id, reflection=round_.reflection['reflection'])
+    yield 'done', round_.done(source, debug_info)
+
+async def summary_events_async(variant_text, instruction):
+    parts = []
+    async for delta in core.upstream.stream_async('generate_summary', async_openai.chat.completions.create,
+                                                  **core.summary_request(variant_text)):
+        parts.append(delta)
+        yield 'delta', {'text': delta}
+    yield 'done', core.summary_result(''.join(parts), instruction)
+
+async def reflection_events_async(session_id, prompt, history):
+    request_kwargs, reflection_prompt = core.reflection_request(prompt, await compact_history_async(history))
+    parts = []
+    async for delta in core.upstream.stream_async('generate_reflection', async_openai.chat.completions.create, **request_kwargs):
+        parts.append(delta)
+        yield 'delta', {'text': delta}
+    reflection = core.reflection_result(''.join(parts), reflection_prompt)
+    await asyncio.to_thread(core.record_session_round, session_id, reflection=reflection['reflection'])
+    yield 'done', reflection
+
+@app.route('/generate-text-variants/stream', methods=['POST', 'OPTIONS'])
+async def stream_text_variants():
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    data = await request.get_json(silent=True) or {}
+    try:
+        session_id, prompt, history, image_url = await asyncio.to_thread(core.session_inputs, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    await asyncio.to_thread(core.cancel_session_jobs, session_id)
+    return sse_response_async(text_variant_events_async(session_id, prompt, history, image_url, request.host_url,
+                                                        *core.stream_options(data)), 'generate-text-variants')
+
+@app.route('/generate_summary/stream', methods=['POST'])
+async def stream_summary():
+    data = await request.get_json(silent=True) or {}
+    if not data.get('variant_text'):
+        return jsonify({'error': 'variant_text is required'}), 400
+    return sse_response_async(summary_events_async(data['variant_text'], data.get('instruction', '')), 'generate_summary')
+
+@app.route('/generate-reflection/stream', methods=['POST', 'OPTIONS'])
+async def stream_reflection():
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        session_id, prompt, history, _ = await asyncio.to_thread(core.session_inputs, await request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return sse_response_async(reflection_events_async(session_id, prompt, history), 'generate-reflection')
+
+@app.route('/generate-cycle', methods=['POST', 'OPTIONS'])
+async def generate_cycle():
+    """Same contract as the Flask /generate-cycle, with every stage awaited concurrently"""
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    data = await request.get_json()
+    try:
+        session_id, prompt, history, image_url = await asyncio.to_thread(core.session_inputs, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        return jsonify(await drive_cycle_async(core.cycle_steps(
+            session_id, prompt, history, image_url, data.get('variants'), data.get('speculate', False), request.host_url,
+            summaries=data.get('summaries'), reflection=data.get('reflection'), images=data.get('images'))))
+    except Exception as e:
+        log.error("Backend error (generate-cycle): %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/image', methods=['POST'])
+async def create_image_job():
+    body, status, headers = await asyncio.to_thread(core.job_submit_response, core.submit_image_job,
+                                                    await request.get_json(silent=True), request.host_url)
+    return jsonify(body), status, headers
+
+@app.route('/jobs/cycle', methods=['POST'])
+async def create_cycle_job():
+    body, status, headers = await asyncio.to_thread(core.job_submit_response, core.submit_cycle_job,
+                                                    await request.get_json(silent=True), request.host_url)
+    return jsonify(body), status, headers
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    """Same contract as the Flask /jobs/<id>; ?wait= waits on an asyncio.Event"""
+    jobs = core.generation_jobs
+    wait, revision = core.job_wait_args(request.args)
+    job = await asyncio.to_thread(jobs.get, job_id)
+    if job is not None and wait:
+        await wait_until(jobs, lambda: jobs.settled(job_id, revision), wait)
+        job = await asyncio.to_thread(jobs.get, job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+async def cancel_job(job_id):
+    job = await asyncio.to_thread(core.generation_jobs.cancel, job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+@app.route('/jobs', methods=['DELETE'])
+async def cancel_jobs():
+    group = request.args.get('group')
+    if not group:
+        return jsonify({'error': 'group is required'}), 400
+    return jsonify({'group': group, 'cancelled': await asyncio.to_thread(core.generation_jobs.cancel_group, group)})
+
+@app.route('/physical-button-press', methods=['POST'])
+async def physical_button_press():
+    try:
+        data = await request.get_json()
+        button_number = data.get('button')
+        event = await asyncio.to_thread(core.record_button_press, button_number, data.get('timestamp'))
+        return jsonify({'status': 'success', 'message': f'Button {button_number} press received', 'seq': event['seq']})
+    except Exception as e:
+        log.error("Error handling physical button press: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/physical-button-presses', methods=['POST'])
+async def physical_button_presses():
+    try:
+        return jsonify(await asyncio.to_thread(core.record_button_presses, await request.get_json(silent=True)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        log.error("Error handling physical button presses: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/button-events', methods=['GET'])
+async def button_events():
+    """SSE stream of button presses; waits on an asyncio.Event instead of a thread per display"""
+    # A browser reconnect sends Last-Event-ID, newer than the ?after= the stream was opened with
+    cursor = core.parse_button_cursor(request.headers.get('Last-Event-ID'))
+    if cursor is None:
+        cursor = core.parse_button_cursor(request.args.get('after'))
+    if cursor is None:
+        cursor = (await asyncio.to_thread(core.button_log.stats))['last_seq']
+    cursor, reset = await asyncio.to_thread(core.resync_button_cursor, cursor)
+
+    loop = asyncio.get_running_loop()
+    wake_up = asyncio.Event()
+
+    def listener():
+        loop.call_soon_threadsafe(wake_up.set)
+
+    async def stream(cursor):
+        with core.button_lock:
+            core.button_log.listeners.append(listener)
+            core.button_log.subscribers += 1
+        try:
+            yield f"retry: 1000\nid: {cursor}\nevent: hello\ndata: {json.dumps({'cursor': cursor, 'reset': reset})}\n\n".encode()
+            while True:
+                events, cursor, missed = await asyncio.to_thread(core.button_log.read_after, cursor)
+                if missed:
+                    yield f"event: missed\ndata: {json.dumps({'missed': missed})}\n\n".encode()
+                for event in events:
+                    yield f"id: {event['seq']}\nevent: button\ndata: {json.dumps(event)}\n\n".encode()
+                if events:
+                    continue
+                wake_up.clear()
+                if (await asyncio.to_thread(core.button_log.stats))['last_seq'] > cursor:
+                    continue
+                try:
+                    await asyncio.wait_for(wake_up.wait(), core.BUTTON_EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+        finally:
+            with core.button_lock:
+                core.button_log.listeners.remove(listener)
+                core.button_log.subscribers -= 1
+
+    response = Response(
+        stream(cursor),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.timeout = None
+    return response
+
+async def wait_until(source, done, timeout):
+    """Wait up to timeout seconds for done() without holding a thread: source.listeners
+    are called (from any thread) on every change, and done() is re-checked each time, on a
+    worker thread since it may read the state database"""
+    loop = asyncio.get_running_loop()
+    wake_up = asyncio.Event()
+
+    def listener():
+        loop.call_soon_threadsafe(wake_up.set)
+
+    def watch(add):
+        # source.lock can be held across a database write, so it is never taken on the loop
+        with source.lock:
+            if add:
+                source.listeners.append(listener)
+            else:
+                source.listeners.remove(listener)
+
+    await asyncio.to_thread(watch, True)
+    try:
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            wake_up.clear()
+            if await asyncio.to_thread(done):
+                return
+            try:
+                await asyncio.wait_for(wake_up.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return
+    finally:
+        await asyncio.to_thread(watch, False)
+
+@app.route('/session/<session_id>', methods=['GET'])
+async def get_session(session_id):
+    """Same contract as the Flask /session/<id>; long-polls wait on an asyncio.Event"""
+    if not core.SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    after, history_after = core.session_read_args(request.args)
+    if after is not None:
+        await wait_until(core.session_store, lambda: core.session_store.version(session_id) != after,
+                         core.SESSION_WAIT_TIMEOUT)
+    version, text = await asyncio.to_thread(core.session_store.read, session_id, history_after)
+    return core.session_response(session_id, version, text, request.headers.get('If-None-Match'))
+
+@app.route('/session/<session_id>', methods=['POST'])
+async def update_session(session_id):
+    if not core.SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = await asyncio.to_thread(core.apply_session_delta, session_id, await request.get_json(silent=True))
+    return jsonify(body), status
+
+@app.route('/votes/<session_id>', methods=['GET'])
+async def get_votes(session_id):
+    """Same contract as the Flask /votes/<id>; long-polls wait on an asyncio.Event"""
+    if not core.SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    after = request.args.get('after')
+    if after is not None:
+        await wait_until(core.vote_board, lambda: core.vote_board.version(session_id) != after,
+                         await asyncio.to_thread(core.vote_board.wait_timeout, session_id))
+    tally = await asyncio.to_thread(core.vote_board.tally, session_id)
+    if tally is None:
+        return jsonify({'error': 'no ballot for this session'}), 404
+    return jsonify(tally)
+
+@app.route('/votes/<session_id>/ballot', methods=['POST'])
+async def create_ballot(session_id):
+    if not core.SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = await asyncio.to_thread(core.open_ballot, session_id, await request.get_json(silent=True))
+    return jsonify(body), status
+
+@app.route('/votes/<session_id>', methods=['POST'])
+async def vote(session_id):
+    if not core.SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = await asyncio.to_thread(core.cast_vote, session_id, await request.get_json(silent=True))
+    return jsonify(body), status
+
+@app.route('/check-button-press', methods=['GET'])
+async def check_button_press():
+    return jsonify(await asyncio.to_thread(core.poll_button_events, request.args.get('after'), request.args.get('limit')))
+
+@app.route('/health', methods=['GET'])
+async def health_check():
+    return jsonify(await asyncio.to_thread(core.health_info, 'Async app is running'))
+
+@app.route('/images/<name>', methods=['GET'])
+async def serve_image(name):
+    path, making, source = core.image_derivatives.lookup(name)
+    if making is not None:
+        # Shielded: the derivative is shared, so a timeout or a client going away here must
+        # not cancel it for the other requests waiting on it
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(making)), core.DERIVATIVE_WAIT)
+        except Exception:
+            pass
+        path = core.image_store.path_for(name)
+    if not path and source:
+        response = redirect(f'/images/{source}')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    if not path:
+        abort(404)
+    core.image_store.touch(path)
+    response = await send_from_directory(core.image_store.directory, name)
+    response.set_etag(name.split('.')[0])
+    response.headers['Cache-Control'] = f'public, max-age={core.IMAGE_CACHE_MAX_AGE}, immutable'
+    return response
+
+@app.route('/dedup-stats', methods=['GET'])
+async def dedup_stats():
+    return jsonify(core.single_flight.stats())
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    return Response(await asyncio.to_thread(core.metrics_text), mimetype='text/plain; version=0.0.4')
+
+@app.route('/button-status', methods=['GET'])
+async def button_status():
+    return jsonify(await asyncio.to_thread(core.button_status_info))
+
+@app.route('/archive/<session_id>', methods=['GET'])
+async def get_archive(session_id):
+    if not core.SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = await asyncio.to_thread(core.archive_page, session_id, request.args)
+    return jsonify(body), status
+
+@app.route('/archive/<session_id>/replay', methods=['GET'])
+async def replay_archive(session_id):
+    if not core.SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = await asyncio.to_thread(core.archive_page, session_id, request.args, full=True, default_run='current')
+    return jsonify(body), status
+
+@app.route('/archive/<session_id>/<int:number>', methods=['GET'])
+async def get_archived_iteration(session_id, number):
+    if not core.SESSION_ID_PATTERN.match(session_id):
+        abort(404)
+    body, status = await asyncio.to_thread(core.archive_iteration, session_id, number)
+    return jsonify(body), status
+
+@app.route('/archive/iterations/<int:iteration_id>/lineage', methods=['GET'])
+async def get_lineage(iteration_id):
+    body, status = await asyncio.to_thread(core.archive_lineage, iteration_id, request.args)
+    return jsonify(body), status
+
+@app.route('/remove-instruction', methods=['POST'])
+async def remove_instruction():
+    try:
+        data = await request.get_json()
+        instruction = data.get('instruction')
+        if not instruction:
+            return jsonify({'error': 'No instruction provided'}), 400
+
+        if await asyncio.to_thread(core.remove_instruction_from_json, instruction):
+            return jsonify({
+                'status': 'success',
+                'message': f'Instruction removed: {instruction}',
+                'action': 'instruction_removed'
+            })
+        return jsonify({
+            'status': 'warning',
+            'message': f'Instruction not found: {instruction}',
+            'action': 'instruction_not_found'
+        })
+    except Exception as e:
+        log.error("Error in remove_instruction endpoint: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/get-instructions-count', methods=['GET'])
+async def get_instructions_count():
+    try:
+        return jsonify({'count': await asyncio.to_thread(core.instruction_pool.count), 'status': 'success'})
+    except Exception as e:
+        log.error("Error getting instructions count: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=65500)
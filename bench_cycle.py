@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+End-to-end latency benchmark: full voting cycles at N concurrent kiosks.
+
+Each kiosk runs --cycles rounds the way script.js drives the backend, against
+fake_openai.py so no real OpenAI calls are made. With --flow steps (the default)
+a round is /generate-text-variants, then 2x /generate-image, then 2x
+/generate_summary, then /generate-reflection; with --flow pipeline it is a single
+/generate-cycle call; with --flow batch it is /generate-variants (variants, summaries
+and reflection in one completion) and then /generate-cycle for the images only; with
+--flow stream it is the same with /generate-text-variants/stream instead of
+/generate-variants, and the time to the first streamed text is reported as
+stream-first-delta. The winning image and summary feed the next round, as if a
+visitor had voted for variant 1. With --rate-limit the fake server answers requests
+over a model's per-minute budget with 429s and the backend schedules against the same
+limits (--unscheduled turns its scheduler off, to compare). Latency percentiles per endpoint and per cycle
+are printed (or written to --output) as JSON, tagged with the git commit, so runs
+can be diffed between commits:
+
+    python bench_cycle.py --kiosks 8 --cycles 3 --output before.json
+    python bench_cycle.py --kiosks 8 --cycles 3 --failure-rate 0.05 --jitter 0.3
+    python bench_cycle.py --flow pipeline --kiosks 4 --rate-limit dall-e-3=20 --rate-limit gpt-4o=60/20000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import time
+
+import httpx
+
+from bench_serving import BASE_DIR, SERVERS, run_mode, summarize, wait_until_up
+from fake_openai import REQUEST_KINDS, parse_rate_limits, start_fake_openai
+
+DEFAULT_PROMPT = "Create a simple mutation of shape in the image with minimal design. Use solid colors and clean lines. The image should be very simple and minimal."
+
+ENDPOINTS = ('generate-text-variants', 'generate-text-variants/stream', 'stream-first-delta', 'generate-variants',
+             'generate-image', 'generate_summary', 'generate-reflection', 'generate-cycle')
+
+class RequestFailed(Exception):
+    pass
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class CycleDriver:
+    def __init__(self, client, base_url):
+        self.client = client
+        self.base_url = base_url
+        self.samples = {name: [] for name in ENDPOINTS}
+        self.errors = {name: 0 for name in ENDPOINTS}
+        self.cycle_samples = []
+        self.cycle_errors = 0
+
+    async def post(self, endpoint, body):
+        started = time.monotonic()
+        try:
+            response = await self.client.post(f"{self.base_url}/{endpoint}", json=body)
+        except httpx.HTTPError as e:
+            self.errors[endpoint] += 1
+            raise RequestFailed(f"{endpoint}: {e!r}")
+        if response.status_code != 200:
+            self.errors[endpoint] += 1
+            raise RequestFailed(f"{endpoint}: HTTP {response.status_code}")
+        self.samples[endpoint].append(time.monotonic() - started)
+        return response.json()
+
+    async def post_stream(self, endpoint, body):
+        """POST to an SSE endpoint and return the done event's data"""
+        started = time.monotonic()
+        buffer = ''
+        first_delta = True
+        try:
+            async with self.client.stream('POST', f"{self.base_url}/{endpoint}", json=body) as response:
+                if response.status_code != 200:
+                    self.errors[endpoint] += 1
+                    raise RequestFailed(f"{endpoint}: HTTP {response.status_code}")
+                async for text in response.aiter_text():
+                    buffer += text
+                    while '\n\n' in buffer:
+                        block, buffer = buffer.split('\n\n', 1)
+                        fields = dict(line.split(': ', 1) for line in block.split('\n') if ': ' in line)
+                        event = fields.get('event')
+                        if event == 'delta' and first_delta:
+                            first_delta = False
+                            self.samples['stream-first-delta'].append(time.monotonic() - started)
+                        elif event == 'error':
+                            self.errors[endpoint] += 1
+                            raise RequestFailed(f"{endpoint}: {fields.get('data')}")
+                        elif event == 'done':
+                            self.samples[endpoint].append(time.monotonic() - started)
+                            return json.loads(fields['data'])
+        except httpx.HTTPError as e:
+            self.errors[endpoint] += 1
+            raise RequestFailed(f"{endpoint}: {e!r}")
+        self.errors[endpoint] += 1
+        raise RequestFailed(f"{endpoint}: stream ended without done")
+
+    async def steps_cycle(self, prompt, history, image_url):
+        """One round as the separate calls script.js used to make"""
+        variants = (await self.post('generate-text-variants', {
+            'prompt': prompt, 'history': history, 'imageUrl': image_url
+        }))['variants']
+        images = await asyncio.gather(*[
+            self.post('generate-image', {'prompt': text, 'imageUrl': image_url}) for text in variants
+        ])
+        summaries = await asyncio.gather(*[
+            self.post('generate_summary', {
+                'variant_text': text,
+                'instruction': image['debug_info'].get('random_instruction') or ''
+            }) for text, image in zip(variants, images)
+        ])
+        await self.post('generate-reflection', {'prompt': prompt, 'history': history})
+        return images[0]['modifiedImageUrl'], summaries[0]['summary']
+
+    async def pipeline_cycle(self, prompt, history, image_url):
+        """One round as a single /generate-cycle call, the way script.js does now"""
+        result = await self.post('generate-cycle', {
+            'prompt': prompt, 'history': history, 'imageUrl': image_url, 'speculate': True
+        })
+        return result['images'][0]['modifiedImageUrl'], result['summaries'][0]['summary']
+
+    async def batch_cycle(self, prompt, history, image_url):
+        """One round as script.js drives it with batched variants"""
+        batch = await self.post('generate-variants', {
+            'prompt': prompt, 'history': history, 'imageUrl': image_url, 'reflection': True
+        })
+        result = await self.post('generate-cycle', {
+            'prompt': prompt, 'history': history, 'imageUrl': image_url, 'speculate': True,
+            'variants': batch['variants'], 'summaries': batch['summaries'],
+            'reflection': batch['reflection']['reflection']
+        })
+        return result['images'][0]['modifiedImageUrl'], result['summaries'][0]['summary']
+
+    async def stream_cycle(self, prompt, history, image_url):
+        """One round as script.js drives it with streamed variants"""
+        batch = await self.post_stream('generate-text-variants/stream', {
+            'prompt': prompt, 'history': history, 'imageUrl': image_url, 'summaries': True, 'reflection': True
+        })
+        result = await self.post('generate-cycle', {
+            'prompt': prompt, 'history': history, 'imageUrl': image_url, 'speculate': True,
+            'variants': batch['variants'], 'summaries': batch['summaries'],
+            'reflection': batch['reflection']['reflection'] if batch['reflection'] else None
+        })
+        return result['images'][0]['modifiedImageUrl'], result['summaries'][0]['summary']
+
+    async def kiosk(self, index, cycles, flow):
+        run_cycle = {'pipeline': self.pipeline_cycle, 'batch': self.batch_cycle,
+                     'stream': self.stream_cycle}.get(flow, self.steps_cycle)
+        prompt = DEFAULT_PROMPT
+        history = []
+        image_url = 'CircleStart.png'
+        for _ in range(cycles):
+            started = time.monotonic()
+            try:
+                image_url, summary = await run_cycle(prompt, history, image_url)
+            except RequestFailed as e:
+                # Start the kiosk over, like a visitor reloading after an error
+                print(f"Kiosk {index}: cycle failed ({e})")
+                self.cycle_errors += 1
+                prompt, history, image_url = DEFAULT_PROMPT, [], 'CircleStart.png'
+                continue
+            self.cycle_samples.append(time.monotonic() - started)
+            # The vote: variant 1 wins, its summary becomes the next prompt
+            prompt = summary
+            history = history + [summary]
+
+async def drive_cycles(base_url, kiosks, cycles, flow):
+    limits = httpx.Limits(max_connections=kiosks * 4 + 4)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        await wait_until_up(client, base_url)
+        driver = CycleDriver(client, base_url)
+        started = time.monotonic()
+        await asyncio.gather(*[driver.kiosk(i, cycles, flow) for i in range(kiosks)])
+        elapsed = time.monotonic() - started
+
+    endpoints = {
+        name: summarize(driver.samples[name], driver.errors[name], elapsed)
+        for name in ENDPOINTS if driver.samples[name] or driver.errors[name]
+    }
+    return {
+        'elapsed_s': round(elapsed, 2),
+        'cycle': summarize(driver.cycle_samples, driver.cycle_errors, elapsed),
+        'endpoints': endpoints
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['flask'], choices=sorted(SERVERS))
+    parser.add_argument('--flow', default='steps', choices=['steps', 'pipeline', 'batch', 'stream'])
+    parser.add_argument('--kiosks', type=int, default=4, help='concurrent kiosks')
+    parser.add_argument('--cycles', type=int, default=3, help='voting cycles per kiosk')
+    parser.add_argument('--chat-latency', type=float, default=0.8)
+    parser.add_argument('--vision-latency', type=float, default=1.5)
+    parser.add_argument('--image-latency', type=float, default=4.0)
+    parser.add_argument('--jitter', type=float, default=0.2, help='relative fake latency jitter')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of fake OpenAI calls that fail')
+    parser.add_argument('--failure-status', type=int, default=500)
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='fraction of fake OpenAI calls that stall')
+    parser.add_argument('--hang-seconds', type=float, default=60.0)
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='MODEL=RPM[/TPM]',
+                        help='per-model limit enforced by the fake server and scheduled for by the backend')
+    parser.add_argument('--unscheduled', action='store_true', help='leave the backend scheduler off under --rate-limit')
+    parser.add_argument('--port', type=int, default=65530)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    fake_server, fake_base_url = start_fake_openai(
+        latency={'chat': args.chat_latency, 'vision': args.vision_latency, 'image': args.image_latency},
+        jitter=args.jitter,
+        failure_rate=dict.fromkeys(REQUEST_KINDS, args.failure_rate),
+        failure_status=args.failure_status,
+        hang_rate=dict.fromkeys(REQUEST_KINDS, args.hang_rate),
+        hang_seconds=args.hang_seconds,
+        rate_limits=parse_rate_limits(args.rate_limit)
+    )
+    if args.rate_limit and not args.unscheduled:
+        os.environ['UPSTREAM_RATE_LIMITS'] = ','.join(args.rate_limit)
+    results = {
+        'commit': git_commit(),
+        'config': vars(args),
+        'modes': {}
+    }
+    for i, mode in enumerate(args.modes):
+        results['modes'][mode] = run_mode(mode, args.port + i, fake_base_url,
+                                          lambda base_url: drive_cycles(base_url, args.kiosks, args.cycles, args.flow))
+    results['upstream_calls'] = fake_server.snapshot_stats()
+    fake_server.shutdown()
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+        print(f"Report written to {args.output}")
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Load benchmark: Flask (app.py, threaded dev server) vs async (app_async.py on hypercorn).
+
+Both backends run against fake_openai.py, so no real OpenAI calls are made. Each run
+keeps --generations concurrent /generate-image requests in flight while --pollers
+clients hammer /check-button-press and /health, then reports latency percentiles
+and throughput per request type as JSON. The *-workers modes run the same apps as
+several hypercorn worker processes sharing state through SQLite (STATE_BACKEND=sqlite,
+in a throwaway database):
+
+    python bench_serving.py --generations 32 --pollers 16 --duration 20
+    python bench_serving.py --modes flask flask-workers async-workers --workers 4
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from fake_openai import start_fake_openai
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WORKERS = 4
+
+SERVERS = {
+    'flask': lambda port: [sys.executable, '-c', f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"],
+    'async': lambda port: [sys.executable, '-m', 'hypercorn', 'app_async:app', '--bind', f'127.0.0.1:{port}'],
+    'flask-workers': lambda port: [sys.executable, '-m', 'hypercorn', 'app:app', '--workers', str(WORKERS),
+                                   '--bind', f'127.0.0.1:{port}'],
+    'async-workers': lambda port: [sys.executable, '-m', 'hypercorn', 'app_async:app', '--workers', str(WORKERS),
+                                   '--bind', f'127.0.0.1:{port}']
+}
+
+SHARED_STATE_MODES = ('flask-workers', 'async-workers')
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 1)
+
+def summarize(samples, errors, duration):
+    return {
+        'count': len(samples),
+        'errors': errors,
+        'per_second': round(len(samples) / duration, 2),
+        'p50_ms': percentile(samples, 50),
+        'p95_ms': percentile(samples, 95),
+        'p99_ms': percentile(samples, 99),
+        'mean_ms': round(statistics.mean(samples) * 1000, 1) if samples else None
+    }
+
+async def wait_until_up(client, base_url, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(f"{base_url}/health")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"Backend at {base_url} did not come up")
+
+async def drive(base_url, generations, pollers, duration):
+    samples = {'generate-image': [], 'check-button-press': [], 'health': []}
+    errors = {name: 0 for name in samples}
+    limits = httpx.Limits(max_connections=generations + pollers * 2 + 4)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        await wait_until_up(client, base_url)
+        stop_at = time.monotonic() + duration
+
+        async def timed(name, send):
+            started = time.monotonic()
+            try:
+                response = await send()
+                if response.status_code != 200:
+                    errors[name] += 1
+                    return
+            except httpx.HTTPError:
+                errors[name] += 1
+                return
+            samples[name].append(time.monotonic() - started)
+
+        async def generator():
+            while time.monotonic() < stop_at:
+                # Unique prompts, so the single-flight layer can't collapse them
+                body = {'prompt': f"bench {uuid.uuid4()}", 'imageUrl': 'CircleStart.png'}
+                await timed('generate-image', lambda: client.post(f"{base_url}/generate-image", json=body))
+
+        async def poller():
+            while time.monotonic() < stop_at:
+                await timed('check-button-press', lambda: client.get(f"{base_url}/check-button-press?after=0"))
+                await timed('health', lambda: client.get(f"{base_url}/health"))
+
+        started = time.monotonic()
+        await asyncio.gather(*[generator() for _ in range(generations)], *[poller() for _ in range(pollers)])
+        elapsed = time.monotonic() - started
+
+    return {name: summarize(samples[name], errors[name], elapsed) for name in samples}
+
+def run_mode(mode, port, fake_base_url, drive_fn):
+    """Start the backend in `mode` against the fake OpenAI server and run drive_fn(base_url) on it"""
+    env = dict(os.environ, OPENAI_BASE_URL=fake_base_url, OPENAI_API_KEY='fake')
+    # The fake server enforces no rate limits unless asked to, so neither does the backend
+    env.setdefault('UPSTREAM_RATE_LIMITS', 'off')
+    with tempfile.TemporaryDirectory() as state_dir:
+        if mode in SHARED_STATE_MODES:
+            env.update(STATE_BACKEND='sqlite', STATE_DB_PATH=os.path.join(state_dir, 'state.db'))
+        process = subprocess.Popen(SERVERS[mode](port), cwd=BASE_DIR, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            return asyncio.run(drive_fn(f"http://127.0.0.1:{port}"))
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+
+def main():
+    global WORKERS
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['flask', 'async'], choices=sorted(SERVERS))
+    parser.add_argument('--generations', type=int, default=32, help='concurrent /generate-image clients')
+    parser.add_argument('--pollers', type=int, default=16, help='concurrent /check-button-press + /health clients')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per mode')
+    parser.add_argument('--image-latency', type=float, default=2.0, help='fake DALL-E latency in seconds')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='processes in the *-workers modes')
+    parser.add_argument('--port', type=int, default=65520)
+    args = parser.parse_args()
+    WORKERS = args.workers
+
+    fake_server, fake_base_url = start_fake_openai(latency={'image': args.image_latency})
+    results = {
+        'config': vars(args),
+        'modes': {
+            mode: run_mode(mode, args.port + i, fake_base_url,
+                           lambda base_url: drive(base_url, args.generations, args.pollers, args.duration))
+            for i, mode in enumerate(args.modes)
+        }
+    }
+    fake_server.shutdown()
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Vision payload benchmark: upload size and end-to-end latency per VISION_IMAGE_PROFILES entry.
+
+Runs against fake_openai.py with a simulated uplink, so bigger payloads cost what they
+would on the exhibition network. 'original' is the behaviour before preprocessing
+(full PNG bytes, base64-encoded). Requires Pillow.
+
+    python bench_vision_payload.py --upload-mbps 20 --runs 5
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import statistics
+import time
+from io import BytesIO
+
+from PIL import Image, ImageFilter
+
+from fake_openai import start_fake_openai
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def dalle_like_png(seed=7):
+    """1024x1792 PNG with gradients and grain, roughly as hard to compress as a DALL-E render"""
+    rng = random.Random(seed)
+    image = Image.effect_noise((1024, 1792), 48).convert('RGB')
+    gradient = Image.linear_gradient('L').resize((1024, 1792))
+    tint = Image.merge('RGB', (gradient, gradient.rotate(90), Image.new('L', (1024, 1792), rng.randint(60, 200))))
+    image = Image.blend(image, tint, 0.7).filter(ImageFilter.GaussianBlur(0.6))
+    output = BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--upload-mbps', type=float, default=20.0)
+    parser.add_argument('--vision-latency', type=float, default=1.0)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    fake_server, base_url = start_fake_openai(latency={'vision': args.vision_latency}, upload_mbps=args.upload_mbps)
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ['OPENAI_API_KEY'] = 'fake'
+    import app  # after the environment points the client at the fake server
+
+    with open(os.path.join(BASE_DIR, 'CircleStart.png'), 'rb') as f:
+        images = {'CircleStart.png': f.read(), 'dalle-like 1024x1792': dalle_like_png()}
+
+    results = {'config': vars(args), 'images': {}}
+    for label, image_data in images.items():
+        digest = hashlib.sha256(image_data).hexdigest()
+        per_profile = {}
+        for profile in app.VISION_IMAGE_PROFILES:
+            latencies = []
+            prepare_ms = []
+            for _ in range(args.runs):
+                app.vision_payloads.clear()
+                started = time.perf_counter()
+                request_kwargs = app.vision_request_for(image_data, digest, profile)
+                prepared = time.perf_counter()
+                app.openai.chat.completions.create(**request_kwargs)
+                latencies.append(time.perf_counter() - started)
+                prepare_ms.append((prepared - started) * 1000)
+            body_bytes = len(json.dumps(request_kwargs))
+            per_profile[profile] = {
+                'request_body_bytes': body_bytes,
+                'prepare_ms': round(statistics.median(prepare_ms), 1),
+                'end_to_end_ms_p50': round(statistics.median(latencies) * 1000, 1),
+                'end_to_end_ms_max': round(max(latencies) * 1000, 1)
+            }
+        results['images'][label] = {'source_bytes': len(image_data), 'profiles': per_profile}
+
+    fake_server.shutdown()
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
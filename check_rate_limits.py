@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Deterministic check of app.py's upstream scheduler against fake_openai.py's rate limits.
+
+Scripted image requests go through a RateLimitScheduler on a virtual clock (time.monotonic
+is replaced while the checks run, so the minutes they cover take no time), and every
+granted request is offered to a fake server with the same limits at the moment it was
+granted. Checks that a cycle's two images go out together, that waiters are granted in
+priority order, that work which can't be served in time is shed, and that nothing the
+scheduler grants would get a 429, with dall-e-3 at its RATE_LIMITS entry. Exits 1 when
+a check fails.
+
+    python check_rate_limits.py
+"""
+
+import argparse
+import os
+import time
+
+from fake_openai import FakeOpenAIServer
+
+IMAGE_REQUEST = {'model': 'dall-e-3', 'prompt': 'a circle', 'n': 1, 'size': '1024x1792'}
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class Run:
+    """A scheduler and a fake server with the same limits, driven on the virtual clock"""
+
+    def __init__(self, core, clock, images_per_minute):
+        self.core = core
+        self.clock = clock
+        self.scheduler = core.RateLimitScheduler({'dall-e-3': (images_per_minute, None)})
+        self.server = FakeOpenAIServer(('127.0.0.1', 0), {'rate_limits': {'dall-e-3': [images_per_minute, None]}})
+        self.interval = 60 / images_per_minute
+        self.waiting = {}  # label -> ticket
+        self.granted = []  # (time, label) in grant order
+        self.shed = {}  # label -> reason
+        self.rejected = []  # granted labels the fake server answered with a 429
+
+    def close(self):
+        self.server.server_close()
+
+    def submit(self, label, priority):
+        """Queue an image request the way UpstreamClient does, with generate_image's deadline"""
+        deadline = self.core.upstream._queue_deadline('generate_image', self.clock.now + self.core.UPSTREAM_TIMEOUTS['generate_image'][1])
+        token = self.core.upstream_priority.set(priority)
+        try:
+            with self.scheduler.lock:
+                self.waiting[label] = self.scheduler._admit(IMAGE_REQUEST, deadline)
+        except self.core.UpstreamBusy as e:
+            self.shed[label] = str(e)
+        finally:
+            self.core.upstream_priority.reset(token)
+        self.poll()
+
+    def poll(self):
+        for label, ticket in list(self.waiting.items()):
+            try:
+                with self.scheduler.lock:
+                    granted = self.scheduler._check(ticket)
+            except self.core.UpstreamBusy as e:
+                del self.waiting[label]
+                self.shed[label] = str(e)
+                continue
+            if granted:
+                del self.waiting[label]
+                self.granted.append((self.clock.now, label))
+                if self.server.take_budget(ticket.model, ticket.cost) is not None:
+                    self.rejected.append(label)
+
+    def advance(self, seconds, step=0.25):
+        end = self.clock.now + seconds
+        while self.clock.now < end:
+            self.clock.now = min(end, self.clock.now + step)
+            self.poll()
+
+    def labels(self):
+        return [label for _, label in self.granted]
+
+    def spend_budget(self):
+        """Use up the requests that may go out at once"""
+        for index in range(int(self.scheduler.limiters['dall-e-3'].requests.capacity)):
+            self.submit(f'burst {index}', 'interactive')
+        return self.labels()
+
+def check_cycle_burst(run):
+    """Both images of a cycle go out at once on a fresh budget"""
+    start = run.clock.now
+    run.submit('image 1', 'interactive')
+    run.submit('image 2', 'interactive')
+    if [at - start for at, _ in run.granted] != [0.0, 0.0]:
+        return f"granted {run.granted}, expected both at once"
+
+def check_priority_order(run):
+    """Waiters go out most important first, speculative work that would wait too long is shed"""
+    burst = run.spend_budget()
+    run.submit('speculative', 'speculative')
+    run.submit('background', 'background')
+    run.submit('interactive', 'interactive')
+    run.advance(3 * run.interval)
+    problems = []
+    if run.labels() != burst + ['interactive', 'background']:
+        problems.append(f"grant order {run.labels()}")
+    if 'budget exhausted' not in run.shed.get('speculative', ''):
+        problems.append(f"speculative request not shed up front: {run.shed}")
+    return '; '.join(problems) or None
+
+def check_deadline_shedding(run):
+    """Requests that could not be granted before their deadline are shed up front, the rest are served"""
+    count = 12
+    for index in range(count):
+        run.submit(f'image {index}', 'interactive')
+    run.advance(count * run.interval)
+    capacity = run.scheduler.limiters['dall-e-3'].requests.capacity
+    deadline = run.core.UPSTREAM_TIMEOUTS['generate_image'][1] - run.core.UPSTREAM_TIMEOUTS['generate_image'][0] / 2
+    served = int(capacity) + int(deadline // run.interval)
+    if len(run.granted) != min(count, served) or len(run.shed) != count - len(run.granted) or run.waiting:
+        return f"{len(run.granted)} granted, {len(run.shed)} shed, expected {min(count, served)} granted"
+
+def check_throttled(run):
+    """A 429 upstream sheds the queued speculative work"""
+    run.spend_budget()
+    run.advance(run.interval - 2)
+    run.submit('speculative', 'speculative')
+    if 'speculative' not in run.waiting:
+        return f"speculative request not queued: {run.shed}"
+    run.scheduler.throttled(run.scheduler.limiters['dall-e-3'].queue[0][2], Exception('429'))
+    run.poll()
+    if 'throttled' not in run.shed.get('speculative', ''):
+        return f"speculative request not shed on a 429: {run.shed}"
+
+def check_sustained(run):
+    """Cycles arriving a little faster than the budget refills are all served, without a 429"""
+    cycles = 15
+    for index in range(cycles):
+        run.submit(f'cycle {index} image 1', 'interactive')
+        run.submit(f'cycle {index} image 2', 'interactive')
+        run.advance(2.2 * run.interval)
+    run.advance(5 * run.interval)
+    if len(run.granted) != 2 * cycles:
+        return f"{len(run.granted)} of {2 * cycles} images granted, shed: {run.shed}"
+
+CHECKS = [check_cycle_burst, check_priority_order, check_deadline_shedding, check_throttled, check_sustained]
+
+def main():
+    argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter).parse_args()
+
+    os.environ.setdefault('OPENAI_API_KEY', 'fake')
+    import app as core
+
+    images_per_minute = core.RATE_LIMITS['dall-e-3'][0]
+    clock = VirtualClock()
+    real_monotonic = time.monotonic
+    failed = 0
+    time.monotonic = clock
+    try:
+        for check in CHECKS:
+            run = Run(core, clock, images_per_minute)
+            try:
+                problem = check(run)
+            finally:
+                run.close()
+            if run.rejected:
+                problem = '; '.join(filter(None, [problem, f"fake server rejected {run.rejected}"]))
+            failed += bool(problem)
+            print(f"{'FAIL' if problem else 'ok'}  {check.__name__}: {problem or check.__doc__.splitlines()[0]}")
+    finally:
+        time.monotonic = real_monotonic
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
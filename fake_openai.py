@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenAI endpoints app.py uses, for benchmarks and offline runs.
+
+Answers /v1/chat/completions (text, vision and json_schema) and /v1/images/generations with
+canned responses after a configurable delay (as chat.completion.chunk events, spread
+over the delay, when the request asks for stream=True), and serves CircleStart.png as the
+"generated" image so follow-up vision analyses work. Latency jitter, error
+responses (429/5xx) and hung requests can be injected per request kind, and
+changed at runtime with POST /_fake/config; GET /_fake/stats counts requests.
+With rate_limits set ({model: [requests per minute, tokens per minute or null]}),
+requests over a model's budget get a 429 with Retry-After. Budgets hold a minute's
+worth and refill continuously, the way OpenAI's do. Point the backend at it with:
+
+    python fake_openai.py --port 65510 &
+    OPENAI_BASE_URL=http://127.0.0.1:65510/v1 OPENAI_API_KEY=fake python app.py
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_LATENCY = {
+    'chat': 0.8,
+    'vision': 1.5,
+    'image': 8.0
+}
+
+REQUEST_KINDS = tuple(DEFAULT_LATENCY)
+
+DEFAULT_CONFIG = {
+    'latency': DEFAULT_LATENCY,
+    'jitter': 0.0,  # each delay is drawn from latency * (1 +/- jitter)
+    'failure_rate': dict.fromkeys(REQUEST_KINDS, 0.0),
+    'failure_status': 500,
+    'hang_rate': dict.fromkeys(REQUEST_KINDS, 0.0),
+    'hang_seconds': 120.0,
+    'upload_bytes_per_second': None,
+    'first_token_share': 0.3,  # part of a streamed reply's delay spent before the first chunk
+    'rate_limits': {}  # model: [requests per minute, tokens per minute or None]
+}
+
+IMAGE_TOKENS = {'low': 85, 'high': 1105, 'auto': 1105}
+
+ERROR_TYPES = {
+    429: 'rate_limit_exceeded',
+    500: 'server_error',
+    502: 'server_error',
+    503: 'service_unavailable'
+}
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/_fake/stats':
+            self._send_json(200, self.server.snapshot_stats())
+            return
+        # Every generated image is CircleStart.png
+        with open(self.server.image_path, 'rb') as f:
+            payload = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        if self.path == '/_fake/config':
+            self._send_json(200, self.server.configure(body))
+            return
+
+        if self.path.endswith('/chat/completions'):
+            messages = body.get('messages', [])
+            kind = 'vision' if any(isinstance(m.get('content'), list) for m in messages) else 'chat'
+        elif self.path.endswith('/images/generations'):
+            kind = 'image'
+        else:
+            self._send_json(404, {'error': {'message': f'Unknown endpoint {self.path}', 'type': 'invalid_request_error'}})
+            return
+
+        model = body.get('model', 'dall-e-3' if kind == 'image' else 'gpt-4-turbo')
+        prompt_tokens = request_tokens(body) if kind != 'image' else 0
+        retry_after = self.server.take_budget(model, prompt_tokens + (body.get('max_tokens') or 0) if kind != 'image' else 0)
+        if retry_after is not None:
+            self._send_json(429, {'error': {
+                'message': f'Rate limit reached for {model} on the fake OpenAI server',
+                'type': 'requests',
+                'code': 'rate_limit_exceeded'
+            }}, {'Retry-After': f'{retry_after:.2f}'})
+            return
+
+        stream = bool(body.get('stream')) and kind != 'image'
+        error_status, remaining = self.server.simulate(kind, length, stream)
+        if error_status:
+            error_type = ERROR_TYPES.get(error_status, 'server_error')
+            self._send_json(error_status, {'error': {
+                'message': f'Injected {error_status} from the fake OpenAI server',
+                'type': error_type,
+                'code': error_type
+            }})
+            return
+
+        serial = self.server.next_serial()
+        if kind == 'image':
+            self._send_json(200, {
+                'created': int(time.time()),
+                'data': [{'url': f"{self.server.public_url}/images/generated-{serial}.png", 'revised_prompt': body.get('prompt', '')[:200]}]
+            })
+        else:
+            schema = ((body.get('response_format') or {}).get('json_schema') or {}).get('schema')
+            reply = structured_reply(schema, serial) if schema else reply_for(messages, kind, serial)
+            if stream:
+                self._send_stream(model, reply, remaining)
+            else:
+                self._send_json(200, chat_completion(model, reply, prompt_tokens))
+
+    def _send_stream(self, model, content, duration):
+        """Server-sent chunks of content, a word at a time, spread over duration seconds"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        # No length or chunked encoding: the end of the stream is the end of the connection
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        words = content.split(' ')
+        for index, word in enumerate(words):
+            if index:
+                time.sleep(duration / len(words))
+            delta = word if index == len(words) - 1 else word + ' '
+            self.wfile.write(f"data: {json.dumps(chat_completion_chunk(model, delta))}\n\n".encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(f"data: {json.dumps(chat_completion_chunk(model, None, 'stop'))}\n\ndata: [DONE]\n\n".encode('utf-8'))
+        self.wfile.flush()
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config=None):
+        super().__init__(address, FakeOpenAIHandler)
+        self.lock = threading.Lock()
+        self.config = copy.deepcopy(DEFAULT_CONFIG)
+        self.budgets = {}  # model -> (requests left, tokens left, monotonic time of the last update)
+        self.configure(config)
+        self.stats = Counter()
+        self.serial = itertools.count(1)
+        self.public_url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CircleStart.png')
+
+    def configure(self, changes):
+        """Merge changes into the config (per-kind settings are merged key by key)"""
+        with self.lock:
+            for key, value in (changes or {}).items():
+                if isinstance(self.config.get(key), dict) and isinstance(value, dict):
+                    self.config[key].update(value)
+                else:
+                    self.config[key] = value
+            if 'rate_limits' in (changes or {}):
+                self.budgets.clear()
+            return copy.deepcopy(self.config)
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on a slow or hung request are expected here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def snapshot_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def next_serial(self):
+        with self.lock:
+            return next(self.serial)
+
+    def take_budget(self, model, tokens):
+        """Count a request against its model's limits; returns None when it fits, else the
+        seconds until enough of the budget has refilled"""
+        with self.lock:
+            limits = self.config['rate_limits'].get(model)
+            if not limits:
+                return None
+            requests_per_minute, tokens_per_minute = limits
+            now = time.monotonic()
+            requests_left, tokens_left, updated = self.budgets.get(model, (requests_per_minute, tokens_per_minute or 0, now))
+            requests_left = min(requests_per_minute, requests_left + (now - updated) * requests_per_minute / 60)
+            wait_time = (1 - requests_left) * 60 / requests_per_minute
+            if tokens_per_minute:
+                tokens = min(tokens, tokens_per_minute)
+                tokens_left = min(tokens_per_minute, tokens_left + (now - updated) * tokens_per_minute / 60)
+                wait_time = max(wait_time, (tokens - tokens_left) * 60 / tokens_per_minute)
+            if wait_time > 1e-6:  # not float rounding in the refill
+                self.budgets[model] = (requests_left, tokens_left, now)
+                self.stats[f'{model}_rate_limited'] += 1
+                return max(0.01, wait_time)
+            self.budgets[model] = (requests_left - 1, tokens_left - (tokens if tokens_per_minute else 0), now)
+            return None
+
+    def simulate(self, kind, request_bytes, stream=False):
+        """Sleep like the real endpoint would until its first byte; returns (HTTP status to fail
+        with or None, seconds left to spread over a streamed reply)"""
+        with self.lock:
+            config = self.config
+            self.stats[kind] += 1
+            jitter = config['jitter']
+            delay = config['latency'][kind] * random.uniform(1 - jitter, 1 + jitter)
+            if config['upload_bytes_per_second']:
+                # Simulate the uplink: bigger request bodies (vision payloads) take longer
+                delay += request_bytes / config['upload_bytes_per_second']
+            status = None
+            first_byte = delay * config['first_token_share'] if stream else delay
+            if random.random() < config['hang_rate'][kind]:
+                self.stats[f'{kind}_hung'] += 1
+                first_byte = config['hang_seconds']
+            elif random.random() < config['failure_rate'][kind]:
+                self.stats[f'{kind}_failed'] += 1
+                status = config['failure_status']
+            if stream:
+                self.stats[f'{kind}_streamed'] += 1
+        time.sleep(max(0.0, first_byte))
+        return status, max(0.0, delay - first_byte)
+
+def reply_for(messages, kind, serial):
+    if kind == 'vision':
+        return "A single solid circle centered on a plain light background, flat colors, clean edges, minimal style."
+    system = messages[0].get('content', '') if messages else ''
+    # Replies carry a serial so concurrent kiosks don't end up with identical
+    # prompts, which the single-flight layer would collapse into one upstream call
+    if 'VARIANT' in system:
+        return (
+            f"Shift the circle's fill towards a warmer orange and soften its edge slightly (#{serial}).\n"
+            "---VARIANT---\n"
+            f"Add a faint vertical gradient to the background, darker at the bottom (#{serial})."
+        )
+    if 'summarizer' in system:
+        return f"Warmed the circle to orange and softened its edge (#{serial})."
+    return "Subtle warmth suits this visitor's taste for calm, minimal shapes."
+
+def structured_reply(schema, serial):
+    """JSON answer for a json_schema response format (the variant_batch schema app.py sends)"""
+    properties = schema.get('properties', {})
+    count = properties.get('variants', {}).get('maxItems', 2)
+    reply = {'variants': [
+        {
+            'text': f"Shift the circle's fill towards a warmer tone and soften its edge, take {index + 1} (#{serial}).",
+            'summary': f"Warmed the circle and softened its edge, take {index + 1} (#{serial})."
+        } for index in range(count)
+    ]}
+    if 'reflection' in properties:
+        reply['reflection'] = "Subtle warmth suits this visitor's taste for calm, minimal shapes."
+    return json.dumps(reply)
+
+def request_tokens(body):
+    """Prompt tokens of a chat request, counted roughly: four characters a token, images by detail"""
+    characters = 0
+    tokens = 0
+    for message in body.get('messages', []):
+        content = message.get('content') or ''
+        tokens += 4
+        if isinstance(content, str):
+            characters += len(content)
+            continue
+        for part in content:
+            if part.get('type') == 'text':
+                characters += len(part['text'])
+            elif part.get('type') == 'image_url':
+                tokens += IMAGE_TOKENS.get(part['image_url'].get('detail', 'auto'), IMAGE_TOKENS['auto'])
+    return tokens + characters // 4
+
+def chat_completion(model, content, prompt_tokens=0):
+    return {
+        'id': 'chatcmpl-fake',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop'
+        }],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': len(content) // 4,
+            'total_tokens': prompt_tokens + len(content) // 4
+        }
+    }
+
+def chat_completion_chunk(model, content, finish_reason=None):
+    return {
+        'id': 'chatcmpl-fake',
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'delta': {'content': content} if content is not None else {},
+            'finish_reason': finish_reason
+        }]
+    }
+
+def parse_rate_limits(items):
+    """['model=rpm/tpm', ...] -> the rate_limits config"""
+    limits = {}
+    for item in items:
+        model, _, values = item.partition('=')
+        rpm, _, tpm = values.partition('/')
+        limits[model] = [float(rpm), float(tpm) if tpm else None]
+    return limits
+
+def start_fake_openai(port=0, latency=None, upload_mbps=None, **config):
+    """Start the fake server in a daemon thread; returns (server, base_url).
+    Extra keyword arguments override DEFAULT_CONFIG entries (jitter, failure_rate, ...)."""
+    config['latency'] = latency or {}
+    if upload_mbps:
+        config['upload_bytes_per_second'] = upload_mbps * 1_000_000 / 8
+    server = FakeOpenAIServer(('127.0.0.1', port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{server.public_url}/v1"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=65510)
+    parser.add_argument('--chat-latency', type=float, default=DEFAULT_LATENCY['chat'])
+    parser.add_argument('--vision-latency', type=float, default=DEFAULT_LATENCY['vision'])
+    parser.add_argument('--image-latency', type=float, default=DEFAULT_LATENCY['image'])
+    parser.add_argument('--jitter', type=float, default=0.0, help='relative latency jitter, e.g. 0.3 for +/-30%%')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests answered with --failure-status')
+    parser.add_argument('--failure-status', type=int, default=500, choices=sorted(ERROR_TYPES))
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='fraction of requests that stall for --hang-seconds')
+    parser.add_argument('--hang-seconds', type=float, default=120.0)
+    parser.add_argument('--upload-mbps', type=float, default=None, help='simulated uplink bandwidth for request bodies')
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='MODEL=RPM[/TPM]',
+                        help='enforce a per-model limit with 429s, e.g. dall-e-3=5 or gpt-4o=500/30000')
+    args = parser.parse_args()
+
+    server, base_url = start_fake_openai(
+        args.port,
+        {'chat': args.chat_latency, 'vision': args.vision_latency, 'image': args.image_latency},
+        args.upload_mbps,
+        jitter=args.jitter,
+        failure_rate=dict.fromkeys(REQUEST_KINDS, args.failure_rate),
+        failure_status=args.failure_status,
+        hang_rate=dict.fromkeys(REQUEST_KINDS, args.hang_rate),
+        hang_seconds=args.hang_seconds,
+        rate_limits=parse_rate_limits(args.rate_limit)
+    )
+    print(f"Fake OpenAI listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""Timing metrics (served on /metrics) and the rate-limited kiosk logger"""
+
+import bisect
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+# Hot-path instrumentation: timing spans aggregated into Prometheus-style histograms,
+# served on /metrics. Stages: image_fetch, base64_encode, vision_preprocess, openai, json_io.
+METRICS_PREFIX = 'kiosk'
+METRICS_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_metric_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metrics:
+    """Thread-safe histograms and counters keyed by metric name and label values"""
+
+    def __init__(self, buckets=METRICS_BUCKETS, prefix=METRICS_PREFIX):
+        self.buckets = buckets
+        self.prefix = prefix
+        self.lock = Lock()
+        self.histograms = {}  # (name, labels) -> [per-bucket counts..., +Inf count]
+        self.sums = defaultdict(float)
+        self.counters = defaultdict(float)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            self.sums[key] += seconds
+
+    def inc(self, name, amount=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """Time the enclosed block into stage_seconds{stage=..., outcome=ok|error}"""
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            yield
+        except BaseException:
+            outcome = 'error'
+            raise
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started, stage=stage, outcome=outcome, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{escape_label_value(value)}"' for key, value in pairs) + '}'
+
+    def render(self, gauges=()):
+        """Prometheus text exposition; gauges is an iterable of (name, labels dict, value)"""
+        with self.lock:
+            histograms = {key: list(counts) for key, counts in self.histograms.items()}
+            sums = dict(self.sums)
+            counters = dict(self.counters)
+
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), counts in sorted(histograms.items()):
+            full_name = f"{self.prefix}_{name}"
+            declare(full_name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{full_name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{full_name}_sum{self._labels(labels)} {sums[(name, labels)]:.6f}")
+            lines.append(f"{full_name}_count{self._labels(labels)} {cumulative}")
+        for (name, labels), value in sorted(counters.items()):
+            full_name = f"{self.prefix}_{name}"
+            declare(full_name, 'counter')
+            lines.append(f"{full_name}{self._labels(labels)} {format_metric_value(value)}")
+        for name, labels, value in gauges:
+            full_name = f"{self.prefix}_{name}"
+            declare(full_name, 'gauge')
+            lines.append(f"{full_name}{self._labels(sorted(labels.items()))} {format_metric_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class TimedLock:
+    """threading.Lock that records how long acquirers waited in lock_wait_seconds{lock=name}.
+    Works as the underlying lock of a Condition."""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            metrics.observe('lock_wait_seconds', 0.0, lock=self.name)
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        metrics.observe('lock_wait_seconds', time.perf_counter() - started, lock=self.name)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+# Leveled logging instead of debug prints. Per call site, at most LOG_RATE_LIMIT records
+# are written per LOG_RATE_WINDOW; the rest are counted and reported with the next one.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_RATE_LIMIT = 20
+LOG_RATE_WINDOW = 10.0  # seconds
+
+class RateLimitFilter(logging.Filter):
+    """Drops records from a call site that already logged `limit` times in the current window"""
+
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.lock = Lock()
+        self.sites = {}  # (pathname, lineno) -> [window start, emitted, suppressed]
+
+    def filter(self, record):
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            state = self.sites.get(site)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                state = self.sites[site] = [now, 0, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+            if state[1] >= self.limit:
+                state[2] += 1
+                metrics.inc('log_suppressed_total', level=record.levelname.lower())
+                return False
+            state[1] += 1
+            return True
+
+def make_logger(name='kiosk'):
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        handler.addFilter(RateLimitFilter())
+        logger.addHandler(handler)
+        logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+        logger.propagate = False
+    return logger
+
+log = make_logger()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Precompute the first levels of the choice tree into the variant pool (variant_pool.json).
+
+Starting from CircleStart.png and the default prompt, generates each round the way
+/generate-cycle does (one batched completion for variants, summaries and reflection,
+then an image per variant) and follows both winners down to --depth levels. Images
+are mirrored into the image store and pinned there, so the backend can answer these
+rounds instantly on a cold start and serve them as a fallback while OpenAI is down.
+Rounds already in the pool are skipped, so an interrupted run can simply be restarted.
+Its OpenAI calls are scheduled as background work under app.py's rate limits, queueing for
+budget rather than being shed (a budget of its own: lower UPSTREAM_RATE_LIMITS while a
+backend is serving on the same account).
+Run it with the same OPENAI_* environment as the backend, then restart the backend:
+
+    python precompute_pool.py --depth 3
+    OPENAI_BASE_URL=http://127.0.0.1:65510/v1 OPENAI_API_KEY=fake python precompute_pool.py --depth 2
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import app as core
+
+log = core.log
+
+def precompute_round(prompt, history, image_url):
+    """Generate the round starting at image_url and store it; returns the pool entry"""
+    image = core.pool_image_key(image_url)
+    entry = core.variant_pool.get(image_url)
+    if entry is not None:
+        log.info("Pool already has the round for %s, skipping", image)
+        return entry
+
+    batch = core.propose_variant_batch(prompt, history, image_url, with_reflection=True)
+    images = []
+    summaries = []
+    for variant_text, summary in zip(batch['variants'], batch['summaries']):
+        random_instruction = core.get_random_instruction()
+        # '/' as the public base URL stores the mirrored image as a host-independent /images/<name>
+        result = core.render_variant_image(variant_text, image_url, random_instruction, '/')
+        if core.image_store.path_for_url(result['modifiedImageUrl']) is None:
+            raise RuntimeError(f"Could not mirror the image for {image}, refusing to pool a remote URL")
+        images.append(result)
+        summaries.append(core.summary_result(summary, random_instruction or ''))
+
+    entry = {
+        'image': image,
+        'prompt': prompt,
+        'history': history,
+        'variants': batch['variants'],
+        'variants_debug_info': batch['debug_info'],
+        'images': images,
+        'summaries': summaries,
+        'reflection': batch['reflection']
+    }
+    core.variant_pool.put(entry)
+    log.info("Pooled the round for %s", image)
+    return entry
+
+def children(entry):
+    """The rounds that follow either winner, the way script.js continues after a vote"""
+    history = entry['history']
+    return [
+        (summary['summary'], history + [summary['summary']], image['modifiedImageUrl'])
+        for image, summary in zip(entry['images'], entry['summaries'])
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depth', type=int, default=3, help='tree levels to precompute (1 is just the first round)')
+    parser.add_argument('--workers', type=int, default=4, help='rounds generated concurrently')
+    args = parser.parse_args()
+
+    if not core.variant_pool.path:
+        parser.error("VARIANT_POOL_PATH is disabled in app.py")
+
+    level = [(core.POOL_START_PROMPT, [], core.POOL_START_IMAGE)]
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for depth in range(1, args.depth + 1):
+            # Entries are keyed by image, so branches that landed on the same image share a round
+            level = list({core.pool_image_key(node[2]): node for node in level}.values())
+            futures = [executor.submit(core.with_priority, 'background', precompute_round, *node) for node in level]
+            level = []
+            for future in futures:
+                try:
+                    level.extend(children(future.result()))
+                except Exception as e:
+                    # The subtree below a failed round is skipped; rerun to fill it in
+                    log.error("Error precomputing a round: %s", e)
+                    failed += 1
+            log.info("Level %d done, %d rounds pooled", depth, core.variant_pool.stats()['entries'])
+
+    log.info("Variant pool: %s (%d round(s) failed)", core.variant_pool.stats(), failed)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
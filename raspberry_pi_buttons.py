@@ -2,105 +2,231 @@
 """
 Script per Raspberry Pi che gestisce i button fisici e comunica con l'app Flask.
 Questo script deve essere eseguito sul Raspberry Pi.
+
+I callback GPIO si limitano a mettere in coda la pressione con il suo timestamp:
+un thread separato invia le pressioni a gruppi a /physical-button-presses, ritenta
+con backoff quando la rete o l'app non rispondono e salva su disco quelle non
+ancora inviate, così un riavvio del Pi non perde i voti.
 """
 
 import RPi.GPIO as GPIO
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import json
-from threading import Thread
+import os
+import signal
+import uuid
+from threading import Thread, Condition, Event
 
 # Configurazione GPIO
 BUTTON_1_PIN = 18  # GPIO 18 per "Choose Variant 1"
 BUTTON_2_PIN = 19  # GPIO 19 per "Choose Variant 2"
+BUTTONS = {BUTTON_1_PIN: 1, BUTTON_2_PIN: 2}
 
 # URL dell'applicazione Flask (modifica con l'IP del computer che esegue l'app)
 FLASK_APP_URL = "http://144.178.100.238:65500"  # Sostituisci con l'IP corretto
 
+# Timeout (connessione, lettura) in secondi: lo usa solo il thread di invio, mai i callback
+REQUEST_TIMEOUT = (1.5, 3)
+
+# Coda locale delle pressioni non ancora confermate dall'app
+QUEUE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'button_queue.json')
+QUEUE_MAX_EVENTS = 1000  # oltre, si scartano le pressioni più vecchie
+EVENT_MAX_AGE = 300  # secondi: un voto più vecchio appartiene a un altro round, non lo inviamo
+SEND_BATCH_MAX = 50  # pressioni per richiesta (l'app ne accetta fino a 100)
+RETRY_DELAY = 0.5  # primo ritardo dopo un invio fallito, poi raddoppia
+RETRY_DELAY_MAX = 10.0
+
+class PressQueue:
+    """Pressioni in attesa di invio, in memoria e su disco (file temporaneo, fsync, rename)"""
+
+    def __init__(self, path=QUEUE_PATH, max_events=QUEUE_MAX_EVENTS):
+        self.path = path
+        self.max_events = max_events
+        self.changed = Condition()
+        self.events = self.load()
+        self.dirty = False  # pressioni arrivate dopo l'ultimo salvataggio
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                events = json.load(f).get('events', [])
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            print(f"Coda locale illeggibile, si riparte vuoti: {e}")
+            return []
+        if events:
+            print(f"Recuperate {len(events)} pressioni non inviate da {self.path}")
+        return events
+
+    def put(self, event):
+        """Chiamato dai callback GPIO: nessun I/O, solo memoria"""
+        with self.changed:
+            self.events.append(event)
+            if len(self.events) > self.max_events:
+                del self.events[0]
+            self.dirty = True
+            self.changed.notify()
+
+    def wait_batch(self, limit, timeout):
+        """Le prime `limit` pressioni in coda, aspettando fino a timeout secondi se è vuota"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.events, timeout=timeout)
+            return list(self.events[:limit])
+
+    def drop_stale(self, max_age):
+        """Scarta le pressioni troppo vecchie; restituisce quante"""
+        cutoff = time.time() - max_age
+        with self.changed:
+            fresh = [event for event in self.events if event['timestamp'] >= cutoff]
+            dropped = len(self.events) - len(fresh)
+            if dropped:
+                self.events = fresh
+                self.dirty = True
+            return dropped
+
+    def ack(self, batch):
+        """Toglie dalla coda le pressioni confermate dall'app"""
+        sent = {event['id'] for event in batch}
+        with self.changed:
+            self.events = [event for event in self.events if event['id'] not in sent]
+            self.dirty = True
+
+    def save(self):
+        """Scrive la coda su disco se è cambiata"""
+        with self.changed:
+            if not self.dirty:
+                return
+            payload = json.dumps({'events': self.events})
+            self.dirty = False
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Errore nel salvataggio della coda locale: {e}")
+            with self.changed:
+                self.dirty = True
+
 class PhysicalButtonController:
     def __init__(self):
-        self.setup_gpio()
-        self.button_pressed = False
-        self.last_press_time = 0
+        self.session = self.create_session()
+        self.queue = PressQueue()
+        self.stop_event = Event()
+        self.sender = Thread(target=self.send_loop, name='button-sender', daemon=True)
+        # Debounce per button: una pressione su 1 non nasconde una pressione su 2
+        self.last_press_time = dict.fromkeys(BUTTONS.values(), 0)
         self.debounce_time = 0.3  # 300ms debounce
-        
+        self.setup_gpio()
+
+    def create_session(self):
+        """Sessione HTTP condivisa: connessione keep-alive riutilizzata per ogni invio"""
+        session = requests.Session()
+        # Un solo host (l'app Flask) e un solo thread di invio: basta una connessione
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
     def setup_gpio(self):
         """Configura i pin GPIO"""
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
-        
+
         # Configura button con pull-down interno (no resistenze esterne necessarie!)
-        GPIO.setup(BUTTON_1_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        GPIO.setup(BUTTON_2_PIN, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        
-        # Callback per interrupt sui button
-        GPIO.add_event_detect(BUTTON_1_PIN, GPIO.RISING, 
-                             callback=self.button_1_callback, bouncetime=300)
-        GPIO.add_event_detect(BUTTON_2_PIN, GPIO.RISING, 
-                             callback=self.button_2_callback, bouncetime=300)
-        
+        # e callback per interrupt sui button
+        for pin in BUTTONS:
+            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+            GPIO.add_event_detect(pin, GPIO.RISING, callback=self.button_callback, bouncetime=300)
+
         print("GPIO configurato. Button 1: GPIO 18, Button 2: GPIO 19")
-        
-    def button_1_callback(self, channel):
-        """Callback per button 1 (Choose Variant 1)"""
-        current_time = time.time()
-        if current_time - self.last_press_time > self.debounce_time:
-            self.last_press_time = current_time
-            print("Button 1 premuto - Choose Variant 1")
-            self.send_button_press(1)
-            
-    def button_2_callback(self, channel):
-        """Callback per button 2 (Choose Variant 2)"""
+
+    def button_callback(self, channel):
+        """Callback per entrambi i button: mette in coda la pressione e ritorna subito"""
         current_time = time.time()
-        if current_time - self.last_press_time > self.debounce_time:
-            self.last_press_time = current_time
-            print("Button 2 premuto - Choose Variant 2")
-            self.send_button_press(2)
-            
-    def send_button_press(self, button_number):
-        """Invia la pressione del button all'app Flask"""
-        try:
-            url = f"{FLASK_APP_URL}/physical-button-press"
-            data = {
-                'button': button_number,
-                'timestamp': time.time()
-            }
-            
-            response = requests.post(url, json=data, timeout=5)
-            if response.status_code == 200:
-                print(f"Button {button_number} signal inviato con successo")
+        button_number = BUTTONS[channel]
+        if current_time - self.last_press_time[button_number] > self.debounce_time:
+            self.last_press_time[button_number] = current_time
+            self.queue.put({'id': uuid.uuid4().hex, 'button': button_number, 'timestamp': current_time})
+            print(f"Button {button_number} premuto - Choose Variant {button_number}")
+
+    def send_loop(self):
+        """Thread di invio: salva la coda, invia un gruppo di pressioni, ritenta con backoff"""
+        delay = RETRY_DELAY
+        while not self.stop_event.is_set():
+            batch = self.queue.wait_batch(SEND_BATCH_MAX, timeout=1.0)
+            dropped = self.queue.drop_stale(EVENT_MAX_AGE)
+            if dropped:
+                print(f"Scartate {dropped} pressioni più vecchie di {EVENT_MAX_AGE}s")
+                continue
+            # Prima su disco, poi in rete: se il Pi si spegne durante l'invio le pressioni restano
+            self.queue.save()
+            if not batch:
+                continue
+            if self.send_batch(batch):
+                self.queue.ack(batch)
+                self.queue.save()
+                delay = RETRY_DELAY
             else:
-                print(f"Errore nell'invio: Status {response.status_code}")
-                
+                self.stop_event.wait(delay)
+                delay = min(delay * 2, RETRY_DELAY_MAX)
+
+    def send_batch(self, batch):
+        """Invia un gruppo di pressioni all'app Flask; True se vanno tolte dalla coda"""
+        try:
+            url = f"{FLASK_APP_URL}/physical-button-presses"
+            # sent_at permette all'app di correggere i timestamp se l'orologio del Pi (senza RTC né NTP) è sfasato
+            response = self.session.post(url, json={'presses': batch, 'sent_at': time.time()}, timeout=REQUEST_TIMEOUT)
         except requests.exceptions.RequestException as e:
-            print(f"Errore di connessione: {e}")
-            
+            print(f"Errore di connessione ({len(batch)} pressioni in coda): {e}")
+            return False
+        if response.status_code == 200:
+            print(f"{len(batch)} pressioni inviate con successo")
+            return True
+        if response.status_code == 400:
+            # Richiesta malformata: ritentare non servirebbe e bloccherebbe la coda
+            print(f"Pressioni rifiutate dall'app, scartate: {response.text}")
+            return True
+        print(f"Errore nell'invio: Status {response.status_code}")
+        return False
+
     def cleanup(self):
-        """Pulizia GPIO"""
+        """Ferma il thread di invio, salva la coda, pulizia GPIO e chiusura della sessione HTTP"""
+        self.stop_event.set()
+        if self.sender.is_alive():
+            self.sender.join(timeout=REQUEST_TIMEOUT[0] + REQUEST_TIMEOUT[1] + 1)
+        self.queue.save()
         GPIO.cleanup()
-        
+        self.session.close()
+
     def run(self):
-        """Loop principale"""
+        """Avvia il thread di invio e resta in attesa fino a Ctrl+C o SIGTERM"""
         print("Controller button fisici avviato...")
         print(f"Connessione verso: {FLASK_APP_URL}")
         print("Premi Ctrl+C per terminare")
-        
+
+        # systemd ferma il servizio con SIGTERM: stessa uscita pulita di Ctrl+C
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_event.set())
         try:
             # Heartbeat per verificare connessione
             self.check_connection()
-            
-            while True:
-                time.sleep(0.1)  # Loop principale leggero
-                
+            self.sender.start()
+            # Nessun polling: il thread principale dorme finché non è ora di uscire
+            self.stop_event.wait()
         except KeyboardInterrupt:
             print("\nSpegnimento...")
         finally:
             self.cleanup()
-            
+
     def check_connection(self):
         """Verifica la connessione con l'app Flask"""
         try:
-            response = requests.get(f"{FLASK_APP_URL}/health", timeout=5)
+            response = self.session.get(f"{FLASK_APP_URL}/health", timeout=REQUEST_TIMEOUT)
             if response.status_code == 200:
                 print("✓ Connessione con l'app Flask stabilita")
             else:
@@ -111,4 +237,4 @@ class PhysicalButtonController:
 
 if __name__ == "__main__":
     controller = PhysicalButtonController()
-    controller.run()
\ No newline at end of file
+    controller.run()
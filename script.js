@@ -37,6 +37,138 @@ if (!API_BASE) {
 }
 console.log('Using API_BASE =', API_BASE);
 
+// Shared kiosk session on the backend (?session= picks one, for several exhibits on one server).
+// The backend is the source of truth for history and the current round; localStorage is a local cache.
+const SESSION_ID = getQueryParam('session') || 'default';
+let sessionSynced = false;
+
+// Generation requests name the session, so the backend reads the history from it and keeps
+// the round's results there; the history is only uploaded while the session isn't in sync
+function withSession(body) {
+    return sessionSynced ? { ...body, sessionId: SESSION_ID } : { ...body, sessionId: SESSION_ID, history };
+}
+
+async function pushSessionDelta(delta, retry = true) {
+    try {
+        const response = await fetch(`${API_BASE}/session/${SESSION_ID}`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(delta)
+        });
+        if (response.status === 409) {
+            // The server has less history than this kiosk assumed (an earlier push failed, or the
+            // session was reset elsewhere): append the new choices on top of what it has, then
+            // take the server's state, which now includes them
+            const conflict = await response.json().catch(() => ({}));
+            if (retry && Number.isInteger(conflict.history_length)) {
+                console.warn(`⚠️ Session has ${conflict.history_length} choices, not ${delta.history_length}; appending on top`);
+                const result = await pushSessionDelta({ ...delta, history_length: conflict.history_length }, false);
+                if (result !== null) await syncSessionState();
+                return result;
+            }
+            // Keep the local history (it is uploaded with the next requests) rather than drop the choice
+            showSessionConflict(conflict.error || 'Session changed elsewhere');
+            sessionSynced = false;
+            return null;
+        }
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        return await response.json();
+    } catch (error) {
+        console.warn('⚠️ Could not update the shared session:', error.message);
+        sessionSynced = false;
+        return null;
+    }
+}
+
+function showSessionConflict(message) {
+    console.warn('⚠️ Could not record the choice in the shared session:', message);
+    const conflictDiv = document.getElementById('session-conflict') || document.createElement('div');
+    conflictDiv.id = 'session-conflict';
+    conflictDiv.style.cssText = `
+        margin-top: 15px;
+        padding: 8px 12px;
+        border-radius: 6px;
+        font-size: 0.9em;
+        text-align: center;
+        background: #fff3cd;
+        color: #856404;
+    `;
+    conflictDiv.textContent = `⚠️ The shared session changed elsewhere; this choice is only kept on this screen (${message})`;
+    const card = document.querySelector('.start-card');
+    if (card && !conflictDiv.parentNode) card.appendChild(conflictDiv);
+    setTimeout(() => conflictDiv.remove(), 8000);
+}
+
+// Adopt the server's session, or seed it from this browser's localStorage the first time
+async function syncSessionState() {
+    try {
+        const response = await fetch(`${API_BASE}/session/${SESSION_ID}`);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const session = await response.json();
+        if (session.history_length > 0 || session.current_image) {
+            history = session.history;
+            localStorage.setItem('history', JSON.stringify(history));
+            if (session.current_image) {
+                localStorage.setItem('current_image', session.current_image);
+                document.getElementById('main-image').src = session.current_image;
+            }
+            if (session.current_prompt) localStorage.setItem('current_image_prompt', session.current_prompt);
+            sessionSynced = true;
+        } else if (history.length > 0) {
+            sessionSynced = (await pushSessionDelta({
+                history_append: history,
+                history_length: 0,
+                set: {
+                    current_image: localStorage.getItem('current_image'),
+                    current_prompt: localStorage.getItem('current_image_prompt')
+                }
+            })) !== null;
+        } else {
+            sessionSynced = true;
+        }
+        console.log(`Session ${SESSION_ID}: ${history.length} choices, synced=${sessionSynced}`);
+    } catch (error) {
+        console.warn('⚠️ Session unavailable, using local state:', error.message);
+        sessionSynced = false;
+    }
+}
+
+// Rebuild the prompt history of the current run from the server's iteration archive,
+// for a kiosk whose localStorage was cleared or that joins a session started elsewhere
+async function restorePromptHistory() {
+    if (promptHistory.length > 0) return;
+    try {
+        let after = 0;
+        const entries = [];
+        while (after !== null) {
+            const response = await fetch(`${API_BASE}/archive/${SESSION_ID}/replay?after=${after}`);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const page = await response.json();
+            page.iterations.forEach(iteration => {
+                iteration.images.forEach((url, i) => entries.push({
+                    timestamp: new Date(iteration.created_at * 1000).toLocaleString(),
+                    type: 'DALL-E Image Generation',
+                    data: {
+                        final_prompt_sent_to_dalle: iteration.final_prompts[i],
+                        generated_image_url: url,
+                        variant_text: iteration.variants[i]
+                    }
+                }));
+            });
+            after = page.next;
+        }
+        // Generation may have added entries while we were fetching
+        if (entries.length === 0 || promptHistory.length > 0) return;
+        promptHistory = entries;
+        localStorage.setItem('prompt_history', JSON.stringify(promptHistory));
+        document.getElementById('prompt-history').style.display = 'block';
+        updatePromptHistoryDisplay();
+        console.log(`Restored ${entries.length / 2} iterations from the archive`);
+    } catch (error) {
+        console.warn('⚠️ Could not restore the prompt history:', error.message);
+    }
+}
+
 // Test connection to backend on load
 async function testBackendConnection() {
     try {
@@ -57,6 +189,8 @@ async function testBackendConnection() {
 // Physical buttons state
 let physicalButtonsEnabled = false;
 let buttonCheckInterval = null;
+let buttonEventSource = null;
+let lastButtonSeq = null; // Cursor into the backend button event log
 let currentVariants = null;
 
 // Voting system state - load from localStorage or default to 0
@@ -64,6 +198,103 @@ let variant1Votes = parseInt(localStorage.getItem('variant1Votes') || '0');
 let variant2Votes = parseInt(localStorage.getItem('variant2Votes') || '0');
 const VOTES_TO_WIN = 3;
 
+// Server-side ballot for the round on display: the backend counts kiosk clicks and physical
+// presses, this page only follows the tally. null while votes are counted locally instead.
+let ballot = null;
+let ballotFollowing = false;
+let ballotWinnerHandled = null; // ballot number whose winner was already selected
+
+async function openBallot() {
+    try {
+        const response = await fetch(`${API_BASE}/votes/${SESSION_ID}/ballot`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            // Keyed by the round's images: a reload or another kiosk joins the same ballot
+            body: JSON.stringify({
+                key: `${localStorage.getItem('variant1_img')}|${localStorage.getItem('variant2_img')}`,
+                votes_to_win: VOTES_TO_WIN
+            })
+        });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        ballot = null;
+        applyBallot(await response.json());
+        followBallot();
+        return true;
+    } catch (error) {
+        console.warn('⚠️ Server-side voting unavailable, counting votes locally:', error.message);
+        ballot = null;
+        return false;
+    }
+}
+
+// Adopt a tally from the backend: counts, vote animations and the winner
+function applyBallot(state) {
+    const previous = ballot && ballot.ballot === state.ballot ? ballot : null;
+    ballot = state;
+    [1, 2].forEach((variantNumber) => {
+        if (previous && state.counts[variantNumber] > previous.counts[variantNumber]) {
+            triggerVoteAnimation(variantNumber);
+        }
+    });
+    variant1Votes = state.counts['1'];
+    variant2Votes = state.counts['2'];
+    localStorage.setItem('variant1Votes', variant1Votes.toString());
+    localStorage.setItem('variant2Votes', variant2Votes.toString());
+    updatePhysicalButtonDisplay();
+
+    if (state.winner && ballotWinnerHandled !== state.ballot) {
+        ballotWinnerHandled = state.ballot;
+        selectWinningVariant(state.winner);
+    }
+}
+
+// Long-poll the tally until the ballot has a winner (or this page drops it)
+async function followBallot() {
+    if (ballotFollowing) {
+        return;
+    }
+    ballotFollowing = true;
+    while (ballot && ballot.open) {
+        const requested = ballot;
+        try {
+            const response = await fetch(`${API_BASE}/votes/${SESSION_ID}?after=${encodeURIComponent(requested.version)}`);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const state = await response.json();
+            // Skip answers for a ballot this page has moved past
+            if (ballot && ballot.ballot === state.ballot) {
+                applyBallot(state);
+            }
+        } catch (error) {
+            console.warn('⚠️ Could not read the vote tally:', error.message);
+            await new Promise((resolve) => setTimeout(resolve, 2000));
+        }
+    }
+    ballotFollowing = false;
+}
+
+async function castBallotVote(variantNumber, retried = false) {
+    try {
+        const response = await fetch(`${API_BASE}/votes/${SESSION_ID}`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ variant: variantNumber, ballot: ballot.ballot })
+        });
+        if (response.status === 404 && !retried) {
+            // The backend restarted and lost the ballot: open it again and retry once
+            if (await openBallot()) await castBallotVote(variantNumber, true);
+            return;
+        }
+        // 409: the ballot closed before this click arrived; its body is the final tally
+        if (!response.ok && response.status !== 409) throw new Error(`HTTP ${response.status}`);
+        const state = await response.json();
+        if (ballot && ballot.ballot === state.ballot) {
+            applyBallot(state);
+        }
+    } catch (error) {
+        console.warn('⚠️ Vote not recorded:', error.message);
+    }
+}
+
 // Setup physical buttons only - disable digital buttons
 function setupPhysicalVoting() {
     console.log('Setting up physical button voting system');
@@ -88,9 +319,12 @@ function setupPhysicalVoting() {
         console.log('Digital button 2 disabled');
     }
 
-    // Enable physical button monitoring
+    // Enable physical button monitoring. The backend counts the presses into the ballot
+    // itself, so the button events are only followed when votes are counted locally.
     checkPhysicalButtons();
-    startPhysicalButtonMonitoring();
+    openBallot().then((opened) => {
+        if (!opened) startPhysicalButtonMonitoring();
+    });
 }
 
 function getPrompt() {
@@ -98,20 +332,92 @@ function getPrompt() {
     return localStorage.getItem('current_image_prompt') || "Create a simple mutation of shape in the image with minimal design. Use solid colors and clean lines. The image should be very simple and minimal.";
 }
 
-async function generateTextVariants(prompt) {
-    // Pass the current image URL so the backend can analyze it with Vision
-    const currentImageUrl = localStorage.getItem('current_image') || 'CircleStart.png';
-    const response = await fetch(`${API_BASE}/generate-text-variants`, {
+// Read /generate-text-variants/stream, calling onEvent for each event until "done".
+// Resolves with the done payload (the /generate-variants shape); throws on an error event.
+async function streamTextVariants(prompt, imageUrl, onEvent) {
+    const response = await fetch(`${API_BASE}/generate-text-variants/stream`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
+        body: JSON.stringify(withSession({
             prompt,
-            history,
-            imageUrl: currentImageUrl
-        })
+            imageUrl,
+            summaries: true,
+            reflection: true,
+            images: true
+        }))
     });
-    if (!response.ok) throw new Error('Error generating text');
-    const data = await response.json();
+    if (!response.ok || !response.body) throw new Error('Variant streaming unavailable');
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += value;
+        let end;
+        while ((end = buffer.indexOf('\n\n')) >= 0) {
+            const block = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+            let event = 'message';
+            let data = '';
+            for (const line of block.split('\n')) {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            if (!data) continue;
+            const payload = JSON.parse(data);
+            if (event === 'error') throw new Error(payload.error);
+            if (event === 'done') return payload;
+            onEvent(event, payload);
+        }
+    }
+    throw new Error('Variant stream ended early');
+}
+
+function showVariantPreview(texts) {
+    document.getElementById('variant-preview').textContent = texts
+        .map((text, index) => text && `Variant ${index + 1}: ${text.trim()}`)
+        .filter(Boolean)
+        .join('\n\n');
+}
+
+async function generateTextVariants(prompt) {
+    // Pass the current image URL so the backend can analyze it with Vision
+    const currentImageUrl = localStorage.getItem('current_image') || 'CircleStart.png';
+    // The variants are streamed so they show up while they are written; the summaries, the
+    // reflection and each variant's image (started as soon as its text is complete) arrive
+    // on the same stream
+    const texts = ['', ''];
+    let data;
+    try {
+        data = await streamTextVariants(prompt, currentImageUrl, (event, payload) => {
+            if (event === 'delta') texts[payload.index] = (texts[payload.index] || '') + payload.text;
+            else if (event === 'variant') texts[payload.index] = payload.text;
+            else return;
+            showVariantPreview(texts);
+        });
+    } catch (e) {
+        console.warn('Variant stream failed, falling back to /generate-variants:', e);
+        showVariantPreview([]);
+        // One batched call returns the variants with their summaries and the reflection
+        const response = await fetch(`${API_BASE}/generate-variants`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(withSession({
+                prompt,
+                imageUrl: currentImageUrl,
+                reflection: true
+            }))
+        });
+        if (!response.ok) throw new Error('Error generating text');
+        data = await response.json();
+    }
+    localStorage.setItem('variant_batch', JSON.stringify({
+        variants: data.variants,
+        summaries: data.summaries,
+        reflection: data.reflection && data.reflection.reflection,
+        images: data.images
+    }));
+    showVariantPreview(data.variants);
 
     // Don't store text variants prompts - we only want final image generation prompts
 
@@ -205,6 +511,78 @@ async function generateReflection(prompt, history) {
     return data;
 }
 
+// Submit a background job and follow it until it finishes, so no request is held open for
+// the whole DALL-E call. A full queue (429) is retried after the delay the backend suggests.
+async function runJob(kind, body) {
+    let response;
+    while (true) {
+        response = await fetch(`${API_BASE}/jobs/${kind}`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(body)
+        });
+        if (response.status !== 429) break;
+        const { retry_after } = await response.json();
+        console.warn(`⏳ Generation queue full, retrying in ${retry_after}s`);
+        await new Promise(resolve => setTimeout(resolve, retry_after * 1000));
+    }
+    if (!response.ok) {
+        const errorText = await response.text();
+        throw new Error(`Error submitting ${kind} job: ${response.status} ${errorText}`);
+    }
+    let job = await response.json();
+    while (!['done', 'failed', 'cancelled'].includes(job.status)) {
+        // Each request waits until the job changes (a new stage, or finished)
+        const poll = await fetch(`${API_BASE}/jobs/${job.id}?wait=25&revision=${job.revision}`);
+        if (!poll.ok) throw new Error(`Error following ${kind} job: ${poll.status}`);
+        job = await poll.json();
+        console.log(`🔄 ${kind} job ${job.status}${job.stage ? ` (${job.stage})` : ''}`);
+    }
+    if (job.status !== 'done') throw new Error(`${kind} job ${job.status}${job.error ? `: ${job.error}` : ''}`);
+    return job.result;
+}
+
+// Run images, summaries and reflection for the current variants in one server-side pipeline.
+// speculate asks the backend to pre-generate the next round's variants while voting is open.
+async function generateCycle(variant1, variant2) {
+    const currentImageUrl = localStorage.getItem('current_image') || 'CircleStart.png';
+    // Summaries, reflection and images that came with these variants spare the backend those calls
+    const batch = JSON.parse(localStorage.getItem('variant_batch') || 'null');
+    const fromBatch = batch && batch.variants[0] === variant1 && batch.variants[1] === variant2;
+    const data = await runJob('cycle', withSession({
+        prompt: getPrompt(),
+        imageUrl: currentImageUrl,
+        variants: [variant1, variant2],
+        summaries: fromBatch ? batch.summaries : undefined,
+        reflection: fromBatch ? batch.reflection : undefined,
+        images: fromBatch ? batch.images : undefined,
+        speculate: true
+    }));
+    if (data.pool && data.pool.fallback) {
+        // A stand-in from the precomputed pool while generation is failing: the backend did
+        // not record it as this visitor's round, so don't play it as one
+        console.warn('Image generation unavailable, got the precomputed round for', data.pool.image);
+        throw new Error('Image generation is unavailable right now');
+    }
+
+    // Store only the final prompts sent to DALL-E for image generation
+    data.images.forEach((img, i) => {
+        addPromptToHistory('DALL-E Image Generation', {
+            final_prompt_sent_to_dalle: img.debug_info.final_prompt,
+            generated_image_url: img.modifiedImageUrl,
+            variant_text: data.variants[i]
+        });
+    });
+
+    return {
+        img1: data.images[0],
+        img2: data.images[1],
+        summary1: data.summaries[0].summary,
+        summary2: data.summaries[1].summary,
+        reflectionData: data.reflection
+    };
+}
+
 async function removeInstructionFromJSON(instruction) {
     try {
         const response = await fetch(`${API_BASE}/remove-instruction`, {
@@ -298,25 +676,11 @@ document.getElementById('gen-img-btn').onclick = async function () {
         const variant1 = localStorage.getItem('variant1_text');
         const variant2 = localStorage.getItem('variant2_text');
         if (!variant1 || !variant2) throw new Error('Generate the variants first!');
-        // Generate both images
-        const [img1, img2] = await Promise.all([
-            generateImage(variant1),
-            generateImage(variant2)
-        ]);
-
-        // Extract instructions from the debug info
-        const instruction1 = (img1.debug_info && img1.debug_info.random_instruction) ? img1.debug_info.random_instruction : '';
-        const instruction2 = (img2.debug_info && img2.debug_info.random_instruction) ? img2.debug_info.random_instruction : '';
-
-        console.log('🔍 MAIN: Instruction1:', instruction1);
-        console.log('🔍 MAIN: Instruction2:', instruction2);
-
-        // Generate summaries for both variants (parallel)
-        const [summary1, summary2] = await Promise.all([
-            generateSummary(variant1, instruction1),
-            generateSummary(variant2, instruction2)
-        ]);
+        // Images, summaries and reflection are generated concurrently by the backend
+        const { img1, img2, summary1, summary2, reflectionData } = await generateCycle(variant1, variant2);
 
+        console.log('🔍 MAIN: Instruction1:', img1.debug_info.random_instruction);
+        console.log('🔍 MAIN: Instruction2:', img2.debug_info.random_instruction);
         console.log('🔍 MAIN: Summary1:', summary1);
         console.log('🔍 MAIN: Summary2:', summary2);
 
@@ -326,8 +690,6 @@ document.getElementById('gen-img-btn').onclick = async function () {
         localStorage.setItem('variant1_text', summary1);  // Save the summary instead of original description
         localStorage.setItem('variant2_text', summary2);  // Save the summary instead of original description
 
-        // Generate reflection
-        const reflectionData = await generateReflection(getPrompt(), history);
         localStorage.setItem('reflection', reflectionData.reflection || '');
         document.getElementById('reflection').innerHTML = `<b>Reflection:</b><br>${reflectionData.reflection}`;
         btn.textContent = 'Images generated';
@@ -372,6 +734,11 @@ function attachVoteHandlers() {
 
 function voteForVariant(variantNumber) {
     console.log('🔵 DEBUG: voteForVariant called with:', variantNumber);
+    if (ballot) {
+        // Counted by the backend; the tally comes back through applyBallot
+        castBallotVote(variantNumber);
+        return;
+    }
     console.log('🔵 DEBUG: Current votes before increment - V1:', variant1Votes, 'V2:', variant2Votes);
 
     if (variantNumber === 1) {
@@ -431,6 +798,13 @@ function voteForVariant(variantNumber) {
         localStorage.setItem('history', JSON.stringify(history));
         // Set the prompt for the next round
         localStorage.setItem('current_image_prompt', prompt);
+        // Record the choice in the shared session, for the displays and the next requests
+        await pushSessionDelta({
+            history_append: [prompt],
+            history_length: history.length - 1,
+            set: { current_image: img, current_prompt: prompt },
+            new_round: true
+        });
 
         // Show winner message briefly
         showWinnerMessage(variantNumber);
@@ -603,8 +977,10 @@ function resetForNextCycle() {
     localStorage.removeItem('variant1_instruction');
     localStorage.removeItem('variant2_instruction');
     localStorage.removeItem('reflection');
+    localStorage.removeItem('variant_batch');
 
     // Reset vote counters and save to localStorage
+    ballot = null;
     variant1Votes = 0;
     variant2Votes = 0;
     localStorage.setItem('variant1Votes', '0');
@@ -616,6 +992,7 @@ function resetForNextCycle() {
     // Hide the choose-variant buttons ONLY after a choice is made
     document.getElementById('choose-variant').style.display = 'none';
     document.getElementById('reflection').innerHTML = '';
+    document.getElementById('variant-preview').textContent = '';
 
     // Stop physical button monitoring when cycle resets
     stopPhysicalButtonMonitoring();
@@ -652,25 +1029,11 @@ async function generateImagesAutomatically() {
         const variant2 = localStorage.getItem('variant2_text');
         if (!variant1 || !variant2) throw new Error('Generate the variants first!');
 
-        // Generate both images
-        const [img1, img2] = await Promise.all([
-            generateImage(variant1),
-            generateImage(variant2)
-        ]);
-
-        // Extract instructions from the debug info
-        const instruction1 = (img1.debug_info && img1.debug_info.random_instruction) ? img1.debug_info.random_instruction : '';
-        const instruction2 = (img2.debug_info && img2.debug_info.random_instruction) ? img2.debug_info.random_instruction : '';
-
-        console.log('🔍 AUTO: Instruction1:', instruction1);
-        console.log('🔍 AUTO: Instruction2:', instruction2);
-
-        // Generate summaries for both variants (parallel)
-        const [summary1, summary2] = await Promise.all([
-            generateSummary(variant1, instruction1),
-            generateSummary(variant2, instruction2)
-        ]);
+        // Images, summaries and reflection are generated concurrently by the backend
+        const { img1, img2, summary1, summary2, reflectionData } = await generateCycle(variant1, variant2);
 
+        console.log('🔍 AUTO: Instruction1:', img1.debug_info.random_instruction);
+        console.log('🔍 AUTO: Instruction2:', img2.debug_info.random_instruction);
         console.log('🔍 AUTO: Summary1:', summary1);
         console.log('🔍 AUTO: Summary2:', summary2);
 
@@ -680,8 +1043,6 @@ async function generateImagesAutomatically() {
         localStorage.setItem('variant1_text', summary1);  // Save the summary instead of original description
         localStorage.setItem('variant2_text', summary2);  // Save the summary instead of original description
 
-        // Generate reflection
-        const reflectionData = await generateReflection(getPrompt(), history);
         localStorage.setItem('reflection', reflectionData.reflection || '');
         document.getElementById('reflection').innerHTML = `<b>Reflection:</b><br>${reflectionData.reflection}`;
         btn.textContent = 'Images generated';
@@ -761,6 +1122,14 @@ function addPromptToHistory(type, promptData) {
     }
 }
 
+// Display-tier version of one of the backend's mirrored images (/images/<sha256>.<ext>
+// becomes /images/<sha256>-<tier>.<ext>); other URLs are used as they are
+function derivativeUrl(url, tier) {
+    const match = /^(.*\/images\/[0-9a-f]{64})\.(png|jpg|webp)$/.exec(url || '');
+    if (!match) return url;
+    return `${match[1]}-${tier}.${tier === 'placeholder' ? 'jpg' : 'webp'}`;
+}
+
 // Function to update the prompt history display
 function updatePromptHistoryDisplay() {
     const entriesContainer = document.getElementById('prompt-entries');
@@ -810,7 +1179,7 @@ function updatePromptHistoryDisplay() {
                     </div>
                     <div class="prompt-entry-images">
                         <div class="prompt-entry-image">
-                            <img src="${entry.data.generated_image_url}" alt="Generated Image ${variantIndex + 1}">
+                            <img src="${derivativeUrl(entry.data.generated_image_url, 'thumb')}" loading="lazy" alt="Generated Image ${variantIndex + 1}">
                             <div class="choice-indicator ${choiceClass}"></div>
                             <div class="variant-label">Variant ${variantIndex + 1}</div>
                         </div>
@@ -839,6 +1208,8 @@ function togglePromptHistory() {
 
 function resetToStart() {
     localStorage.clear();
+    pushSessionDelta({ reset: true });
+    ballot = null;
     history = [];
     promptHistory = [];
     variant1Votes = 0;
@@ -849,6 +1220,7 @@ function resetToStart() {
     document.getElementById('gen-img-btn').style.display = 'none';
     document.getElementById('choose-variant').style.display = 'none';
     document.getElementById('reflection').innerHTML = '';
+    document.getElementById('variant-preview').textContent = '';
     document.getElementById('prompt-history').style.display = 'none';
     document.getElementById('prompt-entries').innerHTML = '';
 }
@@ -879,6 +1251,10 @@ window.onload = function () {
     // Test backend connection first
     testBackendConnection();
 
+    // Load the shared session (it takes precedence over localStorage)
+    syncSessionState();
+    restorePromptHistory();
+
     // Update instructions count on load
     updateInstructionsCount();
 
@@ -985,31 +1361,90 @@ function startPhysicalButtonMonitoring() {
     console.log('🔴 DEBUG: API_BASE =', API_BASE);
 
     // Stop any previous monitoring
+    stopPhysicalButtonMonitoring();
+
+    // Prefer the push channel: presses arrive the moment the Pi sends them
+    if (!window.EventSource) {
+        startButtonPolling();
+        return;
+    }
+
+    const after = lastButtonSeq !== null ? `?after=${lastButtonSeq}` : '';
+    buttonEventSource = new EventSource(`${API_BASE}/button-events${after}`);
+
+    buttonEventSource.addEventListener('hello', (e) => {
+        const data = JSON.parse(e.data);
+        // reset: our cursor predates a backend restart, follow the log from its new end
+        if (lastButtonSeq === null || data.reset) {
+            lastButtonSeq = data.cursor;
+        }
+    });
+
+    buttonEventSource.addEventListener('missed', (e) => {
+        console.warn('🔴 DEBUG: Button events lost before this display could read them:', JSON.parse(e.data).missed);
+    });
+
+    buttonEventSource.addEventListener('open', () => {
+        console.log('🔴 DEBUG: Button event stream connected');
+        // Push channel is back, polling is no longer needed
+        stopButtonPolling();
+    });
+
+    buttonEventSource.addEventListener('button', (e) => {
+        const data = JSON.parse(e.data);
+        console.log(`🔴 DEBUG: Physical button ${data.button} pushed (seq ${data.seq}) - calling handler`);
+        handleButtonEvent(data);
+    });
+
+    buttonEventSource.addEventListener('error', () => {
+        // EventSource reconnects on its own; fall back to polling while it is down
+        console.log('🔴 DEBUG: Button event stream unavailable, falling back to polling');
+        if (buttonEventSource && buttonEventSource.readyState === EventSource.CLOSED) {
+            buttonEventSource = null;
+        }
+        startButtonPolling();
+    });
+}
+
+// Fallback: poll /check-button-press when the push channel is not available
+function startButtonPolling() {
     if (buttonCheckInterval) {
-        clearInterval(buttonCheckInterval);
-        console.log('🔴 DEBUG: Cleared previous monitoring interval');
+        return;
     }
 
     // Check for button presses every 2 seconds (increased for better debugging)
     buttonCheckInterval = setInterval(async () => {
         try {
             console.log('🔴 DEBUG: Checking for button presses...');
-            const response = await fetch(`${API_BASE}/check-button-press`);
+            if (lastButtonSeq === null) {
+                // Start from the newest press, older ones belong to a previous cycle
+                const status = await fetch(`${API_BASE}/button-status`);
+                if (status.ok) {
+                    lastButtonSeq = (await status.json()).last_seq || 0;
+                }
+                return;
+            }
+            const response = await fetch(`${API_BASE}/check-button-press?after=${lastButtonSeq}`);
             console.log('🔴 DEBUG: Response status:', response.status);
 
             if (response.ok) {
                 const data = await response.json();
                 console.log('🔴 DEBUG: Response data:', data);
 
+                if (data.missed) {
+                    console.warn('🔴 DEBUG: Button events lost before this display could read them:', data.missed);
+                }
+
                 if (data.button_pressed) {
-                    console.log(`🔴 DEBUG: Physical button ${data.button} pressed - calling handler`);
-                    handlePhysicalButtonPress(data.button);
+                    // Every press since the last poll, in order
+                    data.events.forEach(handleButtonEvent);
 
                     // DON'T stop monitoring - continue voting
                     console.log('🔴 DEBUG: Continuing monitoring for more votes...');
                 } else {
                     console.log('🔴 DEBUG: No button press detected');
                 }
+                lastButtonSeq = data.reset ? data.cursor : Math.max(lastButtonSeq, data.cursor);
             } else {
                 console.log('🔴 DEBUG: Response not ok:', response.status);
             }
@@ -1018,7 +1453,27 @@ function startPhysicalButtonMonitoring() {
         }
     }, 2000);
 
-    console.log('🔴 DEBUG: Physical button monitoring started with interval ID:', buttonCheckInterval);
+    console.log('🔴 DEBUG: Physical button polling started with interval ID:', buttonCheckInterval);
+}
+
+function stopButtonPolling() {
+    if (buttonCheckInterval) {
+        clearInterval(buttonCheckInterval);
+        buttonCheckInterval = null;
+    }
+}
+
+// Handle one event from the button log; skip anything already seen via the other channel
+function handleButtonEvent(event) {
+    if (lastButtonSeq !== null && event.seq <= lastButtonSeq) {
+        return;
+    }
+    lastButtonSeq = event.seq;
+    if (ballot) {
+        // The backend already counted this press into the ballot
+        return;
+    }
+    handlePhysicalButtonPress(event.button);
 }
 
 function handlePhysicalButtonPress(buttonNumber) {
@@ -1052,9 +1507,12 @@ function handlePhysicalButtonPress(buttonNumber) {
 }
 
 function stopPhysicalButtonMonitoring() {
+    if (buttonEventSource) {
+        buttonEventSource.close();
+        buttonEventSource = null;
+    }
     if (buttonCheckInterval) {
-        clearInterval(buttonCheckInterval);
-        buttonCheckInterval = null;
+        stopButtonPolling();
         console.log('Physical button monitoring stopped');
     }
 }
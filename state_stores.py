@@ -0,0 +1,1795 @@
+"""Kiosk state stores: the button log, instruction pool, sessions, iteration archive, vote
+board and generation job queue. Each has an in-memory implementation for a single process
+and a Sqlite* twin that keeps the state in the shared StateDatabase for several workers."""
+
+import atexit
+import copy
+import heapq
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import statistics
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread, Timer, get_ident, local
+try:
+    import fcntl
+except ImportError:  # not on Windows; there the shared instruction file isn't locked across workers
+    fcntl = None
+
+from instrumentation import log, metrics
+
+STATE_BUSY_TIMEOUT = 5.0  # seconds a writer waits for another process's transaction
+STATE_WATCH_INTERVAL = 0.05  # seconds between checks for commits by other processes
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state_values (name TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS button_events (seq INTEGER PRIMARY KEY, button, timestamp TEXT);
+CREATE TABLE IF NOT EXISTS button_press_ids (press_id TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, version INTEGER NOT NULL, state TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS ballots (session_id TEXT PRIMARY KEY, state TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS instructions (position INTEGER PRIMARY KEY, text TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, job_group TEXT, status TEXT NOT NULL, finished REAL,
+                                 cancel_requested INTEGER NOT NULL DEFAULT 0, state TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS jobs_by_group ON jobs (job_group, status);
+"""
+
+class ObservedStore:
+    """Change notification shared by the stores: `changed` is a condition on self.lock that
+    waiters block on, and listeners are cheap, thread-safe callbacks run on every change
+    (the async app uses them to wake its waiters)"""
+
+    def __init__(self, lock=None):
+        self.lock = lock or Lock()
+        self.changed = Condition(self.lock)
+        self.listeners = []
+
+    def _notify(self):
+        # Caller holds self.lock
+        self.changed.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def remote_changed(self):
+        """Another process committed: wake the waiters, then run the listeners outside the lock"""
+        with self.changed:
+            self.changed.notify_all()
+        for listener in list(self.listeners):
+            listener()
+
+    def stats(self):
+        """Counters for /health and /metrics"""
+        raise NotImplementedError
+
+
+class StateDatabase:
+    """The shared SQLite file: one connection per thread, writes in BEGIN IMMEDIATE
+    transactions. One watcher thread per database polls PRAGMA data_version and wakes every
+    subscribed store when another process committed, so waits and the async app's listeners
+    see remote changes as they see local ones; it also runs the stores' periodic checks."""
+
+    def __init__(self, path, schema=STATE_SCHEMA, watch_interval=STATE_WATCH_INTERVAL):
+        self.path = path
+        self.connections = local()
+        self.subscribers = []
+        self.periodic = []  # [interval, callback, next run]
+        db = self.connection()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(schema)
+        if watch_interval:
+            Thread(target=self._watch, args=(watch_interval,), daemon=True, name='state-watch').start()
+
+    def connection(self):
+        db = getattr(self.connections, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=STATE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.connections.db = db
+        return db
+
+    @contextmanager
+    def transaction(self):
+        """This thread's connection inside BEGIN IMMEDIATE ... COMMIT (ROLLBACK on error)"""
+        db = self.connection()
+        started = time.perf_counter()
+        db.execute('BEGIN IMMEDIATE')
+        metrics.observe('lock_wait_seconds', time.perf_counter() - started, lock='state_db')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def query(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def get(self, db, name, default=0):
+        row = db.execute('SELECT value FROM state_values WHERE name = ?', (name,)).fetchone()
+        return default if row is None else row[0]
+
+    def put(self, db, name, value):
+        db.execute('INSERT INTO state_values (name, value) VALUES (?, ?) '
+                   'ON CONFLICT(name) DO UPDATE SET value = excluded.value', (name, value))
+
+    def add(self, db, name, amount=1):
+        """Increment a counter in the current transaction; returns the new value"""
+        value = self.get(db, name) + amount
+        self.put(db, name, value)
+        return value
+
+    def counters(self, prefix):
+        rows = self.query('SELECT name, value FROM state_values WHERE substr(name, 1, ?) = ?', (len(prefix), prefix))
+        return {name[len(prefix):]: value for name, value in rows}
+
+    def subscribe(self, store):
+        """Call store.remote_changed() on every remote commit"""
+        self.subscribers.append(store)
+
+    def every(self, interval, callback):
+        """Run callback() on the watcher thread about every `interval` seconds"""
+        self.periodic.append([interval, callback, time.monotonic() + interval])
+
+    def _watch(self, interval):
+        db = sqlite3.connect(self.path, timeout=STATE_BUSY_TIMEOUT, isolation_level=None)
+        version = db.execute('PRAGMA data_version').fetchone()[0]
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            for task in self.periodic:
+                if now >= task[2]:
+                    task[2] = now + task[0]
+                    try:
+                        task[1]()
+                    except Exception as e:
+                        log.error("Error in periodic state check %s: %s", task[1].__qualname__, e)
+            try:
+                current = db.execute('PRAGMA data_version').fetchone()[0]
+            except sqlite3.Error as e:
+                log.error("Error watching the state database: %s", e)
+                continue
+            if current == version:
+                continue
+            version = current
+            for store in self.subscribers:
+                store.remote_changed()
+
+# Physical button presses: bounded, sequence-numbered event log.
+# Every display reads with its own cursor ("events after seq N"), so no press
+# is consumed by one tab and hidden from the others.
+BUTTON_EVENT_LOG_SIZE = 1024
+BUTTON_EVENTS_BATCH_LIMIT = 100
+BUTTON_EVENTS_HEARTBEAT = 15  # seconds between keep-alive comments on idle streams
+BUTTON_BATCH_MAX = 100  # presses per /physical-button-presses request
+BUTTON_PRESS_IDS_REMEMBERED = 4096  # press ids kept to drop the ones the Pi resends after a lost answer
+
+class ButtonEventLog(ObservedStore):
+    """Ring buffer of button events with contiguous sequence numbers starting at 1"""
+
+    def __init__(self, size=BUTTON_EVENT_LOG_SIZE, lock=None):
+        super().__init__(lock)
+        self.events = deque(maxlen=size)
+        self.last_seq = 0
+        self.dropped = 0  # events evicted from the ring before every reader could see them
+        self.subscribers = 0
+        self.press_ids = OrderedDict()  # recent batched press ids, oldest first
+        self.duplicates = 0
+        self.legacy_cursor = 0  # for old clients that call /check-button-press without ?after=
+
+    def _append(self, button, timestamp):
+        # Caller holds self.lock and notifies once it is done appending
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.last_seq += 1
+        event = {'seq': self.last_seq, 'button': button, 'timestamp': timestamp}
+        self.events.append(event)
+        return event
+
+    def append(self, button, timestamp):
+        """Record a press and wake up every waiting reader"""
+        with self.changed:
+            event = self._append(button, timestamp)
+            self._notify()
+            return event
+
+    def append_batch(self, presses):
+        """Record (press_id, button, timestamp) presses in order with one wake-up, skipping
+        ids already recorded (a batch resent after its answer was lost); returns the new events"""
+        with self.changed:
+            events = []
+            for press_id, button, timestamp in presses:
+                if press_id in self.press_ids:
+                    self.duplicates += 1
+                    continue
+                self.press_ids[press_id] = True
+                if len(self.press_ids) > BUTTON_PRESS_IDS_REMEMBERED:
+                    self.press_ids.popitem(last=False)
+                events.append(self._append(button, timestamp))
+            if events:
+                self._notify()
+            return events
+
+    def _read(self, after, limit):
+        # Caller holds self.lock. Sequence numbers are contiguous, so indexing is O(1).
+        # A cursor past the last seq was handed out before the log restarted: read from the end.
+        after = min(after, self.last_seq)
+        first_seq = self.last_seq - len(self.events) + 1
+        missed = max(0, first_seq - after - 1)
+        start = max(0, after + 1 - first_seq)
+        batch = [self.events[i] for i in range(start, min(len(self.events), start + limit))]
+        cursor = batch[-1]['seq'] if batch else max(after, first_seq - 1)
+        return batch, cursor, missed
+
+    def read_after(self, after, limit=BUTTON_EVENTS_BATCH_LIMIT):
+        """Return (events with seq > after, new cursor, number of events this reader missed)"""
+        with self.lock:
+            return self._read(after, limit)
+
+    def wait_after(self, after, timeout, limit=BUTTON_EVENTS_BATCH_LIMIT):
+        """Like read_after, but block up to timeout seconds for something new"""
+        with self.changed:
+            after = min(after, self.last_seq)
+            self.changed.wait_for(lambda: self.last_seq > after, timeout=timeout)
+            return self._read(after, limit)
+
+    def claim_next(self):
+        """Hand out the next press past the shared legacy cursor, once, or None"""
+        with self.lock:
+            events, self.legacy_cursor, _ = self._read(self.legacy_cursor, 1)
+            return events[0] if events else None
+
+    def latest(self):
+        with self.lock:
+            return self.events[-1] if self.events else None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'last_seq': self.last_seq,
+                'buffered': len(self.events),
+                'capacity': self.events.maxlen,
+                'dropped': self.dropped,
+                'duplicates': self.duplicates,
+                'subscribers': self.subscribers
+            }
+
+class SqliteButtonEventLog(ButtonEventLog):
+    """ButtonEventLog in the shared state database: a press recorded by one worker process
+    is read by displays connected to any other. Keeps the newest `size` events."""
+
+    def __init__(self, db, size=BUTTON_EVENT_LOG_SIZE, lock=None):
+        super().__init__(size, lock)
+        self.db = db
+        self.size = size
+        db.subscribe(self)
+
+    def _insert(self, db, button, timestamp):
+        seq = db.execute('INSERT INTO button_events (button, timestamp) VALUES (?, ?)',
+                         (button, json.dumps(timestamp))).lastrowid
+        dropped = db.execute('DELETE FROM button_events WHERE seq <= ?', (seq - self.size,)).rowcount
+        if dropped:
+            self.db.add(db, 'button_dropped', dropped)
+        return {'seq': seq, 'button': button, 'timestamp': timestamp}
+
+    def append(self, button, timestamp):
+        with self.db.transaction() as db:
+            event = self._insert(db, button, timestamp)
+        with self.changed:
+            self._notify()
+        return event
+
+    def append_batch(self, presses):
+        events = []
+        with self.db.transaction() as db:
+            for press_id, button, timestamp in presses:
+                if not db.execute('INSERT OR IGNORE INTO button_press_ids (press_id) VALUES (?)', (press_id,)).rowcount:
+                    self.db.add(db, 'button_duplicates')
+                    continue
+                events.append(self._insert(db, button, timestamp))
+            if events:
+                db.execute('DELETE FROM button_press_ids WHERE rowid <= (SELECT max(rowid) FROM button_press_ids) - ?',
+                           (BUTTON_PRESS_IDS_REMEMBERED,))
+        if events:
+            with self.changed:
+                self._notify()
+        return events
+
+    def _last_seq(self):
+        return self.db.query('SELECT coalesce(max(seq), 0) FROM button_events')[0][0]
+
+    def _read(self, after, limit, db=None):
+        db = db or self.db.connection()
+        rows = db.execute('SELECT seq, button, timestamp FROM button_events WHERE seq > ? ORDER BY seq LIMIT ?',
+                          (after, limit)).fetchall()
+        first_seq, last_seq = db.execute('SELECT min(seq), coalesce(max(seq), 0) FROM button_events').fetchone()
+        first_seq = last_seq + 1 if first_seq is None else first_seq
+        after = min(after, last_seq)
+        batch = [{'seq': seq, 'button': button, 'timestamp': json.loads(timestamp)} for seq, button, timestamp in rows]
+        missed = max(0, first_seq - after - 1)
+        cursor = batch[-1]['seq'] if batch else max(after, first_seq - 1)
+        return batch, cursor, missed
+
+    def read_after(self, after, limit=BUTTON_EVENTS_BATCH_LIMIT):
+        return self._read(after, limit)
+
+    def wait_after(self, after, timeout, limit=BUTTON_EVENTS_BATCH_LIMIT):
+        after = min(after, self._last_seq())
+        with self.changed:
+            self.changed.wait_for(lambda: self._last_seq() > after, timeout=timeout)
+        return self._read(after, limit)
+
+    def claim_next(self):
+        with self.db.transaction() as db:
+            events, cursor, _ = self._read(self.db.get(db, 'button_legacy_cursor'), 1, db)
+            self.db.put(db, 'button_legacy_cursor', cursor)
+        return events[0] if events else None
+
+    def latest(self):
+        events, _, _ = self._read(self._last_seq() - 1, 1)
+        return events[0] if events else None
+
+    def stats(self):
+        (buffered,), = self.db.query('SELECT count(*) FROM button_events')
+        counters = self.db.counters('button_')
+        return {
+            'last_seq': self._last_seq(),
+            'buffered': buffered,
+            'capacity': self.size,
+            'dropped': counters.get('dropped', 0),
+            'duplicates': counters.get('duplicates', 0),
+            'subscribers': self.subscribers  # this process's streams
+        }
+
+# instructions.json is loaded once into memory. Removals are O(1) and batched into an
+# atomic write-and-rename; a watcher reloads the pool when the file is edited on disk.
+INSTRUCTIONS_FLUSH_DELAY = 0.5  # seconds to batch removals before writing
+INSTRUCTIONS_WATCH_INTERVAL = 2.0  # seconds between checks for external edits
+INSTRUCTIONS_FLUSH_RETRY = 5.0  # seconds before retrying a failed write
+
+class InstructionPool:
+    """In-memory instruction set with O(1) random pick and removal, persisted atomically"""
+
+    def __init__(self, path, flush_delay=INSTRUCTIONS_FLUSH_DELAY, watch_interval=INSTRUCTIONS_WATCH_INTERVAL):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.lock = Lock()
+        self.write_lock = Lock()
+        self.data = {}
+        self.items = []  # for random.choice
+        self.positions = {}  # instruction -> index in self.items
+        self.ordered = {}  # file order, kept for persistence
+        self.removed = set()  # removals not yet written
+        self.flush_timer = None
+        self.file_mtime = None
+        try:
+            self.reload()
+        except (OSError, ValueError) as e:
+            # Serve no instruction (as a bad edit would) until the watcher loads a good file
+            log.error("Could not load %s, starting with no instructions: %s", self.path, e)
+        if watch_interval:
+            watcher = Thread(target=self._watch, args=(watch_interval,), daemon=True, name='instructions-watch')
+            watcher.start()
+        atexit.register(self.flush)
+
+    def reload(self):
+        """(Re)load the file, re-applying removals that haven't been written yet"""
+        with metrics.span('json_io', file='instructions', op='read'):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        mtime = os.stat(self.path).st_mtime_ns
+        with self.lock:
+            self.data = data
+            self.ordered = dict.fromkeys(i for i in data.get('random_instructions', []) if i not in self.removed)
+            self.items = list(self.ordered)
+            self.positions = {instruction: index for index, instruction in enumerate(self.items)}
+            self.file_mtime = mtime
+        log.info("Instruction pool loaded: %d instructions", len(self.items))
+
+    def _watch(self, interval):
+        failing = None
+        while True:
+            time.sleep(interval)
+            try:
+                if os.stat(self.path).st_mtime_ns != self.file_mtime:
+                    log.info("instructions.json changed on disk, reloading")
+                    self.reload()
+                failing = None
+            except (OSError, ValueError) as e:
+                if str(e) != failing:  # once per problem, not every interval
+                    log.error("Error reloading instructions.json: %s", e)
+                failing = str(e)
+
+    def choice(self):
+        with self.lock:
+            return random.choice(self.items) if self.items else None
+
+    def count(self):
+        with self.lock:
+            return len(self.items)
+
+    def remove(self, instruction):
+        """Drop an instruction; returns False if it isn't in the pool"""
+        with self.lock:
+            index = self.positions.pop(instruction, None)
+            if index is None:
+                return False
+            # Swap with the last item so removal stays O(1)
+            last = self.items.pop()
+            if last != instruction:
+                self.items[index] = last
+                self.positions[last] = index
+            del self.ordered[instruction]
+            self.removed.add(instruction)
+            if self.flush_timer is None:
+                self._schedule_flush(self.flush_delay)
+        return True
+
+    def _schedule_flush(self, delay):
+        # Caller holds self.lock
+        self.flush_timer = Timer(delay, self._timed_flush)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            # The removals stay pending: try again rather than leave them unwritten
+            log.error("Error saving instructions.json, retrying in %ss: %s", INSTRUCTIONS_FLUSH_RETRY, e)
+            with self.lock:
+                if self.flush_timer is None:
+                    self._schedule_flush(INSTRUCTIONS_FLUSH_RETRY)
+
+    def flush(self):
+        """Write pending removals: temp file, fsync, then rename over instructions.json"""
+        with self.write_lock:
+            with self.lock:
+                self.flush_timer = None
+                if not self.removed:
+                    return
+                data = dict(self.data, random_instructions=list(self.ordered))
+                written = set(self.removed)
+            tmp_path = f"{self.path}.tmp"
+            with metrics.span('json_io', file='instructions', op='write'):
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=4, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            with self.lock:
+                self.file_mtime = os.stat(self.path).st_mtime_ns
+                self.data = data
+                self.removed -= written
+            log.info("instructions.json saved (%d instructions)", len(data['random_instructions']))
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock on `path` across processes (a no-op without fcntl)"""
+    with open(path, 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+class SqliteInstructionPool:
+    """The instruction pool in the shared state database. instructions.json seeds it and is
+    imported again whenever it is edited on disk; removals are written back to the file.
+    Writes and imports of the file take a lock file, so no worker re-imports a list another
+    one is still writing, and no older snapshot is written over a newer one."""
+
+    def __init__(self, db, path, flush_delay=INSTRUCTIONS_FLUSH_DELAY, watch_interval=INSTRUCTIONS_WATCH_INTERVAL):
+        self.db = db
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.flush_delay = flush_delay
+        self.lock = Lock()
+        self.flush_timer = None
+        self.generation = None  # the database's instructions_generation self.items was read at
+        self.items = []  # for random.choice
+        self.failing = None
+        try:
+            self.reload()
+        except (OSError, ValueError) as e:
+            log.error("Could not import %s, keeping the database's instructions: %s", self.path, e)
+        if watch_interval:
+            db.every(watch_interval, self._check_file)
+        atexit.register(self.flush)
+
+    def reload(self):
+        """Import the file unless this version of it was imported (or written) already"""
+        with file_lock(self.lock_path):
+            mtime = os.stat(self.path).st_mtime_ns
+            if self.db.get(self.db.connection(), 'instructions_mtime', None) == mtime:
+                return
+            with metrics.span('json_io', file='instructions', op='read'):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            with self.db.transaction() as db:
+                db.execute('DELETE FROM instructions')
+                db.executemany('INSERT OR IGNORE INTO instructions (text) VALUES (?)',
+                               [(instruction,) for instruction in data.get('random_instructions', [])])
+                self.db.put(db, 'instructions_mtime', mtime)
+                self.db.put(db, 'instructions_file', json.dumps(data, ensure_ascii=False))
+                self.db.add(db, 'instructions_generation')
+        log.info("Instruction pool imported into the state database: %d instructions", self.count())
+
+    def _check_file(self):
+        # Runs on the state database's watcher thread
+        try:
+            if os.stat(self.path).st_mtime_ns != self.db.get(self.db.connection(), 'instructions_mtime', None):
+                self.reload()
+            self.failing = None
+        except (OSError, ValueError, sqlite3.Error) as e:
+            if str(e) != self.failing:
+                log.error("Error reloading instructions.json: %s", e)
+            self.failing = str(e)
+
+    def choice(self):
+        # The generation is read before the list, so a change in between only costs a re-read
+        generation = self.db.get(self.db.connection(), 'instructions_generation')
+        with self.lock:
+            if generation != self.generation:
+                self.items = [text for (text,) in self.db.query('SELECT text FROM instructions')]
+                self.generation = generation
+            return random.choice(self.items) if self.items else None
+
+    def count(self):
+        return self.db.query('SELECT count(*) FROM instructions')[0][0]
+
+    def remove(self, instruction):
+        with self.db.transaction() as db:
+            if not db.execute('DELETE FROM instructions WHERE text = ?', (instruction,)).rowcount:
+                return False
+            self.db.add(db, 'instructions_generation')
+        with self.lock:
+            if self.flush_timer is None:
+                self._schedule_flush(self.flush_delay)
+        return True
+
+    def _schedule_flush(self, delay):
+        # Caller holds self.lock
+        self.flush_timer = Timer(delay, self._timed_flush)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            log.error("Error saving instructions.json, retrying in %ss: %s", INSTRUCTIONS_FLUSH_RETRY, e)
+            with self.lock:
+                if self.flush_timer is None:
+                    self._schedule_flush(INSTRUCTIONS_FLUSH_RETRY)
+
+    def flush(self):
+        """Write the pool back to instructions.json: temp file, fsync, then rename. Only the
+        snapshot is taken in a transaction; the file is written after it commits."""
+        with self.lock:
+            if self.flush_timer is None:
+                return
+            self.flush_timer = None
+        with file_lock(self.lock_path):
+            with self.db.transaction() as db:
+                instructions = [text for (text,) in db.execute('SELECT text FROM instructions ORDER BY position')]
+                data = dict(json.loads(self.db.get(db, 'instructions_file', '{}')), random_instructions=instructions)
+            tmp_path = f"{self.path}.tmp"
+            with metrics.span('json_io', file='instructions', op='write'):
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=4, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            with self.db.transaction() as db:
+                self.db.put(db, 'instructions_mtime', os.stat(self.path).st_mtime_ns)
+                self.db.put(db, 'instructions_file', json.dumps(data, ensure_ascii=False))
+        log.info("instructions.json saved (%d instructions)", len(instructions))
+
+# Kiosk state shared by the control page, the variant displays and the Pi controller:
+# one session per exhibit, holding the append-only choice history and the artifacts of
+# the current round. Clients send deltas; reads are served from a JSON snapshot that is
+# rebuilt only when the session's version changes, and changes are written behind.
+SESSION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions')  # None keeps sessions in memory only
+SESSION_DEFAULT_ID = 'default'
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+SESSION_FLUSH_DELAY = 1.0  # seconds to batch changes before writing
+SESSION_WAIT_TIMEOUT = 15  # seconds a reader may block waiting for a newer version
+SESSION_FIELDS = ('current_image', 'current_prompt')
+SESSION_ROUND_FIELDS = ('prompt', 'variants', 'images', 'summaries', 'instructions', 'reflection')
+
+class SessionConflict(Exception):
+    """A history append built on more history than the server has"""
+
+    def __init__(self, message, history_length):
+        super().__init__(message)
+        self.history_length = history_length
+
+def check_session_id(session_id):
+    if not isinstance(session_id, str) or not SESSION_ID_PATTERN.match(session_id):
+        raise ValueError(f"Invalid session id: {session_id!r}")
+    return session_id
+
+def empty_session():
+    return {'version': 0, 'history': [], 'current_image': None, 'current_prompt': None, 'round': {}}
+
+class SessionStore(ObservedStore):
+    """Versioned per-session kiosk state with cached snapshots, persisted atomically"""
+
+    def __init__(self, directory=SESSION_DIR, flush_delay=SESSION_FLUSH_DELAY):
+        super().__init__()
+        self.directory = directory
+        self.flush_delay = flush_delay
+        self.write_lock = Lock()
+        self.sessions = {}
+        self.snapshots = {}  # session id -> (version, state without history, its JSON text)
+        self.dirty = set()
+        self.flush_timer = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        atexit.register(self.flush)
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, f'{session_id}.json')
+
+    def _session(self, session_id):
+        # Caller holds self.lock. Sessions are loaded from disk on first use.
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = empty_session()
+            if self.directory and os.path.exists(self._path(session_id)):
+                try:
+                    with metrics.span('json_io', file='session', op='read'):
+                        with open(self._path(session_id), 'r', encoding='utf-8') as f:
+                            session.update(json.load(f))
+                except (OSError, ValueError) as e:
+                    log.error("Error loading session %s: %s", session_id, e)
+            self.sessions[session_id] = session
+        return session
+
+    def _snapshot(self, session_id):
+        # Caller holds self.lock
+        session = self._session(session_id)
+        cached = self.snapshots.get(session_id)
+        if cached is None or cached[0] != session['version']:
+            state = {
+                'session': session_id,
+                'version': session['version'],
+                'history_length': len(session['history']),
+                'current_image': session['current_image'],
+                'current_prompt': session['current_prompt'],
+                'round': session['round']
+            }
+            cached = (session['version'], state, json.dumps(dict(state, history=session['history']), ensure_ascii=False))
+            self.snapshots[session_id] = cached
+        return cached
+
+    def read(self, session_id, history_after=0):
+        """Return (version, snapshot JSON). With history_after=N only history items after
+        the first N are included, so displays that track the length download no history."""
+        with self.lock:
+            version, state, text = self._snapshot(check_session_id(session_id))
+            if history_after <= 0:
+                return version, text
+            history = self.sessions[session_id]['history'][history_after:]
+            return version, json.dumps(dict(state, history_after=history_after, history=history), ensure_ascii=False)
+
+    def version(self, session_id):
+        with self.lock:
+            return self._session(check_session_id(session_id))['version']
+
+    def wait(self, session_id, version, timeout, history_after=0):
+        """Like read, but block up to timeout seconds while the version is still `version`"""
+        check_session_id(session_id)
+        with self.changed:
+            self.changed.wait_for(lambda: self._session(session_id)['version'] != version, timeout=timeout)
+        return self.read(session_id, history_after)
+
+    def inputs(self, session_id):
+        """(history, current image, current prompt) for a generation request"""
+        with self.lock:
+            session = self._session(check_session_id(session_id))
+            return list(session['history']), session['current_image'], session['current_prompt']
+
+    def _check_delta(self, session_id, delta):
+        """(appended, fields, round_fields) of a valid delta; ValueError otherwise"""
+        check_session_id(session_id)
+        if not isinstance(delta, dict):
+            raise ValueError("A session delta must be a JSON object")
+        appended = delta.get('history_append') or []
+        fields = delta.get('set') or {}
+        round_fields = delta.get('round') or {}
+        if not isinstance(appended, list) or not all(isinstance(item, str) for item in appended):
+            raise ValueError("history_append must be a list of strings")
+        if not isinstance(fields, dict) or not all(value is None or isinstance(value, str) for value in fields.values()):
+            raise ValueError("set must map fields to strings or null")
+        if not isinstance(round_fields, dict):
+            raise ValueError("round must be an object")
+        base = delta.get('history_length')
+        if base is not None and (isinstance(base, bool) or not isinstance(base, int) or base < 0):
+            raise ValueError("history_length must be a non-negative integer")
+        unknown = (set(fields) - set(SESSION_FIELDS)) | (set(round_fields) - set(SESSION_ROUND_FIELDS))
+        if unknown:
+            raise ValueError(f"Unknown session fields: {', '.join(sorted(unknown))}")
+        return appended, fields, round_fields
+
+    def _apply(self, session_id, session, delta, appended, fields, round_fields):
+        # Updates session in place and bumps its version; SessionConflict before any change
+        history_length = 0 if delta.get('reset') else len(session['history'])
+        base = delta.get('history_length')
+        if appended and base is not None:
+            if base > history_length:
+                raise SessionConflict(f"Session {session_id} has {history_length} history items, client assumed {base}", history_length)
+            appended = appended[history_length - base:]
+        if delta.get('reset'):
+            session.update(empty_session(), version=session['version'])
+        session['history'].extend(appended)
+        session.update(fields)
+        if delta.get('new_round'):
+            session['round'] = {}
+        session['round'] = dict(session['round'], **round_fields)
+        session['version'] += 1
+
+    def apply(self, session_id, delta):
+        """Apply a client delta and return the new version. Keys, applied in this order:
+        reset, history_append (with history_length, the client's count before appending, so
+        a retried append isn't duplicated), set (current_image/current_prompt), new_round and round."""
+        appended, fields, round_fields = self._check_delta(session_id, delta)
+        with self.changed:
+            session = self._session(session_id)
+            self._apply(session_id, session, delta, appended, fields, round_fields)
+            self.dirty.add(session_id)
+            if self.directory and self.flush_timer is None:
+                self.flush_timer = Timer(self.flush_delay, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+            self._notify()
+            return session['version']
+
+    def flush(self):
+        """Write changed sessions: temp file, fsync, then rename over <id>.json"""
+        if not self.directory:
+            return
+        with self.write_lock:
+            with self.lock:
+                self.flush_timer = None
+                pending = {session_id: json.dumps(self.sessions[session_id], ensure_ascii=False) for session_id in self.dirty}
+                self.dirty.clear()
+            for session_id, payload in pending.items():
+                path = self._path(session_id)
+                tmp_path = f"{path}.tmp"
+                with metrics.span('json_io', file='session', op='write'):
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        f.write(payload)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sessions': len(self.sessions),
+                'history_items': sum(len(session['history']) for session in self.sessions.values()),
+                'pending_writes': len(self.dirty)
+            }
+
+class SqliteSessionStore(SessionStore):
+    """SessionStore in the shared state database. Each worker caches sessions and their
+    snapshots, and re-reads a session only when its version row has moved on."""
+
+    def __init__(self, db, import_directory=SESSION_DIR):
+        super().__init__(directory=None)
+        self.db = db
+        self.import_directory = import_directory  # <id>.json files from the memory backend, read once
+        db.subscribe(self)
+
+    def _session(self, session_id):
+        # Caller holds self.lock
+        row = self.db.connection().execute('SELECT version, state FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        cached = self.sessions.get(session_id)
+        if row is None:
+            if cached is None:
+                cached = empty_session()
+                path = os.path.join(self.import_directory, f'{session_id}.json') if self.import_directory else None
+                if path and os.path.exists(path):
+                    try:
+                        with open(path, 'r', encoding='utf-8') as f:
+                            cached.update(json.load(f))
+                    except (OSError, ValueError) as e:
+                        log.error("Error importing session %s: %s", session_id, e)
+                self.sessions[session_id] = cached
+            return cached
+        if cached is None or cached['version'] != row[0]:
+            cached = self.sessions[session_id] = json.loads(row[1])
+        return cached
+
+    def apply(self, session_id, delta):
+        appended, fields, round_fields = self._check_delta(session_id, delta)
+        with self.changed:
+            with self.db.transaction() as db:
+                # A copy, so a failed write doesn't leave the cache ahead of the database
+                session = copy.deepcopy(self._session(session_id))
+                self._apply(session_id, session, delta, appended, fields, round_fields)
+                db.execute('INSERT INTO sessions (id, version, state) VALUES (?, ?, ?) '
+                           'ON CONFLICT(id) DO UPDATE SET version = excluded.version, state = excluded.state',
+                           (session_id, session['version'], json.dumps(session, ensure_ascii=False)))
+            self.sessions[session_id] = session
+            self._notify()
+            return session['version']
+
+    def stats(self):
+        (sessions, history_items), = self.db.query(
+            "SELECT count(*), coalesce(sum(json_array_length(state, '$.history')), 0) FROM sessions")
+        return {'sessions': sessions, 'history_items': history_items, 'pending_writes': 0}
+
+# Iteration archive: every generated round (parent image, prompt, analysis, variants,
+# images, summaries, reflection) and every choice is appended to an indexed SQLite file,
+# so a session's evolution survives reloads and can be paged, traced back through its
+# parents and replayed without OpenAI. Requests only enqueue; a writer thread inserts
+# batches in one transaction.
+ARCHIVE_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive.db')  # None disables the archive
+ARCHIVE_BATCH_MAX = 200  # records per write transaction
+ARCHIVE_FLUSH_DELAY = 0.5  # seconds a batch may wait to fill up
+ARCHIVE_QUEUE_MAX = 10000  # records waiting to be written; beyond that new ones are dropped
+ARCHIVE_PAGE_MAX = 100
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS iterations (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    run INTEGER NOT NULL,
+    parent_id INTEGER REFERENCES iterations (id),
+    parent_image TEXT,
+    prompt TEXT,
+    created_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS iterations_by_session ON iterations (session_id, iteration);
+CREATE INDEX IF NOT EXISTS iterations_by_parent ON iterations (parent_id);
+CREATE TABLE IF NOT EXISTS iteration_images (
+    image TEXT NOT NULL,
+    iteration_id INTEGER NOT NULL REFERENCES iterations (id),
+    variant INTEGER NOT NULL,
+    PRIMARY KEY (image, iteration_id)
+);
+CREATE TABLE IF NOT EXISTS choices (
+    id INTEGER PRIMARY KEY,
+    iteration_id INTEGER NOT NULL REFERENCES iterations (id),
+    variant INTEGER NOT NULL,
+    image TEXT NOT NULL,
+    prompt TEXT,
+    chosen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS choices_by_iteration ON choices (iteration_id, id);
+CREATE TABLE IF NOT EXISTS runs (
+    session_id TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    first_iteration INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    PRIMARY KEY (session_id, run)
+);
+"""
+
+class IterationArchive(ObservedStore):
+    """Append-only archive of rounds and choices. A run is the stretch of a session between
+    two resets; the parent of a round is the archived round that produced its start image."""
+
+    def __init__(self, path=ARCHIVE_DB_PATH, image_key=lambda image_url: image_url):
+        super().__init__()
+        self.image_key = image_key  # host-independent key of an image URL, to find its parent round by
+        self.db = StateDatabase(path, ARCHIVE_SCHEMA, watch_interval=0) if path else None
+        self.write_lock = Lock()
+        self.pending = deque()
+        self.counters = Counter()
+        if self.db:
+            Thread(target=self._write_loop, daemon=True, name='archive-writer').start()
+            atexit.register(self.flush)
+
+    def _enqueue(self, kind, record):
+        if not self.db:
+            return
+        with self.lock:
+            if len(self.pending) >= ARCHIVE_QUEUE_MAX:
+                self.counters['dropped'] += 1
+                log.warning("Archive queue full, dropping a %s record", kind)
+                return
+            self.pending.append((kind, record))
+            self.changed.notify()
+
+    def add_iteration(self, session_id, prompt, history, image_url, result):
+        """Queue a finished round (a /generate-cycle result) for the archive"""
+        if session_id is None:
+            return
+        images = result['images']
+        self._enqueue('iteration', {
+            'session_id': session_id,
+            'parent_image': image_url,
+            'prompt': prompt,
+            'created_at': time.time(),
+            'data': {
+                'history': history,
+                'analysis': images[0]['debug_info'].get('image_analysis') if images else None,
+                'variants': result['variants'],
+                'images': [image['modifiedImageUrl'] for image in images],
+                'final_prompts': [image['debug_info'].get('final_prompt') for image in images],
+                'instructions': [image['debug_info'].get('random_instruction') for image in images],
+                'summaries': [summary['summary'] for summary in result['summaries']],
+                'reflection': (result.get('reflection') or {}).get('reflection'),
+                'pool': result.get('pool')
+            }
+        })
+
+    def add_choice(self, session_id, image, prompt):
+        """Queue the choice of `image` (one of the session's archived variants) as the winner"""
+        self._enqueue('choice', {'session_id': session_id, 'image': image, 'prompt': prompt, 'chosen_at': time.time()})
+
+    def add_reset(self, session_id):
+        """Queue the start of a new run for the session"""
+        self._enqueue('reset', {'session_id': session_id, 'started_at': time.time()})
+
+    def _write_loop(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.pending)
+                # Let a batch build up, unless it is full already
+                self.changed.wait_for(lambda: len(self.pending) >= ARCHIVE_BATCH_MAX, timeout=ARCHIVE_FLUSH_DELAY)
+            try:
+                self.flush(ARCHIVE_BATCH_MAX)
+            except sqlite3.Error as e:
+                log.error("Error writing the iteration archive: %s", e)
+                time.sleep(ARCHIVE_FLUSH_DELAY)
+            except Exception:
+                # Anything else is a record that can't be written; keep the writer going
+                log.exception("Dropped a batch the iteration archive could not write")
+
+    def flush(self, limit=None):
+        """Write queued records (up to limit) in one transaction. Batches that fail on the
+        database are requeued; ones that fail otherwise would fail again, so they are dropped"""
+        if not self.db:
+            return
+        with self.write_lock:
+            with self.lock:
+                count = len(self.pending) if limit is None else min(limit, len(self.pending))
+                batch = [self.pending.popleft() for _ in range(count)]
+            if not batch:
+                return
+            try:
+                with metrics.span('archive_write'):
+                    with self.db.transaction() as db:
+                        for kind, record in batch:
+                            getattr(self, f'_write_{kind}')(db, record)
+            except sqlite3.Error:
+                with self.lock:
+                    self.pending.extendleft(reversed(batch))
+                    self.counters['errors'] += 1
+                raise
+            except Exception:
+                with self.lock:
+                    self.counters['errors'] += 1
+                    self.counters['dropped'] += len(batch)
+                raise
+            with self.lock:
+                self.counters['written'] += len(batch)
+                self.counters['batches'] += 1
+
+    def _run(self, db, session_id):
+        row = db.execute('SELECT max(run) FROM runs WHERE session_id = ?', (session_id,)).fetchone()
+        return row[0] or 0
+
+    def _write_iteration(self, db, record):
+        session_id = record['session_id']
+        # The round that produced our start image, preferably in this session
+        parent = db.execute(
+            'SELECT images.iteration_id FROM iteration_images AS images JOIN iterations ON iterations.id = images.iteration_id '
+            'WHERE images.image = ? ORDER BY iterations.session_id = ? DESC, images.iteration_id DESC LIMIT 1',
+            (self.image_key(record['parent_image']), session_id)).fetchone()
+        iteration = db.execute('SELECT coalesce(max(iteration), 0) + 1 FROM iterations WHERE session_id = ?',
+                               (session_id,)).fetchone()[0]
+        iteration_id = db.execute(
+            'INSERT INTO iterations (session_id, iteration, run, parent_id, parent_image, prompt, created_at, data) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (session_id, iteration, self._run(db, session_id), parent[0] if parent else None, record['parent_image'],
+             record['prompt'], record['created_at'], json.dumps(record['data'], ensure_ascii=False))).lastrowid
+        db.executemany('INSERT OR IGNORE INTO iteration_images (image, iteration_id, variant) VALUES (?, ?, ?)',
+                       [(self.image_key(image), iteration_id, index + 1) for index, image in enumerate(record['data']['images'])])
+
+    def _write_choice(self, db, record):
+        found = db.execute(
+            'SELECT images.iteration_id, images.variant FROM iteration_images AS images '
+            'JOIN iterations ON iterations.id = images.iteration_id '
+            'WHERE images.image = ? AND iterations.session_id = ? ORDER BY images.iteration_id DESC LIMIT 1',
+            (self.image_key(record['image']), record['session_id'])).fetchone()
+        if found is None:
+            self.counters['unmatched_choices'] += 1
+            return
+        db.execute('INSERT INTO choices (iteration_id, variant, image, prompt, chosen_at) VALUES (?, ?, ?, ?, ?)',
+                   (found[0], found[1], record['image'], record['prompt'], record['chosen_at']))
+
+    def _write_reset(self, db, record):
+        session_id = record['session_id']
+        first = db.execute('SELECT coalesce(max(iteration), 0) + 1 FROM iterations WHERE session_id = ?',
+                           (session_id,)).fetchone()[0]
+        db.execute('INSERT INTO runs (session_id, run, first_iteration, started_at) VALUES (?, ?, ?, ?)',
+                   (session_id, self._run(db, session_id) + 1, first, record['started_at']))
+
+    ITERATION_COLUMNS = 'id, session_id, iteration, run, parent_id, parent_image, prompt, created_at, data'
+
+    def _record(self, db, row, full=True):
+        iteration_id, session_id, iteration, run, parent_id, parent_image, prompt, created_at, data = row
+        choice = db.execute('SELECT variant, image, prompt, chosen_at FROM choices WHERE iteration_id = ? '
+                            'ORDER BY id DESC LIMIT 1', (iteration_id,)).fetchone()
+        record = {
+            'id': iteration_id,
+            'session': session_id,
+            'iteration': iteration,
+            'run': run,
+            'parent_id': parent_id,
+            'parent_image': parent_image,
+            'prompt': prompt,
+            'created_at': created_at,
+            'winner': dict(zip(('variant', 'image', 'prompt', 'chosen_at'), choice)) if choice else None
+        }
+        data = json.loads(data)
+        if full:
+            record.update(data)
+        else:
+            record['images'] = data['images']
+        return record
+
+    def iteration(self, session_id, number):
+        """Iteration `number` of the session (one lookup in the session index), or None"""
+        db = self.db.connection()
+        row = db.execute(f'SELECT {self.ITERATION_COLUMNS} FROM iterations WHERE session_id = ? AND iteration = ?',
+                         (session_id, number)).fetchone()
+        return self._record(db, row) if row else None
+
+    def page(self, session_id, after=0, limit=ARCHIVE_PAGE_MAX, run=None, full=False):
+        """The session's iterations after iteration `after`, oldest first, optionally only
+        those of one run ('current' for the latest); returns (records, next cursor or None)"""
+        db = self.db.connection()
+        last = None
+        if run == 'current':
+            run = self._run(db, session_id)
+        if run is not None:
+            # Run 0 starts at the first iteration and has no row; later runs start at a reset
+            start = db.execute('SELECT first_iteration FROM runs WHERE session_id = ? AND run = ?',
+                               (session_id, run)).fetchone()
+            if start is None and run != 0:
+                return [], None
+            end = db.execute('SELECT min(first_iteration) FROM runs WHERE session_id = ? AND run > ?',
+                             (session_id, run)).fetchone()[0]
+            after = max(after, start[0] - 1 if start else 0)
+            last = end - 1 if end else None
+        rows = db.execute(f'SELECT {self.ITERATION_COLUMNS} FROM iterations WHERE session_id = ? AND iteration > ? '
+                          'AND iteration <= coalesce(?, iteration) ORDER BY iteration LIMIT ?',
+                          (session_id, after, last, limit + 1)).fetchall()
+        records = [self._record(db, row, full) for row in rows[:limit]]
+        return records, records[-1]['iteration'] if len(rows) > limit else None
+
+    def lineage(self, iteration_id, limit=ARCHIVE_PAGE_MAX):
+        """The iteration and its ancestors, newest first, one primary-key lookup per step;
+        returns (records, id to continue from or None)"""
+        db = self.db.connection()
+        records = []
+        next_id = iteration_id
+        while next_id is not None and len(records) < limit:
+            row = db.execute(f'SELECT {self.ITERATION_COLUMNS} FROM iterations WHERE id = ?', (next_id,)).fetchone()
+            if row is None:
+                break
+            records.append(self._record(db, row, full=False))
+            next_id = row[4]
+        return records, next_id
+
+    def children(self, iteration_id):
+        """Ids of the rounds that started from one of this iteration's images"""
+        return [row[0] for row in self.db.query('SELECT id FROM iterations WHERE parent_id = ? ORDER BY id', (iteration_id,))]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters, pending=len(self.pending))
+        if self.db:
+            stats['iterations'] = self.db.query('SELECT max(id) FROM iterations')[0][0] or 0
+        return stats
+
+# Server-side vote tallying: one ballot per session for the round on display, fed by kiosk
+# clicks (POST /votes/<session>) and by every physical button press. Displays follow the
+# aggregate (GET /votes/<session>) instead of counting button events themselves.
+VOTE_VARIANTS = (1, 2)
+VOTES_TO_WIN = 3
+VOTE_WINDOW = 0.0  # default seconds a ballot stays open; 0 means until a variant has VOTES_TO_WIN
+VOTE_CLOCK_SKEW = 2.0  # presses timestamped this long before a ballot opened still count for it (server clock)
+VOTE_COUNTER_STRIPES = 8
+VOTE_WAIT_TIMEOUT = 25  # seconds a GET /votes?after= waits for a change
+VOTE_KEY_MAX_LENGTH = 2048
+
+class StripedCounter:
+    """Counts per key spread over lock stripes picked by thread, so concurrent voters
+    (request threads, the batched Pi endpoint) don't all queue on one lock"""
+
+    def __init__(self, stripes=VOTE_COUNTER_STRIPES):
+        self.stripes = [(Lock(), Counter()) for _ in range(stripes)]
+
+    def add(self, key, amount=1):
+        lock, counts = self.stripes[get_ident() % len(self.stripes)]
+        with lock:
+            counts[key] += amount
+
+    def totals(self):
+        totals = Counter()
+        for lock, counts in self.stripes:
+            with lock:
+                totals.update(counts)
+        return totals
+
+class Ballot:
+    def __init__(self, number, key, window, votes_to_win, physical):
+        self.number = number
+        self.key = key
+        self.opened_at = time.time()
+        self.closes_at = self.opened_at + window if window else None
+        self.votes_to_win = votes_to_win
+        self.physical = physical
+        self.counts = StripedCounter()
+        self.final = None  # counts frozen when the ballot closed
+        self.winner = None
+        self.closed_at = None
+        self.reason = None
+
+    def leader(self, counts):
+        """The variant with the most votes, or None on a tie"""
+        ranked = sorted(VOTE_VARIANTS, key=lambda variant: counts[variant], reverse=True)
+        return ranked[0] if counts[ranked[0]] > counts[ranked[1]] else None
+
+    def version(self, counts):
+        # Counts only grow while open, so their total identifies the state
+        return f"{self.number}-{sum(counts.values())}-{int(self.winner is not None)}"
+
+    def outcome(self, counts, triggered_by=None):
+        """(winner, reason) if the ballot should close now: a variant reached votes_to_win, or
+        the window is over with a clear leader (a tie at the end stays open until the next
+        vote breaks it); None otherwise"""
+        if self.winner is not None:
+            return None
+        reached = [variant for variant in VOTE_VARIANTS if counts[variant] >= self.votes_to_win]
+        if reached:
+            # Both sides can cross the line in the same instant: the vote that did it wins ties
+            return self.leader(counts) or triggered_by or reached[0], 'votes'
+        if self.closes_at is not None and time.time() >= self.closes_at:
+            leader = self.leader(counts)
+            return (leader, 'window') if leader is not None else None
+        return None
+
+    def close(self, counts, winner, reason):
+        self.final = counts
+        self.winner = winner
+        self.closed_at = time.time()
+        self.reason = reason
+        log.info("Ballot %d closed (%s): variant %s wins %s", self.number, reason, winner, dict(counts))
+
+    def tally(self, session_id, counts):
+        return {
+            'session': session_id,
+            'ballot': self.number,
+            'version': self.version(counts),
+            'counts': {str(variant): counts[variant] for variant in VOTE_VARIANTS},
+            'votes_to_win': self.votes_to_win,
+            'opened_at': self.opened_at,
+            'closes_at': self.closes_at,
+            'open': self.winner is None,
+            'winner': self.winner,
+            'closed_at': self.closed_at,
+            'reason': self.reason
+        }
+
+class VoteBoard(ObservedStore):
+    """Current ballot per session; counting is striped, opening and closing take self.lock"""
+
+    def __init__(self):
+        super().__init__()
+        self.ballots = {}
+        self.numbers = Counter()  # last ballot number per session
+        self.counters = Counter()
+
+    def _settle(self, ballot, triggered_by=None):
+        """Close the ballot if Ballot.outcome says so"""
+        if ballot.outcome(ballot.counts.totals()) is None:
+            return
+        with self.lock:
+            counts = ballot.counts.totals()
+            outcome = ballot.outcome(counts, triggered_by)
+            if outcome is not None:
+                ballot.close(counts, *outcome)
+                self.counters['closed_' + outcome[1]] += 1
+                self._notify()
+
+    def open(self, session_id, key=None, window=None, votes_to_win=None, physical=True):
+        """Start a ballot for the session's round, replacing the previous one. With a key
+        (the round's images) an existing ballot for the same key is returned instead, so
+        reloads and other kiosks showing the same round join it."""
+        check_session_id(session_id)
+        window = VOTE_WINDOW if window is None else window
+        votes_to_win = VOTES_TO_WIN if votes_to_win is None else votes_to_win
+        with self.lock:
+            ballot = self.ballots.get(session_id)
+            if key is not None and ballot is not None and ballot.key == key:
+                return ballot
+            self.numbers[session_id] += 1
+            ballot = Ballot(self.numbers[session_id], key, window, votes_to_win, physical)
+            self.ballots[session_id] = ballot
+            self.counters['opened'] += 1
+            self._notify()
+            return ballot
+
+    def discard(self, session_id):
+        with self.lock:
+            if self.ballots.pop(session_id, None) is not None:
+                self._notify()
+
+    def current(self, session_id):
+        with self.lock:
+            return self.ballots.get(session_id)
+
+    def vote(self, session_id, variant, number=None):
+        """A kiosk click for the session's current ballot; False when that ballot is not
+        open (closed already, or a click for an earlier round)"""
+        ballot = self.current(session_id)
+        if ballot is None or ballot.winner is not None or (number is not None and number != ballot.number):
+            self.counters['rejected'] += 1
+            return False
+        self._cast(ballot, variant)
+        return True
+
+    def add_presses(self, events):
+        """Count physical button events (from the button log) for every open physical ballot"""
+        with self.lock:
+            ballots = [ballot for ballot in self.ballots.values() if ballot.physical and ballot.winner is None]
+        for event in events:
+            timestamp = event['timestamp'] if isinstance(event['timestamp'], (int, float)) else time.time()
+            for ballot in ballots:
+                if event['button'] in VOTE_VARIANTS and timestamp >= ballot.opened_at - VOTE_CLOCK_SKEW:
+                    self._cast(ballot, event['button'])
+
+    def _cast(self, ballot, variant):
+        if ballot.winner is not None:
+            return
+        ballot.counts.add(variant)
+        self.counters['votes'] += 1
+        self._settle(ballot, variant)
+        with self.lock:
+            self._notify()
+
+    def _version(self, session_id):
+        # Caller holds self.lock
+        ballot = self.ballots.get(session_id)
+        if ballot is None:
+            return None
+        return ballot.version(ballot.final if ballot.winner is not None else ballot.counts.totals())
+
+    def version(self, session_id):
+        with self.lock:
+            return self._version(session_id)
+
+    def wait_timeout(self, session_id, timeout=VOTE_WAIT_TIMEOUT):
+        """How long a long-poll may wait: never past the end of the voting window (once it
+        is over, only a tie-breaking vote can change the tally)"""
+        ballot = self.current(session_id)
+        if ballot is None or ballot.winner is not None or ballot.closes_at is None:
+            return timeout
+        remaining = ballot.closes_at - time.time()
+        return min(timeout, remaining) if remaining > 0 else timeout
+
+    def wait(self, session_id, version, timeout=VOTE_WAIT_TIMEOUT):
+        """Block up to wait_timeout seconds while the tally's version is still `version`"""
+        timeout = self.wait_timeout(session_id, timeout)
+        with self.changed:
+            self.changed.wait_for(lambda: self._version(session_id) != version, timeout=timeout)
+
+    def tally(self, session_id):
+        """The session's current ballot as JSON-ready dict, or None"""
+        ballot = self.current(session_id)
+        if ballot is None:
+            return None
+        self._settle(ballot)
+        return ballot.tally(session_id, ballot.final if ballot.winner is not None else ballot.counts.totals())
+
+    def stats(self):
+        with self.lock:
+            open_ballots = sum(1 for ballot in self.ballots.values() if ballot.winner is None)
+            return dict(self.counters, ballots=len(self.ballots), open=open_ballots)
+
+BALLOT_FIELDS = ('number', 'key', 'opened_at', 'closes_at', 'votes_to_win', 'physical', 'winner', 'closed_at', 'reason')
+
+class SqliteVoteBoard(VoteBoard):
+    """VoteBoard in the shared state database, so clicks and presses received by any worker
+    count for the same ballot. Each vote is one short write transaction (the database lock
+    replaces the striped counters)."""
+
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        db.subscribe(self)
+
+    def _load(self, db, session_id):
+        """(ballot, counts) for the session, or (None, None)"""
+        row = db.execute('SELECT state FROM ballots WHERE session_id = ?', (session_id,)).fetchone()
+        if row is None:
+            return None, None
+        state = json.loads(row[0])
+        ballot = Ballot(state['number'], state['key'], 0, state['votes_to_win'], state['physical'])
+        for field in BALLOT_FIELDS:
+            setattr(ballot, field, state[field])
+        counts = Counter({int(variant): count for variant, count in state['counts'].items()})
+        if ballot.winner is not None:
+            ballot.final = counts
+        return ballot, counts
+
+    def _store(self, db, session_id, ballot, counts):
+        state = {field: getattr(ballot, field) for field in BALLOT_FIELDS}
+        state['counts'] = {str(variant): counts[variant] for variant in VOTE_VARIANTS}
+        db.execute('INSERT INTO ballots (session_id, state) VALUES (?, ?) '
+                   'ON CONFLICT(session_id) DO UPDATE SET state = excluded.state', (session_id, json.dumps(state)))
+
+    def _changed(self):
+        with self.lock:
+            self._notify()
+
+    def open(self, session_id, key=None, window=None, votes_to_win=None, physical=True):
+        check_session_id(session_id)
+        window = VOTE_WINDOW if window is None else window
+        votes_to_win = VOTES_TO_WIN if votes_to_win is None else votes_to_win
+        with self.db.transaction() as db:
+            ballot, _ = self._load(db, session_id)
+            if key is not None and ballot is not None and ballot.key == key:
+                return ballot
+            number = self.db.add(db, f'ballot_number:{session_id}')
+            ballot = Ballot(number, key, window, votes_to_win, physical)
+            self._store(db, session_id, ballot, Counter())
+            self.db.add(db, 'votes_opened')
+        self._changed()
+        return ballot
+
+    def discard(self, session_id):
+        with self.db.transaction() as db:
+            discarded = db.execute('DELETE FROM ballots WHERE session_id = ?', (session_id,)).rowcount
+        if discarded:
+            self._changed()
+
+    def current(self, session_id):
+        return self._load(self.db.connection(), session_id)[0]
+
+    def _cast(self, db, session_id, ballot, counts, variant):
+        counts[variant] += 1
+        self.db.add(db, 'votes_votes')
+        outcome = ballot.outcome(counts, variant)
+        if outcome is not None:
+            ballot.close(counts, *outcome)
+            self.db.add(db, 'votes_closed_' + outcome[1])
+        self._store(db, session_id, ballot, counts)
+
+    def vote(self, session_id, variant, number=None):
+        with self.db.transaction() as db:
+            ballot, counts = self._load(db, session_id)
+            if ballot is None or ballot.winner is not None or (number is not None and number != ballot.number):
+                self.db.add(db, 'votes_rejected')
+                return False
+            self._cast(db, session_id, ballot, counts, variant)
+        self._changed()
+        return True
+
+    def add_presses(self, events):
+        cast = False
+        with self.db.transaction() as db:
+            for (session_id,) in db.execute('SELECT session_id FROM ballots').fetchall():
+                ballot, counts = self._load(db, session_id)
+                if not ballot.physical:
+                    continue
+                for event in events:
+                    timestamp = event['timestamp'] if isinstance(event['timestamp'], (int, float)) else time.time()
+                    if (ballot.winner is None and event['button'] in VOTE_VARIANTS
+                            and timestamp >= ballot.opened_at - VOTE_CLOCK_SKEW):
+                        self._cast(db, session_id, ballot, counts, event['button'])
+                        cast = True
+        if cast:
+            self._changed()
+
+    def _version(self, session_id):
+        ballot, counts = self._load(self.db.connection(), session_id)
+        return None if ballot is None else ballot.version(counts)
+
+    def tally(self, session_id):
+        ballot, counts = self._load(self.db.connection(), session_id)
+        if ballot is None:
+            return None
+        if ballot.outcome(counts) is not None:
+            # The window ran out since the last vote: close it for everyone
+            with self.db.transaction() as db:
+                ballot, counts = self._load(db, session_id)
+                outcome = ballot and ballot.outcome(counts)
+                if outcome:
+                    ballot.close(counts, *outcome)
+                    self.db.add(db, 'votes_closed_' + outcome[1])
+                    self._store(db, session_id, ballot, counts)
+            if ballot is None:
+                return None
+            self._changed()
+        return ballot.tally(session_id, counts)
+
+    def stats(self):
+        ballots = [json.loads(state) for (state,) in self.db.query('SELECT state FROM ballots')]
+        return dict(self.db.counters('votes_'), ballots=len(ballots),
+                    open=sum(1 for ballot in ballots if ballot['winner'] is None))
+
+# Background generation jobs: a request submits the work and gets a job id back right
+# away instead of holding its connection (and a server thread) for the whole DALL-E
+# call. Jobs run on a bounded pool in priority order, and a full queue is refused with
+# 429 + Retry-After so the backpressure is explicit.
+GENERATION_JOB_WORKERS = 4
+GENERATION_JOB_MAX_QUEUED = 32
+GENERATION_JOB_RETENTION = 600  # seconds finished jobs stay pollable
+GENERATION_JOB_DEFAULT_PRIORITY = 5  # lower runs first
+GENERATION_JOB_WAIT_TIMEOUT = 25  # longest a status request may block with ?wait=
+JOB_FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+class JobQueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class JobCancelled(Exception):
+    """Raised from a job's progress callback once the job has been cancelled"""
+
+class JobQueue(ObservedStore):
+    """Bounded worker pool running submitted callables in priority order, with status and cancellation"""
+
+    def __init__(self, workers=GENERATION_JOB_WORKERS, max_queued=GENERATION_JOB_MAX_QUEUED,
+                 retention=GENERATION_JOB_RETENTION, name='jobs'):
+        super().__init__()
+        self.workers = workers
+        self.max_queued = max_queued
+        self.retention = retention
+        self.heap = []  # (priority, seq, job id); cancelled entries are skipped when popped
+        self.jobs = {}  # job id -> job, including finished ones until they expire
+        self.seq = itertools.count()
+        self.queued = 0
+        self.running = 0
+        self.run_seconds = deque(maxlen=50)  # recent run times, for Retry-After estimates
+        for index in range(workers):
+            Thread(target=self._work, daemon=True, name=f'{name}-{index}').start()
+
+    def _changed(self, job):
+        # Caller holds self.lock
+        job['revision'] += 1
+        self._notify()
+
+    def _after_change(self):
+        """Runs after every change, once self.lock is released (SqliteJobQueue stores the jobs here)"""
+
+    def _view(self, job):
+        # Caller holds self.lock
+        view = {key: value for key, value in job.items() if key not in ('work', 'key')}
+        if job['status'] == 'queued':
+            view['position'] = sum(1 for key, _ in self._queued_keys() if key < job['key'])
+        return view
+
+    def _queued_keys(self):
+        for priority, seq, job_id in self.heap:
+            job = self.jobs.get(job_id)
+            if job is not None and job['status'] == 'queued':
+                yield (priority, seq), job
+
+    def _retry_after(self):
+        # Caller holds self.lock
+        typical = statistics.median(self.run_seconds) if self.run_seconds else 10.0
+        return max(1, int(typical * self.queued / max(1, self.workers)))
+
+    def _prune(self):
+        # Caller holds self.lock
+        cutoff = time.time() - self.retention
+        expired = [job_id for job_id, job in self.jobs.items() if job['finished'] and job['finished'] < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def submit(self, kind, work, group=None, priority=GENERATION_JOB_DEFAULT_PRIORITY):
+        """Queue work(progress) and return the job's status; raises JobQueueFull.
+        work may call progress(stage) between steps, which raises JobCancelled once cancelled
+        (progress(None) only checks). Upstream calls already in flight are not interrupted."""
+        with self.changed:
+            self._prune()
+            if self.queued >= self.max_queued:
+                metrics.inc('jobs_rejected_total', kind=kind)
+                raise JobQueueFull(self._retry_after())
+            key = (priority, next(self.seq))
+            job = {
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'group': group,
+                'priority': priority,
+                'status': 'queued',
+                'stage': None,
+                'revision': 0,
+                'cancel_requested': False,
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'result': None,
+                'error': None,
+                'work': work,
+                'key': key
+            }
+            self.jobs[job['id']] = job
+            heapq.heappush(self.heap, key + (job['id'],))
+            self.queued += 1
+            self._changed(job)
+            view = self._view(job)
+        self._after_change()
+        return view
+
+    def _next_job(self):
+        # Caller holds self.lock; returns None when only cancelled entries were left
+        while self.heap:
+            job = self.jobs.get(heapq.heappop(self.heap)[2])
+            if job is not None and job['status'] == 'queued':
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self.changed:
+                job = None
+                while job is None:
+                    self.changed.wait_for(lambda: self.heap)
+                    job = self._next_job()
+                self.queued -= 1
+                self.running += 1
+                job.update(status='running', started=time.time())
+                self._changed(job)
+            self._after_change()
+            metrics.observe('job_wait_seconds', job['started'] - job['created'], kind=job['kind'])
+
+            result, error = None, None
+            try:
+                result = job['work'](lambda stage: self._progress(job, stage))
+            except JobCancelled:
+                pass
+            except Exception as e:
+                log.error("Job %s (%s) failed: %s", job['id'], job['kind'], e)
+                error = str(e)
+
+            with self.changed:
+                self.running -= 1
+                job['finished'] = time.time()
+                job['work'] = None
+                if job['cancel_requested']:
+                    job['status'] = 'cancelled'
+                elif error is not None:
+                    job.update(status='failed', error=error)
+                else:
+                    job.update(status='done', result=result)
+                self.run_seconds.append(job['finished'] - job['started'])
+                self._changed(job)
+            self._after_change()
+            metrics.observe('job_run_seconds', job['finished'] - job['started'], kind=job['kind'], status=job['status'])
+
+    def _progress(self, job, stage):
+        with self.changed:
+            if job['cancel_requested']:
+                raise JobCancelled()
+            if stage is not None and stage != job['stage']:
+                job['stage'] = stage
+                self._changed(job)
+        self._after_change()
+
+    def _lookup(self, job_id):
+        # Caller holds self.lock
+        job = self.jobs.get(job_id)
+        return self._view(job) if job else None
+
+    def get(self, job_id):
+        with self.lock:
+            return self._lookup(job_id)
+
+    def _settled(self, job_id, revision):
+        # Caller holds self.lock
+        job = self._lookup(job_id)
+        if job is None:
+            return True
+        if revision is None:
+            return job['status'] in JOB_FINISHED_STATES
+        return job['revision'] != revision
+
+    def settled(self, job_id, revision=None):
+        """True once the job has finished or, given a revision, changed from it"""
+        with self.lock:
+            return self._settled(job_id, revision)
+
+    def wait(self, job_id, timeout, revision=None):
+        """Block up to timeout seconds until settled(job_id, revision); returns the status or None"""
+        with self.changed:
+            self.changed.wait_for(lambda: self._settled(job_id, revision), timeout=timeout)
+            return self._lookup(job_id)
+
+    def _cancel(self, job):
+        # Caller holds self.lock. Queued jobs stop at once; running ones when they next
+        # report progress (upstream calls in flight still finish), and their result is
+        # dropped either way.
+        if job['status'] == 'queued':
+            self.queued -= 1
+            job.update(status='cancelled', finished=time.time(), work=None)
+        elif job['status'] == 'running':
+            job['cancel_requested'] = True
+        else:
+            return False
+        self._changed(job)
+        return True
+
+    def cancel(self, job_id):
+        """Cancel one job; returns its status, or None if unknown"""
+        with self.changed:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            self._cancel(job)
+            view = self._view(job)
+        self._after_change()
+        return view
+
+    def cancel_group(self, group):
+        """Cancel every unfinished job of a group; returns how many were cancelled"""
+        with self.changed:
+            cancelled = sum(self._cancel(job) for job in list(self.jobs.values())
+                            if job['group'] == group and not job['cancel_requested'])
+        self._after_change()
+        return cancelled
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'running': self.running,
+                'retained': len(self.jobs)
+            }
+
+class SqliteJobQueue(JobQueue):
+    """JobQueue whose job status lives in the shared state database, so a client polling
+    /jobs/<id> can land on any worker. Jobs still run in the worker that accepted them;
+    another worker's cancel sets a flag there that the owner picks up before starting the
+    job, whenever it reports progress and when it stores the outcome. Queue positions are
+    only known to the owner. Changed jobs are written once self.lock is released, so the
+    queue never waits on the database."""
+
+    def __init__(self, db, **kwargs):
+        self.db = db
+        self.store_lock = Lock()  # keeps the writes in order; never taken while holding self.lock
+        self.unstored = {}  # job id -> job changed since it was last written
+        self.prune_due = False
+        super().__init__(**kwargs)
+        db.subscribe(self)
+
+    def _stored(self, job_id):
+        rows = self.db.query('SELECT state FROM jobs WHERE id = ?', (job_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def _cancel_requested(self, job):
+        rows = self.db.query('SELECT cancel_requested FROM jobs WHERE id = ?', (job['id'],))
+        return bool(rows and rows[0][0])
+
+    def _store(self, states, prune):
+        # A cancel from another worker wins over the outcome, as a local one does; a failed
+        # write leaves the status visible to this worker only. Returns the states written.
+        written = {}
+        try:
+            with self.db.transaction() as db:
+                for job_id, state in states.items():
+                    row = db.execute('SELECT cancel_requested, state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+                    if row is not None:
+                        if row[0] and state['status'] == 'running':
+                            state['cancel_requested'] = True
+                        elif row[0] and state['status'] in ('done', 'failed'):
+                            state.update(status='cancelled', result=None, error=None)
+                        state['revision'] = max(state['revision'], json.loads(row[1])['revision'] + 1)
+                    try:
+                        text = json.dumps(state)
+                    except (TypeError, ValueError) as e:
+                        log.error("Could not store the status of job %s: %s", job_id, e)
+                        continue
+                    db.execute('INSERT INTO jobs (id, job_group, status, finished, state) VALUES (?, ?, ?, ?, ?) '
+                               'ON CONFLICT(id) DO UPDATE SET status = excluded.status, finished = excluded.finished, '
+                               'state = excluded.state',
+                               (job_id, state['group'], state['status'], state['finished'], text))
+                    written[job_id] = state
+                if prune:
+                    db.execute('DELETE FROM jobs WHERE finished < ?', (time.time() - self.retention,))
+        except sqlite3.Error as e:
+            log.error("Could not store the status of %d job(s): %s", len(states), e)
+            return {}
+        return written
+
+    def _changed(self, job):
+        super()._changed(job)
+        self.unstored[job['id']] = job
+
+    def _after_change(self):
+        with self.store_lock:
+            with self.lock:
+                states = {job_id: {key: value for key, value in job.items() if key not in ('work', 'key')}
+                          for job_id, job in self.unstored.items()}
+                self.unstored = {}
+                prune, self.prune_due = self.prune_due, False
+            if not states and not prune:
+                return
+            written = self._store(states, prune)
+            with self.changed:
+                # Take over what the database had: revisions bumped and cancels flagged elsewhere
+                notify = False
+                for job_id, state in written.items():
+                    job = self.jobs.get(job_id)
+                    if job is None:
+                        continue
+                    job['revision'] = max(job['revision'], state['revision'])
+                    if state['cancel_requested'] and job['status'] == 'running' and not job['cancel_requested']:
+                        job['cancel_requested'] = notify = True
+                    elif state['status'] == 'cancelled' and job['status'] in ('done', 'failed'):
+                        job.update(status='cancelled', result=None, error=None)
+                        notify = True
+                if notify:
+                    self._notify()
+
+    def _prune(self):
+        super()._prune()
+        self.prune_due = True
+
+    def _next_job(self):
+        while True:
+            job = super()._next_job()
+            if job is None or not self._cancel_requested(job):
+                return job
+            self._cancel(job)
+
+    def _progress(self, job, stage):
+        with self.changed:
+            if not job['cancel_requested'] and self._cancel_requested(job):
+                self._cancel(job)
+        self._after_change()
+        super()._progress(job, stage)
+
+    def _lookup(self, job_id):
+        return super()._lookup(job_id) or self._stored(job_id)
+
+    def _cancel_stored(self, db, job_id):
+        """Flag a job another worker owns; returns (status, whether it was cancelled now)"""
+        row = db.execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None, False
+        job = json.loads(row[0])
+        if job['status'] in JOB_FINISHED_STATES or job['cancel_requested']:
+            return job, False
+        # Queued jobs show as cancelled at once; the owner skips them when they come up
+        if job['status'] == 'queued':
+            job.update(status='cancelled', finished=time.time())
+        else:
+            job['cancel_requested'] = True
+        job['revision'] += 1
+        db.execute('UPDATE jobs SET cancel_requested = 1, status = ?, finished = ?, state = ? WHERE id = ?',
+                   (job['status'], job['finished'], json.dumps(job), job_id))
+        return job, True
+
+    def cancel(self, job_id):
+        with self.lock:
+            local = job_id in self.jobs
+        if local:
+            return super().cancel(job_id)
+        with self.db.transaction() as db:
+            job, _ = self._cancel_stored(db, job_id)
+        return job
+
+    def cancel_group(self, group):
+        cancelled = super().cancel_group(group)
+        with self.lock:
+            local = set(self.jobs)
+        with self.db.transaction() as db:
+            rows = db.execute("SELECT id FROM jobs WHERE job_group = ? AND status IN ('queued', 'running') "
+                              "AND cancel_requested = 0", (group,)).fetchall()
+            cancelled += sum(self._cancel_stored(db, job_id)[1] for (job_id,) in rows if job_id not in local)
+        return cancelled
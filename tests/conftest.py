@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The backend modules are flat scripts next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py reads these at import time; the tests never reach OpenAI
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+os.environ['STATE_BACKEND'] = 'memory'
+os.environ['UPSTREAM_RATE_LIMITS'] = 'off'
@@ -0,0 +1,243 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import pytest
+
+import app
+from state_stores import ButtonEventLog, SessionStore, VoteBoard
+
+IMAGE_REQUEST = {'model': 'dall-e-3', 'prompt': 'a circle', 'n': 1, 'size': '1024x1792'}
+
+# Shared route bodies
+
+@pytest.fixture
+def stores(monkeypatch):
+    """Fresh in-memory stores behind the route bodies"""
+    monkeypatch.setattr(app, 'button_log', ButtonEventLog())
+    monkeypatch.setattr(app, 'session_store', SessionStore(directory=None))
+    monkeypatch.setattr(app, 'vote_board', VoteBoard())
+    monkeypatch.setattr(app, 'iteration_archive', app.IterationArchive(path=None))
+
+def test_poll_button_events_batches_after_a_cursor(stores):
+    for button in (1, 2, 1):
+        app.record_button_press(button, None)
+    body = app.poll_button_events('1', '1')
+    assert [event['seq'] for event in body['events']] == [2]
+    assert (body['cursor'], body['missed'], body['reset']) == (2, 0, False)
+
+def test_poll_button_events_resets_a_cursor_from_before_a_restart(stores):
+    app.record_button_press(2, None)
+    body = app.poll_button_events('40', None)
+    assert (body['events'], body['cursor'], body['reset']) == ([], 1, True)
+    assert app.resync_button_cursor(40) == (1, True)
+    assert app.resync_button_cursor(1) == (1, False)
+
+def test_session_delta_conflict_answers_409_with_the_history_length(stores):
+    assert app.apply_session_delta('s1', {'history_append': ['a'], 'history_length': 0})[1] == 200
+    body, status = app.apply_session_delta('s1', {'history_append': ['b'], 'history_length': 2})
+    assert status == 409
+    assert (body['history_length'], body['version']) == (1, 1)
+
+def test_session_delta_with_a_bad_history_length_answers_400(stores):
+    body, status = app.apply_session_delta('s1', {'history_append': ['a'], 'history_length': 'two'})
+    assert status == 400 and 'history_length' in body['error']
+
+def test_vote_on_a_closed_ballot_answers_409(stores):
+    assert app.cast_vote('s1', {'variant': 1})[1] == 404
+    tally, status = app.open_ballot('s1', {'votes_to_win': 1})
+    assert status == 200 and tally['open']
+    body, status = app.cast_vote('s1', {'variant': 2, 'ballot': tally['ballot']})
+    assert status == 200 and body['winner'] == 2
+    body, status = app.cast_vote('s1', {'variant': 1, 'ballot': tally['ballot']})
+    assert status == 409
+    assert (body['open'], body['counts']) == (False, {'1': 0, '2': 1})
+    assert app.cast_vote('s1', {'variant': True})[1] == 400
+
+# Streamed variant batches
+
+def variant_batch(texts, summaries, reflection=None):
+    answer = {'variants': [{'text': text, 'summary': summary} for text, summary in zip(texts, summaries)]}
+    if reflection is not None:
+        answer['reflection'] = reflection
+    return json.dumps(answer)
+
+def split_events(content, chunk_size, **kwargs):
+    splitter = app.VariantBatchStreamSplitter(**kwargs)
+    events = []
+    for start in range(0, len(content), chunk_size):
+        events.extend(splitter.feed(content[start:start + chunk_size]))
+    return events, splitter.close()
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 1000])
+def test_splitter_streams_variants_summaries_and_reflection(chunk_size):
+    texts = ['Make the circle "glow" é\U0001f600', 'Add a line\nbelow it']
+    content = variant_batch(texts, ['Glow', 'Line'], 'It drifts warmer')
+    events, closing = split_events(content, chunk_size, with_reflection=True)
+    for index, text in enumerate(texts):
+        assert ''.join(data['text'] for kind, data in events if kind == 'delta' and data['index'] == index) == text
+    assert [data['text'] for kind, data in events if kind == 'variant'] == texts
+    assert [data['text'] for kind, data in events if kind == 'summary'] == ['Glow', 'Line']
+    assert [data['text'] for kind, data in events if kind == 'reflection'] == ['It drifts warmer']
+    assert closing == []
+
+def test_splitter_ignores_variants_beyond_the_count_and_an_unrequested_reflection():
+    content = variant_batch(['one', 'two', 'three'], ['1', '2', '3'], 'not asked for')
+    events, closing = split_events(content, 5)
+    assert [data['text'] for kind, data in events if kind == 'variant'] == ['one', 'two']
+    assert not any(kind == 'reflection' for kind, _ in events)
+    assert closing == []
+
+def test_splitter_rejects_a_malformed_answer_on_close():
+    splitter = app.VariantBatchStreamSplitter()
+    splitter.feed('{"variants": [{"text": "only one", "summary": "1"}]}')
+    with pytest.raises(ValueError):
+        splitter.close()
+
+# Precomputed variant pool
+
+def pool_entry(image, variants):
+    return {
+        'image': image,
+        'variants': variants,
+        'variants_debug_info': {},
+        'summaries': [{'summary': text, 'original_summary': text} for text in variants],
+        'images': [],
+        'reflection': {'reflection': 'pooled'}
+    }
+
+@pytest.fixture
+def pool(monkeypatch):
+    variant_pool = app.VariantPool(path=None)
+    monkeypatch.setattr(app, 'variant_pool', variant_pool)
+    return variant_pool
+
+def failing_generate():
+    raise app.UpstreamUnavailable('upstream down')
+
+def test_pool_answers_a_hit_without_generating(pool):
+    pool.entries['CircleStart.png'] = pool_entry('CircleStart.png', ['a', 'b'])
+    result = app.variants_with_pool('CircleStart.png', 2, failing_generate)
+    assert result['variants'] == ['a', 'b']
+    assert result['debug_info']['pool'] == {'image': 'CircleStart.png', 'fallback': False}
+
+def test_pool_falls_back_when_generation_fails(pool):
+    name = 'ab' * 32 + '.png'
+    pool.entries[name] = pool_entry(name, ['a', 'b'])
+    # Three variants aren't in the pool, so they are generated; a failure serves the pooled round
+    result = app.variants_with_pool(f'http://kiosk.local/images/{name}', 3, failing_generate)
+    assert result['debug_info']['pool'] == {'image': name, 'fallback': True}
+    assert app.variants_with_pool(name, 3, lambda: {'variants': ['x', 'y', 'z']}) == {'variants': ['x', 'y', 'z']}
+    assert pool.counters['fallbacks'] == 1
+
+def test_pool_fallback_needs_the_same_image_and_variants(pool):
+    pool.entries['CircleStart.png'] = pool_entry('CircleStart.png', ['a', 'b'])
+    with pytest.raises(app.UpstreamUnavailable):
+        app.variants_with_pool('other.png', 2, failing_generate)
+    assert pool.fallback('CircleStart.png', ['a', 'other']) is None
+    assert pool.fallback('CircleStart.png', ['a', 'b'])['image'] == 'CircleStart.png'
+
+def test_pool_starts_empty_on_a_corrupt_index(tmp_path):
+    path = tmp_path / 'variant_pool.json'
+    path.write_text('{"entries": {"CircleStart.png": ')
+    assert app.VariantPool(path=str(path)).entries == {}
+
+# Upstream rate limits
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = VirtualClock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
+
+def admit(scheduler, clock, priority):
+    with scheduler.lock:
+        return app.with_priority(priority, scheduler._admit, IMAGE_REQUEST, clock.now + 60)
+
+def spend_budget(scheduler, clock):
+    """Grant the requests that may go out at once"""
+    burst = [admit(scheduler, clock, 'interactive') for _ in range(int(scheduler.limiters['dall-e-3'].requests.capacity))]
+    with scheduler.lock:
+        assert all(scheduler._check(ticket) for ticket in burst)
+
+def test_scheduler_grants_waiters_most_important_first(clock):
+    scheduler = app.RateLimitScheduler({'dall-e-3': (60, None)})
+    spend_budget(scheduler, clock)
+    waiting = {priority: admit(scheduler, clock, priority) for priority in ('speculative', 'background', 'interactive')}
+    granted = []
+    while waiting:
+        clock.now += 0.25
+        with scheduler.lock:
+            for priority, ticket in list(waiting.items()):
+                if scheduler._check(ticket):
+                    granted.append(priority)
+                    del waiting[priority]
+        assert clock.now < 1010
+    assert granted == ['interactive', 'background', 'speculative']
+
+def test_scheduler_sheds_speculative_work_that_would_wait_too_long(clock):
+    scheduler = app.RateLimitScheduler({'dall-e-3': (6, None)})
+    spend_budget(scheduler, clock)
+    with pytest.raises(app.UpstreamBusy, match='budget exhausted'):
+        admit(scheduler, clock, 'speculative')
+    assert admit(scheduler, clock, 'interactive').state == 'waiting'
+
+def test_scheduler_leaves_unlimited_models_alone():
+    scheduler = app.RateLimitScheduler({})
+    assert scheduler.acquire(IMAGE_REQUEST, time.monotonic() + 1) is None
+
+# Single-flight
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_single_flight_shares_a_call_in_flight():
+    flight = app.SingleFlight()
+    release = Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return 'answer'
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(flight.do, 'chat', 'key', call)
+        wait_until(lambda: flight.stats()['in_flight'] == 1)
+        second = executor.submit(flight.do, 'chat', 'key', call)
+        wait_until(lambda: flight.stats()['endpoints']['chat']['shared_in_flight'] == 1)
+        release.set()
+        assert (first.result(5), second.result(5)) == ('answer', 'answer')
+    assert calls == [1]
+
+def test_single_flight_reuses_recent_results_within_the_ttl():
+    flight = app.SingleFlight(ttl=60, ttls={'image': 0})
+    assert flight.do('chat', 'key', lambda: 1) == 1
+    assert flight.do('chat', 'key', lambda: 2) == 1
+    assert flight.do('chat', 'other', lambda: 3) == 3
+    flight.forget('chat', 'key')
+    assert flight.do('chat', 'key', lambda: 4) == 4
+    # A TTL of 0 only deduplicates calls in flight
+    assert flight.do('image', 'key', lambda: 5) == 5
+    assert flight.do('image', 'key', lambda: 6) == 6
+    assert flight.stats()['endpoints']['chat']['saved'] == 1
+
+def test_single_flight_does_not_keep_failures():
+    flight = app.SingleFlight(ttl=60)
+    with pytest.raises(RuntimeError):
+        flight.do('chat', 'key', failing_call)
+    assert flight.do('chat', 'key', lambda: 'retried') == 'retried'
+
+def failing_call():
+    raise RuntimeError('upstream down')
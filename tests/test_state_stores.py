@@ -0,0 +1,250 @@
+import time
+from threading import Event
+
+import pytest
+
+from state_stores import (
+    ButtonEventLog, IterationArchive, JobCancelled, JobQueue, JobQueueFull, SessionConflict, SessionStore, VoteBoard
+)
+
+# Button event log
+
+def test_button_log_sequence_is_contiguous():
+    log = ButtonEventLog(size=8)
+    events = [log.append(button, 100.0 + button) for button in (1, 2, 1)]
+    assert [event['seq'] for event in events] == [1, 2, 3]
+    assert log.read_after(1) == (events[1:], 3, 0)
+    assert log.read_after(0, limit=2) == (events[:2], 2, 0)
+    assert log.read_after(3) == ([], 3, 0)
+
+def test_button_log_reports_events_evicted_from_the_ring():
+    log = ButtonEventLog(size=3)
+    for _ in range(5):
+        log.append(1, None)
+    events, cursor, missed = log.read_after(0)
+    assert [event['seq'] for event in events] == [3, 4, 5]
+    assert (cursor, missed) == (5, 2)
+    assert log.stats()['dropped'] == 2
+
+def test_button_log_reads_a_stale_cursor_from_the_end():
+    # A cursor handed out before a restart is past the new log's last seq
+    log = ButtonEventLog()
+    log.append(2, None)
+    assert log.read_after(10) == ([], 1, 0)
+
+def test_button_log_batch_skips_resent_press_ids():
+    log = ButtonEventLog()
+    first = log.append_batch([('a', 1, 1.0), ('b', 2, 2.0)])
+    again = log.append_batch([('b', 2, 2.0), ('c', 1, 3.0)])
+    assert [event['seq'] for event in first] == [1, 2]
+    assert [(event['seq'], event['button']) for event in again] == [(3, 1)]
+    assert log.stats()['duplicates'] == 1
+
+def test_button_log_claim_next_hands_out_each_press_once():
+    log = ButtonEventLog()
+    log.append(1, None)
+    log.append(2, None)
+    assert [log.claim_next()['button'], log.claim_next()['button'], log.claim_next()] == [1, 2, None]
+
+# Sessions
+
+def test_session_retried_append_is_not_duplicated():
+    store = SessionStore(directory=None)
+    store.apply('s1', {'history_append': ['a'], 'history_length': 0})
+    store.apply('s1', {'history_append': ['a', 'b'], 'history_length': 0})
+    assert store.inputs('s1')[0] == ['a', 'b']
+
+def test_session_append_past_the_history_is_a_conflict():
+    store = SessionStore(directory=None)
+    version = store.apply('s1', {'history_append': ['a'], 'history_length': 0})
+    with pytest.raises(SessionConflict) as conflict:
+        store.apply('s1', {'history_append': ['c'], 'history_length': 3})
+    assert conflict.value.history_length == 1
+    assert store.version('s1') == version
+    assert store.inputs('s1')[0] == ['a']
+
+@pytest.mark.parametrize('history_length', [-1, True, '1', 1.5])
+def test_session_history_length_must_be_a_count(history_length):
+    store = SessionStore(directory=None)
+    with pytest.raises(ValueError, match='history_length'):
+        store.apply('s1', {'history_append': ['a'], 'history_length': history_length})
+
+def test_session_rejects_unknown_fields_and_ids():
+    store = SessionStore(directory=None)
+    with pytest.raises(ValueError, match='bogus'):
+        store.apply('s1', {'set': {'bogus': 'x'}})
+    with pytest.raises(ValueError):
+        store.apply('../etc', {})
+
+def test_session_read_after_sends_only_new_history():
+    store = SessionStore(directory=None)
+    store.apply('s1', {'history_append': ['a', 'b', 'c']})
+    version, text = store.read('s1', history_after=2)
+    assert version == 1
+    assert '"history": ["c"]' in text and '"history_length": 3' in text
+
+# Votes
+
+def test_ballot_closes_when_a_variant_reaches_votes_to_win():
+    board = VoteBoard()
+    ballot = board.open('s1', votes_to_win=2)
+    assert board.vote('s1', 1, ballot.number)
+    assert board.vote('s1', 2, ballot.number)
+    assert board.vote('s1', 1, ballot.number)
+    tally = board.tally('s1')
+    assert (tally['open'], tally['winner'], tally['reason']) == (False, 1, 'votes')
+    assert tally['counts'] == {'1': 2, '2': 1}
+    assert not board.vote('s1', 2, ballot.number)
+    assert board.tally('s1')['counts'] == {'1': 2, '2': 1}
+
+def test_ballot_rejects_votes_for_an_earlier_round():
+    board = VoteBoard()
+    old = board.open('s1', key='round 1')
+    new = board.open('s1', key='round 2')
+    assert new.number == old.number + 1
+    assert board.open('s1', key='round 2') is new
+    assert not board.vote('s1', 1, old.number)
+    assert board.stats()['rejected'] == 1
+
+def test_ballot_window_closes_on_a_leader_but_not_on_a_tie():
+    board = VoteBoard()
+    ballot = board.open('s1', window=60)
+    board.vote('s1', 1)
+    board.vote('s1', 2)
+    ballot.closes_at = time.time() - 1
+    assert board.tally('s1')['open']
+    board.vote('s1', 2)
+    tally = board.tally('s1')
+    assert (tally['open'], tally['winner'], tally['reason']) == (False, 2, 'window')
+
+def test_physical_presses_count_for_open_physical_ballots():
+    board = VoteBoard()
+    board.open('kiosk', votes_to_win=2)
+    board.open('web', physical=False)
+    now = time.time()
+    board.add_presses([{'button': 2, 'timestamp': now}, {'button': 2, 'timestamp': now}, {'button': 3, 'timestamp': now}])
+    assert board.tally('kiosk')['winner'] == 2
+    assert board.tally('web')['counts'] == {'1': 0, '2': 0}
+
+# Jobs
+
+def wait_for(job_queue, job_id, timeout=5):
+    job = job_queue.wait(job_id, timeout)
+    assert job['status'] in ('done', 'failed', 'cancelled'), job
+    return job
+
+def wait_running(job_queue):
+    deadline = time.monotonic() + 5
+    while job_queue.stats()['running'] == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_jobs_run_in_priority_order():
+    job_queue = JobQueue(workers=1, name='test-jobs')
+    release = Event()
+    order = []
+    blocker = job_queue.submit('test', lambda progress: release.wait(5))
+    wait_running(job_queue)
+    low = job_queue.submit('test', lambda progress: order.append('low'), priority=9)
+    high = job_queue.submit('test', lambda progress: order.append('high'), priority=1)
+    assert (job_queue.get(high['id'])['position'], job_queue.get(low['id'])['position']) == (0, 1)
+    release.set()
+    for job in (blocker, low, high):
+        assert wait_for(job_queue, job['id'])['status'] == 'done'
+    assert order == ['high', 'low']
+
+def test_jobs_reject_work_beyond_the_queue_limit():
+    job_queue = JobQueue(workers=1, max_queued=1, name='test-jobs')
+    release = Event()
+    job_queue.submit('test', lambda progress: release.wait(5))
+    wait_running(job_queue)
+    job_queue.submit('test', lambda progress: None)
+    with pytest.raises(JobQueueFull) as full:
+        job_queue.submit('test', lambda progress: None)
+    assert full.value.retry_after >= 1
+    release.set()
+
+def test_jobs_cancel_queued_and_running_work():
+    job_queue = JobQueue(workers=1, name='test-jobs')
+    started, release = Event(), Event()
+
+    def work(progress):
+        started.set()
+        release.wait(5)
+        progress('next stage')
+        return 'never returned'
+
+    running = job_queue.submit('test', work, group='s1')
+    queued = job_queue.submit('test', lambda progress: 'never run', group='s1')
+    other = job_queue.submit('test', lambda progress: 'kept', group='s2')
+    assert started.wait(5)
+    assert job_queue.cancel(queued['id'])['status'] == 'cancelled'
+    assert job_queue.cancel_group('s1') == 1
+    release.set()
+    assert wait_for(job_queue, running['id'])['status'] == 'cancelled'
+    assert wait_for(job_queue, running['id'])['result'] is None
+    assert wait_for(job_queue, other['id'])['result'] == 'kept'
+    assert job_queue.cancel('unknown') is None
+
+def test_jobs_progress_raises_once_cancelled():
+    job_queue = JobQueue(workers=1, name='test-jobs')
+    checked = Event()
+    seen = []
+
+    def work(progress):
+        progress('first')
+        checked.wait(5)
+        try:
+            progress(None)
+        except JobCancelled:
+            seen.append('cancelled')
+            raise
+
+    job = job_queue.submit('test', work)
+    while job_queue.get(job['id'])['stage'] != 'first':
+        time.sleep(0.01)
+    job_queue.cancel(job['id'])
+    checked.set()
+    assert wait_for(job_queue, job['id'])['status'] == 'cancelled'
+    assert seen == ['cancelled']
+
+# Iteration archive
+
+def cycle_result(images):
+    return {
+        'variants': [f'variant for {image}' for image in images],
+        'images': [{'modifiedImageUrl': image, 'debug_info': {'final_prompt': 'p', 'random_instruction': 'i'}}
+                   for image in images],
+        'summaries': [{'summary': f'summary of {image}'} for image in images],
+        'reflection': {'reflection': 'r'}
+    }
+
+def test_archive_links_rounds_choices_and_runs(tmp_path):
+    archive = IterationArchive(path=str(tmp_path / 'archive.db'))
+    archive.add_iteration('s1', 'start', [], 'CircleStart.png', cycle_result(['a.png', 'b.png']))
+    archive.add_choice('s1', 'b.png', 'summary of b.png')
+    archive.add_iteration('s1', 'summary of b.png', ['summary of b.png'], 'b.png', cycle_result(['c.png', 'd.png']))
+    archive.add_reset('s1')
+    archive.add_iteration('s1', 'start', [], 'CircleStart.png', cycle_result(['e.png', 'f.png']))
+    archive.flush()
+
+    first = archive.iteration('s1', 1)
+    assert first['winner']['variant'] == 2
+    assert first['summaries'] == ['summary of a.png', 'summary of b.png']
+    second = archive.iteration('s1', 2)
+    assert second['parent_id'] == first['id']
+    records, next_id = archive.lineage(second['id'])
+    assert [record['iteration'] for record in records] == [2, 1] and next_id is None
+
+    records, cursor = archive.page('s1', run='current')
+    assert [(record['iteration'], record['run']) for record in records] == [(3, 1)]
+    records, cursor = archive.page('s1', limit=2)
+    assert [record['iteration'] for record in records] == [1, 2]
+    assert archive.page('s1', after=cursor)[0][0]['iteration'] == 3
+
+def test_archive_ignores_choices_it_has_no_round_for(tmp_path):
+    archive = IterationArchive(path=str(tmp_path / 'archive.db'))
+    archive.add_choice('s1', 'unknown.png', None)
+    archive.flush()
+    assert archive.stats()['unmatched_choices'] == 1
+    assert archive.page('s1') == ([], None)